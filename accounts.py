@@ -6,29 +6,34 @@ Handles user registration, authentication, and account data
 
 import json
 import os
-import hashlib
-import secrets
+import threading
 from datetime import datetime, timedelta
+from passwords import PasswordHasher
 
 # ==================== FILE PATHS ====================
 ACCOUNTS_FILE = 'accounts_data.json'
 
+# ==================== PASSWORD HASHING ====================
+password_hasher = PasswordHasher(os.environ.get('ECHOROOM_PASSWORD_HASHER', 'scrypt'))
+
 # ==================== HELPER FUNCTIONS ====================
 
 def hash_password(password, salt=None):
     """Hash password with salt"""
-    if salt is None:
-        salt = secrets.token_hex(16)
-    return hashlib.sha256((password + salt).encode()).hexdigest(), salt
+    return password_hasher.hash(password, salt)
 
 def verify_password(password, hashed_password, salt):
     """Verify password against stored hash"""
-    return hashlib.sha256((password + salt).encode()).hexdigest() == hashed_password
+    return password_hasher.verify(password, hashed_password, salt)
 
 # ==================== DATA MANAGEMENT ====================
+# The file is read once; every operation then works on the same in-memory
+# data (and its username index) and save_accounts writes it back.
 
-def load_accounts():
-    """Load accounts from file"""
+_accounts = None
+_accounts_lock = threading.Lock()
+
+def _read_accounts_file():
     try:
         if os.path.exists(ACCOUNTS_FILE):
             with open(ACCOUNTS_FILE, 'r') as f:
@@ -40,9 +45,33 @@ def load_accounts():
     
     return {
         'users': {},  # email -> user data
-        'sessions': {}  # email -> sessions list
+        'sessions': {},  # email -> sessions list
+        'usernames': {}  # username -> email
     }
 
+def load_accounts():
+    """Accounts data, read from file on first use"""
+    global _accounts
+    if _accounts is None:
+        with _accounts_lock:
+            if _accounts is None:
+                accounts = _read_accounts_file()
+                get_username_index(accounts)
+                _accounts = accounts
+    return _accounts
+
+def get_username_index(accounts_data):
+    """Return the username -> email index, rebuilding it if missing or stale"""
+    index = accounts_data.get('usernames')
+    if index is None or len(index) != len(accounts_data['users']):
+        index = {
+            user_data['username']: email
+            for email, user_data in accounts_data['users'].items()
+            if user_data.get('username')
+        }
+        accounts_data['usernames'] = index
+    return index
+
 def save_accounts(accounts_data):
     """Save accounts to file"""
     try:
@@ -68,9 +97,9 @@ def create_account(email, username, password):
         return False, 'Email already registered', None
     
     # Check if username already exists
-    for user_data in accounts['users'].values():
-        if user_data.get('username') == username:
-            return False, 'Username already taken', None
+    usernames = get_username_index(accounts)
+    if username in usernames:
+        return False, 'Username already taken', None
     
     # Hash password
     hashed_password, salt = hash_password(password)
@@ -90,6 +119,7 @@ def create_account(email, username, password):
     # Save to accounts
     accounts['users'][email] = user_data
     accounts['sessions'][email] = []
+    usernames[username] = email
     
     save_accounts(accounts)
     
@@ -112,6 +142,10 @@ def authenticate_user(email, password):
     if not verify_password(password, user_data['password_hash'], user_data['salt']):
         return False, 'Invalid email or password', None
     
+    # Upgrade legacy / outdated hashes while we have the plain password
+    if password_hasher.needs_rehash(user_data['password_hash']):
+        user_data['password_hash'], user_data['salt'] = hash_password(password)
+    
     # Update last login
     user_data['last_login'] = datetime.now().isoformat()
     accounts['users'][email] = user_data
@@ -128,10 +162,10 @@ def get_user_by_email(email):
 def get_user_by_username(username):
     """Get user data by username"""
     accounts = load_accounts()
-    for email, user_data in accounts['users'].items():
-        if user_data.get('username') == username:
-            return user_data
-    return None
+    email = get_username_index(accounts).get(username)
+    if email is None:
+        return None
+    return accounts['users'].get(email)
 
 def update_user_data(email, updates):
     """Update user data"""
@@ -140,7 +174,21 @@ def update_user_data(email, updates):
     if email not in accounts['users']:
         return False, 'User not found'
     
+    usernames = get_username_index(accounts)
+    old_username = accounts['users'][email].get('username')
+    new_username = updates.get('username', old_username)
+    
+    # A rename must not take over another user's name
+    if new_username != old_username and usernames.get(new_username, email) != email:
+        return False, 'Username already taken'
+    
     accounts['users'][email].update(updates)
+    
+    # Keep the username index in step with renames
+    if new_username != old_username:
+        usernames.pop(old_username, None)
+        usernames[new_username] = email
+    
     save_accounts(accounts)
     
     print(f"✅ User data updated: {email}")
@@ -4,28 +4,66 @@ EchoRoom - Secure Voice & Text Chat with Gmail Validation
 FIXED VERSION - No Syntax Errors
 """
 
+# Selects threading/eventlet/gevent; must patch before anything imports socket
+import runtime
+runtime.monkey_patch()
+
 import uuid
+import base64
+import binascii
 import hashlib
 import json
 import os
-import smtplib
-import ssl
 import re
 import secrets
+import atexit
+import signal
+import sys
+import threading
+import time
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from flask import Flask, render_template_string, request
+from flask import Flask, request, send_file
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from journal import Journal
+from storage import BytesEncoder, JsonStorage, decode_bytes
+from sessions import SessionIndex
+from passwords import PasswordHasher
+from mailer import MailQueue, SmtpTransport, SinkTransport
+from pages import IMMUTABLE, REVALIDATE, build_page
+from cluster import LocalManager, LocalPresence, RedisPresence
+from blobs import BlobStore, served_type, sniff_image
+from archive import MessageArchive
+from search import MessageSearch, conversation_id
+from presence import PresenceAggregator, RoomUpdateAggregator
+from directory import RoomDirectory, room_audience, room_summary, timestamp_seconds
+from audio import VoiceProcessor, VoiceRejected
 
 # Initialize Flask app FIRST
 app = Flask(__name__)
 app.secret_key = 'echo-room-secret-key-2025'
 
+# Multi-worker fan-out: '' (single process), 'local' (in-process stand-in)
+# or a message queue URL (redis://, amqp://, kafka://) shared by all workers
+MESSAGE_QUEUE = os.environ.get('ECHOROOM_MESSAGE_QUEUE', '')
+# Where presence lives; defaults to the message queue when that is Redis
+PRESENCE_URL = os.environ.get('ECHOROOM_PRESENCE_URL',
+                              MESSAGE_QUEUE if MESSAGE_QUEUE.startswith('redis') else '')
+
+def message_queue_options():
+    """SocketIO keyword arguments for MESSAGE_QUEUE"""
+    if not MESSAGE_QUEUE:
+        return {}
+    if MESSAGE_QUEUE == 'local':
+        return {'client_manager': LocalManager()}
+    return {'message_queue': MESSAGE_QUEUE}
+
 # Initialize SocketIO AFTER app
 socketio = SocketIO(app, 
                    cors_allowed_origins="*",
-                   async_mode='threading')
+                   async_mode=runtime.ASYNC_MODE,
+                   **message_queue_options())
 
 # Email Configuration (REPLACE WITH REAL CREDENTIALS)
 EMAIL_SENDER = "echoroomteam1@gmail.com"  # Replace with real Gmail
@@ -33,14 +71,76 @@ EMAIL_PASSWORD = "jxsb vfkm zseq zwqq"  # Replace with Gmail App Password
 EMAIL_HOST = "smtp.gmail.com"
 EMAIL_PORT = 587
 
+# Outbound mail: 'smtp', or 'sink' to keep mail local (tests / development)
+MAIL_BACKEND = os.environ.get('ECHOROOM_MAIL_BACKEND', 'smtp')
+MAIL_SINK_FILE = os.environ.get('ECHOROOM_MAIL_SINK_FILE', 'echoroom_mail_sink.jsonl')
+MAIL_DEAD_LETTER_FILE = os.environ.get('ECHOROOM_MAIL_DEAD_LETTER_FILE', 'echoroom_mail_dead.jsonl')
+MAIL_BATCH_SIZE = int(os.environ.get('ECHOROOM_MAIL_BATCH_SIZE', 20))
+MAIL_MAX_ATTEMPTS = int(os.environ.get('ECHOROOM_MAIL_MAX_ATTEMPTS', 5))
+
+def open_mail_queue():
+    """Build the background mail queue for MAIL_BACKEND"""
+    if MAIL_BACKEND == 'sink':
+        transport = SinkTransport(MAIL_SINK_FILE)
+        print(f"📭 Mail sink: {MAIL_SINK_FILE}")
+    elif MAIL_BACKEND == 'smtp':
+        transport = SmtpTransport(EMAIL_HOST, EMAIL_PORT, EMAIL_SENDER, EMAIL_PASSWORD)
+    else:
+        raise ValueError(f"Unknown ECHOROOM_MAIL_BACKEND: {MAIL_BACKEND}")
+    queue = MailQueue(transport, EMAIL_SENDER,
+                      dead_letter_file=MAIL_DEAD_LETTER_FILE,
+                      batch_size=MAIL_BATCH_SIZE,
+                      max_attempts=MAIL_MAX_ATTEMPTS)
+    queue.start()
+    return queue
+
+mail_queue = open_mail_queue()
+atexit.register(mail_queue.close)
+
 # Email validation regex
 EMAIL_REGEX = r'^[a-zA-Z0-9._%+-]+@gmail\.com$'
 
 # Session token expiry (30 days)
 SESSION_EXPIRY_DAYS = 30
 
+# Password hashing: 'scrypt' or 'pbkdf2_sha256', cost and worker pool size
+PASSWORD_HASHER = os.environ.get('ECHOROOM_PASSWORD_HASHER', 'scrypt')
+PASSWORD_HASH_WORKERS = int(os.environ.get('ECHOROOM_PASSWORD_HASH_WORKERS', 0)) or None
+SCRYPT_COST = {
+    'n': int(os.environ.get('ECHOROOM_SCRYPT_N', 2 ** 14)),
+    'r': int(os.environ.get('ECHOROOM_SCRYPT_R', 8)),
+    'p': int(os.environ.get('ECHOROOM_SCRYPT_P', 1)),
+}
+PBKDF2_COST = {
+    'iterations': int(os.environ.get('ECHOROOM_PBKDF2_ITERATIONS', 600000)),
+}
+
+password_hasher = PasswordHasher(
+    PASSWORD_HASHER,
+    workers=PASSWORD_HASH_WORKERS,
+    **(SCRYPT_COST if PASSWORD_HASHER == 'scrypt' else PBKDF2_COST)
+)
+atexit.register(password_hasher.close)
+
+# Voice clips: caps, optional Opus transcoding (needs ffmpeg) and waveform previews
+VOICE_MAX_BYTES = int(os.environ.get('ECHOROOM_VOICE_MAX_BYTES', 1000000))
+VOICE_MAX_SECONDS = int(os.environ.get('ECHOROOM_VOICE_MAX_SECONDS', 60))
+VOICE_TRANSCODE = os.environ.get('ECHOROOM_VOICE_TRANSCODE', '0') == '1'
+VOICE_BITRATE = os.environ.get('ECHOROOM_VOICE_BITRATE', '24k')
+VOICE_WORKERS = int(os.environ.get('ECHOROOM_VOICE_WORKERS', 2))
+
+voice_processor = VoiceProcessor(
+    max_bytes=VOICE_MAX_BYTES,
+    max_seconds=VOICE_MAX_SECONDS,
+    transcode=VOICE_TRANSCODE,
+    bitrate=VOICE_BITRATE,
+    ffmpeg=os.environ.get('ECHOROOM_FFMPEG'),
+    workers=VOICE_WORKERS
+)
+atexit.register(voice_processor.close)
+
 # إضافة encoder مخصص للتاريخ
-class DateTimeEncoder(json.JSONEncoder):
+class DateTimeEncoder(BytesEncoder):
     def default(self, obj):
         if isinstance(obj, datetime):
             return obj.isoformat()
@@ -122,34 +222,65 @@ See you inside EchoRoom,
         msg.attach(part1)
         msg.attach(part2)
         
-        # Create secure SSL context
-        context = ssl.create_default_context()
-        
-        # Connect to SMTP server and send email
-        with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as server:
-            server.starttls(context=context)
-            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-            server.sendmail(EMAIL_SENDER, to_email, msg.as_string())
-        
-        print(f"📧 Welcome email sent to {to_email}")
+        # Hand off to the mail queue; delivery happens in the background
+        mail_queue.send(to_email, msg.as_string(), kind='welcome email')
         return True
     except Exception as e:
-        print(f"❌ Failed to send email: {e}")
+        print(f"❌ Failed to queue email: {e}")
         return False
 
+def read_data_url(value, default_type):
+    """Bytes and MIME type of a base64 data URL, or (None, None)"""
+    if not isinstance(value, str) or not value.startswith('data:'):
+        return None, None
+    header, _, payload = value.partition(',')
+    mime_type = header[len('data:'):].replace(';base64', '') or default_type
+    try:
+        return base64.b64decode(payload), mime_type
+    except (ValueError, binascii.Error):
+        return None, None
+
+def read_voice_payload(data):
+    """Audio bytes and MIME type of a voice message.
+    
+    Accepts the binary attachment ('audio' + 'mimeType') and, for clients
+    still on the old page, a base64 data URL in 'audioData'.
+    """
+    audio = data.get('audio')
+    if isinstance(audio, (bytes, bytearray)):
+        return bytes(audio), data.get('mimeType') or 'audio/webm'
+    return read_data_url(data.get('audioData'), 'audio/webm')
+
+def process_voice_payload(data):
+    """Validated, capped (and possibly transcoded) clip of a voice message.
+    
+    Returns {'audio', 'mimeType', 'duration', 'waveform'}; raises
+    VoiceRejected when the clip is not accepted.
+    """
+    audio, mime_type = read_voice_payload(data)
+    return voice_processor.process(audio, mime_type, data.get('duration', 0))
+
 def generate_session_token():
     """Generate a secure session token"""
     return secrets.token_urlsafe(32)
 
 def hash_password(password, salt=None):
     """Hash password with salt"""
-    if salt is None:
-        salt = secrets.token_hex(16)
-    return hashlib.sha256((password + salt).encode()).hexdigest(), salt
+    return password_hasher.hash(password, salt)
 
 def verify_password(password, hashed_password, salt):
     """Verify password against stored hash"""
-    return hashlib.sha256((password + salt).encode()).hexdigest() == hashed_password
+    return password_hasher.verify(password, hashed_password, salt)
+
+def upgrade_password_hash(email, user_data, password):
+    """Rehash a just-verified password if it uses a legacy or outdated scheme"""
+    if not password_hasher.needs_rehash(user_data['password_hash']):
+        return
+    hashed_password, salt = hash_password(password)
+    store.update_user(email, {
+        'password_hash': hashed_password,
+        'salt': salt
+    })
 
 # ==================== HTML TEMPLATE WITH AUTO-LOGIN ====================
 HTML_TEMPLATE = '''
@@ -722,6 +853,68 @@ HTML_TEMPLATE = '''
             overflow: hidden;
         }
 
+        .voice-bars {
+            position: absolute;
+            inset: 0 10px;
+            display: flex;
+            align-items: center;
+            gap: 2px;
+        }
+
+        .voice-bars span {
+            flex: 1;
+            background: rgba(255,255,255,0.45);
+            border-radius: 1px;
+        }
+
+        .message-search {
+            position: relative;
+            margin-right: 15px;
+        }
+
+        .message-search input {
+            width: 220px;
+            padding: 8px 12px;
+            background: rgba(255,255,255,0.08);
+            border: 1px solid rgba(255,255,255,0.15);
+            border-radius: 8px;
+            color: white;
+        }
+
+        .search-results {
+            display: none;
+            position: absolute;
+            right: 0;
+            top: 42px;
+            width: 360px;
+            max-height: 420px;
+            overflow-y: auto;
+            background: rgba(20, 20, 30, 0.98);
+            border: 1px solid rgba(255,255,255,0.15);
+            border-radius: 10px;
+            z-index: 50;
+        }
+
+        .search-result {
+            padding: 10px 14px;
+            border-bottom: 1px solid rgba(255,255,255,0.06);
+            cursor: pointer;
+        }
+
+        .search-result:hover { background: rgba(0,229,255,0.08); }
+
+        .search-result-meta {
+            font-size: 12px;
+            color: #00e5ff;
+            margin-bottom: 4px;
+        }
+
+        .search-result-text {
+            font-size: 14px;
+            color: rgba(255,255,255,0.85);
+            word-break: break-word;
+        }
+
         .voice-progress {
             position: absolute;
             left: 0;
@@ -890,6 +1083,10 @@ HTML_TEMPLATE = '''
                     <i class="fas fa-plus"></i>
                     <span>Create Room</span>
                 </div>
+                <div class="nav-item" onclick="showBrowseRoomsModal()">
+                    <i class="fas fa-compass"></i>
+                    <span>Browse Rooms</span>
+                </div>
             </div>
 
             <div class="nav-section">
@@ -950,6 +1147,11 @@ HTML_TEMPLATE = '''
                     </button>
                 </div>
                 <div class="user-info">
+                    <div class="message-search">
+                        <input type="text" id="message-search-input" placeholder="Search messages..."
+                               oninput="scheduleMessageSearch()">
+                        <div class="search-results" id="search-results"></div>
+                    </div>
                     <div id="connection-status" class="premium-badge">
                         <i class="fas fa-wifi"></i> Connected
                     </div>
@@ -1167,6 +1369,33 @@ HTML_TEMPLATE = '''
         </div>
     </div>
 
+    <div class="modal" id="browse-rooms-modal">
+        <div class="settings-modal-content">
+            <button class="close-btn" onclick="hideBrowseRoomsModal()">
+                <i class="fas fa-times"></i>
+            </button>
+            
+            <div class="settings-header">
+                <h2><i class="fas fa-compass"></i> Browse Rooms</h2>
+            </div>
+
+            <div class="form-group">
+                <input type="text" id="room-browse-input" placeholder="Search rooms..." oninput="scheduleRoomBrowse()">
+            </div>
+
+            <div class="form-group">
+                <label for="room-browse-sort">Sort By</label>
+                <select id="room-browse-sort" onchange="browseRooms(null)">
+                    <option value="members">Most Members</option>
+                    <option value="activity">Recently Active</option>
+                    <option value="name">Name</option>
+                </select>
+            </div>
+
+            <div id="room-browse-results"></div>
+        </div>
+    </div>
+
     <div class="modal" id="add-friend-modal">
         <div class="settings-modal-content">
             <button class="close-btn" onclick="hideAddFriendModal()">
@@ -1303,6 +1532,11 @@ HTML_TEMPLATE = '''
         let friends = [];
         let privateChats = {};
 
+        // History paging: older pages load when the chat is scrolled to the top
+        let historyHasMore = false;
+        let historyLoading = false;
+        let olderHistoryAnchor = null;  // scroll position kept while a page is prepended
+
         // Voice recording variables
         let mediaRecorder = null;
         let audioChunks = [];
@@ -1313,7 +1547,8 @@ HTML_TEMPLATE = '''
 
         // Initialize WebSocket
         function initWebSocket() {
-            socket = io();
+            // WebSocket first: a single long-lived connection needs no sticky routing
+            socket = io({ transports: ['websocket', 'polling'] });
             
             socket.on('connect', () => {
                 console.log('✅ Connected to EchoRoom');
@@ -1408,11 +1643,23 @@ socket.on('message_sent', (data) => {
                 console.log('📨 Chat messages loaded:', messages?.length);
                 const messagesDiv = document.getElementById('chat-messages');
                 messagesDiv.innerHTML = '';
+                historyLoading = false;
+                historyHasMore = !!(messages && messages.length > 0);
                 if (messages && messages.length > 0) {
-                    messages.forEach(msg => addMessage(msg));
+                    messages.forEach(msg => msg.type === 'voice' ? addVoiceMessage(msg) : addMessage(msg));
                 }
             });
 
+            // An older page of room history (requested with a 'before' cursor)
+            socket.on('chat_messages_page', (data) => {
+                if (data.room !== currentRoom) return;
+                historyLoading = false;
+                historyHasMore = !!data.has_more;
+                prependOlderMessages(() => {
+                    data.messages.forEach(msg => msg.type === 'voice' ? addVoiceMessage(msg) : addMessage(msg));
+                });
+            });
+
             socket.on('message_deleted', (data) => {
                 console.log('🗑️ Message deleted:', data);
                 const messageDiv = document.querySelector(`[data-message-id="${data.message_id}"]`);
@@ -1467,6 +1714,34 @@ socket.on('private_message', (data) => {
     }
 });
 
+function addPrivateHistoryMessage(msg, index) {
+    if (msg.type === 'voice') {
+        addVoiceMessage({
+            id: msg.id || Date.now().toString() + index,
+            username: msg.from,
+            displayName: msg.displayName || msg.from,
+            audioBlob: msg.audioBlob,
+            audio: msg.audio,
+            audioData: msg.audioData,
+            mimeType: msg.mimeType,
+            duration: msg.duration,
+            waveform: msg.waveform,
+            timestamp: msg.timestamp || new Date().toISOString(),
+            type: 'voice'
+        });
+        return;
+    }
+    addMessage({
+        id: msg.id || Date.now().toString() + index,
+        username: msg.from,
+        displayName: msg.displayName || msg.from,
+        message: msg.message,
+        server: msg.room_id || currentRoom,
+        timestamp: msg.timestamp || new Date().toISOString(),
+        type: 'private'
+    });
+}
+
 socket.on('private_messages', (data) => {
     console.log('📨🔥 PRIVATE MESSAGES LOADED - DEBUG:', data);
     const messagesDiv = document.getElementById('chat-messages');
@@ -1476,22 +1751,22 @@ socket.on('private_messages', (data) => {
         return;
     }
     
+    historyLoading = false;
+    historyHasMore = !!data.has_more;
+    
+    // An older page (requested with a 'before' cursor) goes above what is shown
+    if (data.before) {
+        if (data.room_id === currentRoom) {
+            prependOlderMessages(() => data.messages.forEach(addPrivateHistoryMessage));
+        }
+        return;
+    }
+    
     messagesDiv.innerHTML = '';
     
     if (data.messages && data.messages.length > 0) {
         console.log(`✅ Loading ${data.messages.length} private messages`);
-        data.messages.forEach((msg, index) => {
-            console.log(`📝 Message ${index + 1}:`, msg);
-            addMessage({
-                id: msg.id || Date.now().toString() + index,
-                username: msg.from,
-                displayName: msg.displayName || msg.from,
-                message: msg.message,
-                server: msg.room_id || currentRoom,
-                timestamp: msg.timestamp || new Date().toISOString(),
-                type: 'private'
-            });
-        });
+        data.messages.forEach(addPrivateHistoryMessage);
         
         // التمرير لآخر رسالة
         setTimeout(() => {
@@ -1538,6 +1813,28 @@ socket.on('private_message_sent', (data) => {
                 addVoiceMessage(data);
             });
 
+            socket.on('voice_message_error', (data) => {
+                console.error('❌ Voice message rejected:', data);
+                showNotification(data.message || 'Failed to send voice message', 'error');
+            });
+
+            // Message search
+            socket.on('search_results', (data) => {
+                showSearchResults(data);
+            });
+
+            socket.on('room_directory', (data) => {
+                showRoomDirectory(data);
+            });
+
+            socket.on('room_directory_error', (data) => {
+                showNotification(data.message || 'Cannot load rooms', 'error');
+            });
+
+            socket.on('search_error', (data) => {
+                showNotification(data.message || 'Search failed', 'error');
+            });
+
             socket.on('private_voice_message', (data) => {
                 console.log('🎤 Private voice message received:', data);
                 
@@ -1550,8 +1847,12 @@ socket.on('private_message_sent', (data) => {
                         id: data.id || Date.now().toString(),
                         username: data.from,
                         displayName: data.displayName || data.from,
+                        audioBlob: data.audioBlob,
+                        audio: data.audio,
                         audioData: data.audioData,
+                        mimeType: data.mimeType,
                         duration: data.duration,
+                        waveform: data.waveform,
                         timestamp: data.timestamp || new Date().toISOString(),
                         type: 'voice'
                     });
@@ -1615,7 +1916,7 @@ function addMessage(data) {
     
     // التمرير لآخر رسالة
     setTimeout(() => {
-        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+        scrollChatToBottom(messagesDiv);
     }, 50);
     
     console.log('✅ Message added successfully');
@@ -1675,19 +1976,26 @@ function joinPrivateChat(friend, roomId) {
             });
 
             socket.on('user_settings_updated', (data) => {
+                if (data.success === false) {
+                    showNotification(data.message || 'Settings not saved', 'error');
+                    return;
+                }
                 console.log('✅ Settings updated');
                 showNotification('Settings saved!', 'success');
             });
 
             // Rooms
-            socket.on('room_list', (rooms) => {
-                console.log('🏠 Rooms loaded:', rooms);
-                updateRoomList(rooms);
+            socket.on('room_list', (data) => {
+                console.log('🏠 Rooms loaded:', data.rooms);
+                setRoomDirectory(data.version, data.rooms);
             });
 
+            socket.on('room_added', (data) => applyRoomDelta('added', data));
+            socket.on('room_updated', (data) => applyRoomDelta('updated', data));
+            socket.on('room_removed', (data) => applyRoomDelta('removed', data));
+
             socket.on('room_created', (data) => {
                 console.log('✅ Room created:', data.room);
-                addRoomToList(data.room);
                 showNotification(`Room "${data.room.name}" created!`, 'success');
                 hideCreateRoomModal();
             });
@@ -1699,7 +2007,7 @@ function joinPrivateChat(friend, roomId) {
                     currentRoomType = data.room.type;
                 }
                 updateRoomHeader();
-                updateRoomMembers(data.members || []);
+                setRoomMembers(data.room && data.room.id, data.members_version || 0, data.members || []);
             });
 
             socket.on('room_left', (data) => {
@@ -1735,9 +2043,15 @@ function joinPrivateChat(friend, roomId) {
                 showNotification(data.message || 'Cannot generate invite', 'error');
             });
 
-            socket.on('room_members_updated', (members) => {
-                console.log('👥 Room members updated:', members);
-                updateRoomMembers(members);
+            socket.on('room_members', (data) => {
+                console.log('👥 Room members snapshot:', data);
+                if (data.room === currentRoom) {
+                    setRoomMembers(data.room, data.version, data.members);
+                }
+            });
+
+            socket.on('room_members_delta', (data) => {
+                applyRoomMembersDelta(data);
             });
 
             // Friends
@@ -2217,7 +2531,10 @@ function joinPrivateChat(friend, roomId) {
             const avatarPreview = document.getElementById('settings-avatar-preview');
             const userAvatarPreview = document.getElementById('user-avatar-preview');
             
-            if (userSettings.avatar) {
+            if (userSettings.avatarBlob) {
+                avatarPreview.innerHTML = `<img src="/blobs/${userSettings.avatarBlob}" alt="Avatar">`;
+                userAvatarPreview.innerHTML = `<img src="/blobs/${userSettings.avatarBlob}" alt="Avatar">`;
+            } else if (userSettings.avatar) {
                 if (userSettings.avatar.startsWith('data:image')) {
                     avatarPreview.innerHTML = `<img src="${userSettings.avatar}" alt="Avatar">`;
                     userAvatarPreview.innerHTML = `<img src="${userSettings.avatar}" alt="Avatar">`;
@@ -2232,8 +2549,9 @@ function joinPrivateChat(friend, roomId) {
             const bannerLabel = document.getElementById('banner-upload-label');
             const bannerInput = document.getElementById('banner-upload');
             
-            if (userSettings.banner && isPremium) {
-                bannerPreview.innerHTML = `<img src="${userSettings.banner}" alt="Banner">`;
+            if ((userSettings.bannerBlob || userSettings.banner) && isPremium) {
+                const bannerSrc = userSettings.bannerBlob ? `/blobs/${userSettings.bannerBlob}` : userSettings.banner;
+                bannerPreview.innerHTML = `<img src="${bannerSrc}" alt="Banner">`;
             }
             
             if (!isPremium) {
@@ -2288,6 +2606,7 @@ function joinPrivateChat(friend, roomId) {
                 
                 // Save to user settings
                 userSettings.avatar = avatarData;
+                userSettings.avatarBlob = null;
                 
                 showNotification('Avatar updated! Click Save to keep changes.', 'success');
             };
@@ -2313,6 +2632,7 @@ function joinPrivateChat(friend, roomId) {
                 
                 // Save to user settings
                 userSettings.banner = bannerData;
+                userSettings.bannerBlob = null;
                 
                 showNotification('Banner updated! Click Save to keep changes.', 'success');
             };
@@ -2460,7 +2780,7 @@ function addMessage(data) {
     messagesDiv.appendChild(messageDiv);
     
     setTimeout(() => {
-        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+        scrollChatToBottom(messagesDiv);
     }, 50);
     
     console.log('✅ Message added successfully');
@@ -2608,44 +2928,42 @@ function escapeHtml(text) {
                 const audioBlob = new Blob(audioChunks, { type: 'audio/webm;codecs=opus' });
                 const duration = Math.floor((Date.now() - recordingStartTime) / 1000);
                 
-                const reader = new FileReader();
-                reader.onloadend = () => {
-                    const base64Audio = reader.result;
-                    
-                    console.log('📤 Sending voice message:', {
-                        size: audioBlob.size,
-                        duration: duration,
-                        room: currentRoom
-                    });
-                    
-                    if (currentRoom.startsWith('dm_')) {
-                        const parts = currentRoom.split('_');
-                        if (parts.length === 3) {
-                            const [_, user1, user2] = parts;
-                            const friendUsername = user1 === currentUser ? user2 : user1;
-                            
-                            socket.emit('private_voice_message', {
-                                from: currentUser,
-                                to: friendUsername,
-                                audioData: base64Audio,
-                                duration: duration,
-                                timestamp: new Date().toISOString()
-                            });
-                        }
-                    } else {
-                        socket.emit('voice_message', {
-                            username: currentUser,
-                            server: currentRoom,
-                            audioData: base64Audio,
+                // Raw bytes go out as a Socket.IO binary attachment (no base64)
+                const audio = await audioBlob.arrayBuffer();
+                
+                console.log('📤 Sending voice message:', {
+                    size: audioBlob.size,
+                    duration: duration,
+                    room: currentRoom
+                });
+                
+                if (currentRoom.startsWith('dm_')) {
+                    const parts = currentRoom.split('_');
+                    if (parts.length === 3) {
+                        const [_, user1, user2] = parts;
+                        const friendUsername = user1 === currentUser ? user2 : user1;
+                        
+                        socket.emit('private_voice_message', {
+                            from: currentUser,
+                            to: friendUsername,
+                            audio: audio,
+                            mimeType: audioBlob.type,
                             duration: duration,
                             timestamp: new Date().toISOString()
                         });
                     }
-                    
-                    showNotification('Voice message sent!', 'success');
-                };
+                } else {
+                    socket.emit('voice_message', {
+                        username: currentUser,
+                        server: currentRoom,
+                        audio: audio,
+                        mimeType: audioBlob.type,
+                        duration: duration,
+                        timestamp: new Date().toISOString()
+                    });
+                }
                 
-                reader.readAsDataURL(audioBlob);
+                showNotification('Voice message sent!', 'success');
                 
             } catch (error) {
                 console.error('❌ Error sending voice message:', error);
@@ -2653,6 +2971,137 @@ function escapeHtml(text) {
             }
         }
 
+        function scrollChatToBottom(messagesDiv) {
+            // Not while an older page is being inserted above the visible messages
+            if (!olderHistoryAnchor) {
+                messagesDiv.scrollTop = messagesDiv.scrollHeight;
+            }
+        }
+
+        function prependOlderMessages(render) {
+            // render() appends with addMessage/addVoiceMessage; the new nodes are
+            // then moved above the existing ones, keeping the scroll position
+            const messagesDiv = document.getElementById('chat-messages');
+            if (!messagesDiv) return;
+            
+            const firstExisting = messagesDiv.firstChild;
+            const shownBefore = messagesDiv.children.length;
+            olderHistoryAnchor = {
+                height: messagesDiv.scrollHeight,
+                top: messagesDiv.scrollTop
+            };
+            
+            render();
+            
+            Array.from(messagesDiv.children).slice(shownBefore)
+                .forEach(node => messagesDiv.insertBefore(node, firstExisting));
+            const anchor = olderHistoryAnchor;
+            messagesDiv.scrollTop = messagesDiv.scrollHeight - anchor.height + anchor.top;
+            
+            // addMessage scrolls to the bottom after 50ms; release the anchor after that
+            setTimeout(() => {
+                if (olderHistoryAnchor === anchor) olderHistoryAnchor = null;
+            }, 100);
+        }
+
+        function loadOlderMessages() {
+            const messagesDiv = document.getElementById('chat-messages');
+            const oldest = messagesDiv && messagesDiv.querySelector('[data-message-id]');
+            if (!oldest || !historyHasMore || historyLoading) return;
+            
+            const before = oldest.getAttribute('data-message-id');
+            
+            if (currentRoom.startsWith('dm_')) {
+                const parts = currentRoom.split('_');
+                if (parts.length !== 3) return;
+                historyLoading = true;
+                const friend = parts[1] === currentUser ? parts[2] : parts[1];
+                socket.emit('get_private_messages', { friend: friend, before: before });
+            } else {
+                historyLoading = true;
+                socket.emit('get_room_messages', { room: currentRoom, before: before });
+            }
+        }
+
+        // ========== MESSAGE SEARCH ==========
+        let searchTimer = null;
+
+        function scheduleMessageSearch() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => searchMessages(0), 250);
+        }
+
+        function searchMessages(offset) {
+            const query = document.getElementById('message-search-input').value;
+            if (!query.trim()) {
+                document.getElementById('search-results').style.display = 'none';
+                return;
+            }
+            socket.emit('search_messages', { query: query, offset: offset });
+        }
+
+        function showSearchResults(data) {
+            const input = document.getElementById('message-search-input');
+            const panel = document.getElementById('search-results');
+            // Drop answers to queries the user has typed past
+            if (data.query !== input.value) return;
+            
+            if (data.offset === 0) panel.innerHTML = '';
+            panel.querySelector('.search-more')?.remove();
+            
+            if (data.offset === 0 && data.results.length === 0) {
+                panel.innerHTML = '<div class="search-result"><div class="search-result-text">No messages found</div></div>';
+            }
+            
+            data.results.forEach(hit => {
+                const item = document.createElement('div');
+                item.className = 'search-result';
+                const where = hit.type === 'private' ? `@${hit.friend}` : `#${hit.roomName}`;
+                const when = hit.timestamp ? new Date(hit.timestamp).toLocaleString() : '';
+                item.innerHTML = `
+                    <div class="search-result-meta">${escapeHtml(where)} · ${escapeHtml(hit.sender || '')} · ${when}</div>
+                    <div class="search-result-text">${escapeHtml(hit.message)}</div>
+                `;
+                item.onclick = () => {
+                    panel.style.display = 'none';
+                    if (hit.type === 'private') {
+                        startPrivateChat(hit.friend);
+                    } else {
+                        joinRoom(hit.room, hit.roomName);
+                    }
+                };
+                panel.appendChild(item);
+            });
+            
+            if (data.has_more) {
+                const more = document.createElement('div');
+                more.className = 'search-result search-more';
+                more.innerHTML = '<div class="search-result-meta">Show more results</div>';
+                more.onclick = () => searchMessages(data.next_offset);
+                panel.appendChild(more);
+            }
+            panel.style.display = 'block';
+        }
+
+        function voiceAudioUrl(data) {
+            // Blob store id, binary attachment (ArrayBuffer) or a legacy data URL
+            if (data.audioBlob) {
+                return `/blobs/${data.audioBlob}`;
+            }
+            if (data.audio) {
+                return URL.createObjectURL(new Blob([data.audio], { type: data.mimeType || 'audio/webm' }));
+            }
+            return data.audioData || '';
+        }
+
+        function voiceWaveformBars(waveform) {
+            // Server-computed peak levels (0-100), one bar per bucket
+            if (!Array.isArray(waveform) || waveform.length === 0) return '';
+            const bars = waveform.map(level =>
+                `<span style="height: ${Math.max(8, Number(level) || 0)}%"></span>`).join('');
+            return `<div class="voice-bars">${bars}</div>`;
+        }
+
         function addVoiceMessage(data) {
             console.log('🎤 Adding voice message to chat');
             
@@ -2693,10 +3142,11 @@ function escapeHtml(text) {
                                 <i class="fas fa-play"></i>
                             </button>
                             <div class="voice-waveform">
+                                ${voiceWaveformBars(data.waveform)}
                                 <div class="voice-progress" id="progress-${audioId}" style="width: 0%"></div>
                             </div>
                             <span class="voice-duration">${formatDuration(data.duration || 0)}</span>
-                            <audio id="${audioId}" src="${data.audioData}" preload="metadata" style="display: none;"></audio>
+                            <audio id="${audioId}" src="${voiceAudioUrl(data)}" preload="metadata" style="display: none;"></audio>
                         </div>
                     </div>
                     ${canDelete ? `
@@ -2735,7 +3185,7 @@ function escapeHtml(text) {
             }
             
             setTimeout(() => {
-                messagesDiv.scrollTop = messagesDiv.scrollHeight;
+                scrollChatToBottom(messagesDiv);
             }, 50);
             
             console.log('✅ Voice message added successfully');
@@ -3033,6 +3483,72 @@ function joinPrivateChat(friend, roomId) {
             }
         }
 
+        // Member list of the open room: a snapshot, then versioned deltas
+        let roomMembers = new Map();
+        let roomMembersRoom = null;
+        let roomMembersVersion = 0;
+        let roomMembersResync = false;
+
+        function setRoomMembers(room, version, members) {
+            roomMembersRoom = room;
+            roomMembersVersion = version;
+            roomMembersResync = false;
+            roomMembers = new Map(members.map(member => [member.username, member]));
+            updateRoomMembers(Array.from(roomMembers.values()));
+        }
+
+        function applyRoomMembersDelta(data) {
+            if (data.room !== roomMembersRoom || data.version <= roomMembersVersion) return;
+            if (data.version !== roomMembersVersion + 1) {
+                // Missed an update: start over from a fresh snapshot
+                if (!roomMembersResync) {
+                    roomMembersResync = true;
+                    socket.emit('get_room_members', { room: data.room });
+                }
+                return;
+            }
+            
+            data.changes.forEach(change => {
+                const member = roomMembers.get(change.username);
+                if (change.op === 'joined') {
+                    roomMembers.set(change.username, { username: change.username, connected: !!change.connected });
+                } else if (change.op === 'left') {
+                    roomMembers.delete(change.username);
+                } else if (member) {
+                    member.connected = change.op === 'online';
+                }
+            });
+            roomMembersVersion = data.version;
+            updateRoomMembers(Array.from(roomMembers.values()));
+        }
+
+        // Room list: one snapshot, then deltas. Every room's deltas share
+        // one counter and can arrive out of order across rooms, so each
+        // room keeps the version it was last changed at (removed rooms
+        // too); the snapshot's version covers every room it listed.
+        let roomDirectory = new Map();
+        let roomDirectoryVersion = 0;
+        let roomVersions = new Map();
+
+        function setRoomDirectory(version, rooms) {
+            roomDirectoryVersion = version;
+            roomVersions = new Map();
+            roomDirectory = new Map(rooms.map(room => [room.id, room]));
+            updateRoomList(Array.from(roomDirectory.values()));
+        }
+
+        function applyRoomDelta(op, data) {
+            const seen = roomVersions.get(data.room.id) || roomDirectoryVersion;
+            if (data.version <= seen) return;
+            roomVersions.set(data.room.id, data.version);
+            if (op === 'removed') {
+                roomDirectory.delete(data.room.id);
+            } else {
+                roomDirectory.set(data.room.id, data.room);
+            }
+            updateRoomList(Array.from(roomDirectory.values()));
+        }
+
         function updateRoomMembers(members) {
             const membersDiv = document.getElementById('room-members');
             membersDiv.innerHTML = '';
@@ -3054,6 +3570,69 @@ function joinPrivateChat(friend, roomId) {
             });
         }
 
+        // ========== ROOM DIRECTORY ==========
+        let roomBrowseTimer = null;
+
+        function showBrowseRoomsModal() {
+            document.getElementById('browse-rooms-modal').style.display = 'flex';
+            document.getElementById('room-browse-input').focus();
+            browseRooms(null);
+        }
+
+        function hideBrowseRoomsModal() {
+            document.getElementById('browse-rooms-modal').style.display = 'none';
+            document.getElementById('room-browse-input').value = '';
+        }
+
+        function scheduleRoomBrowse() {
+            clearTimeout(roomBrowseTimer);
+            roomBrowseTimer = setTimeout(() => browseRooms(null), 250);
+        }
+
+        function browseRooms(cursor) {
+            socket.emit('browse_rooms', {
+                query: document.getElementById('room-browse-input').value,
+                sort: document.getElementById('room-browse-sort').value,
+                cursor: cursor
+            });
+        }
+
+        function showRoomDirectory(data) {
+            // Drop answers to queries or orders the user has moved past
+            if (data.query !== document.getElementById('room-browse-input').value.slice(0, 100) ||
+                data.sort !== document.getElementById('room-browse-sort').value) return;
+            const panel = document.getElementById('room-browse-results');
+            panel.querySelector('.search-more')?.remove();
+            if (!data.cursor) panel.innerHTML = '';
+            
+            if (!data.cursor && data.rooms.length === 0) {
+                panel.innerHTML = '<div class="search-result"><div class="search-result-text">No rooms found</div></div>';
+            }
+            
+            data.rooms.forEach(room => {
+                const item = document.createElement('div');
+                item.className = 'search-result';
+                const active = room.last_activity ? new Date(room.last_activity * 1000).toLocaleString() : '';
+                item.innerHTML = `
+                    <div class="search-result-meta">#${escapeHtml(room.name || '')} · ${room.member_count} members${active ? ' · ' + active : ''}</div>
+                    <div class="search-result-text">${escapeHtml(room.description || '')}</div>
+                `;
+                item.onclick = () => {
+                    hideBrowseRoomsModal();
+                    joinRoom(room.id, room.name);
+                };
+                panel.appendChild(item);
+            });
+            
+            if (data.has_more) {
+                const more = document.createElement('div');
+                more.className = 'search-result search-more';
+                more.innerHTML = '<div class="search-result-meta">Show more rooms</div>';
+                more.onclick = () => browseRooms(data.next_cursor);
+                panel.appendChild(more);
+            }
+        }
+
         // ========== CREATE ROOM FUNCTIONS ==========
         function showCreateRoomModal() {
             document.getElementById('create-room-modal').style.display = 'flex';
@@ -3432,6 +4011,10 @@ function joinPrivateChat(friend, roomId) {
                 if (e.key === 'Enter') sendMessage();
             };
             
+            document.getElementById('chat-messages').addEventListener('scroll', function() {
+                if (this.scrollTop < 50) loadOlderMessages();
+            });
+            
             document.getElementById('room-name').onkeypress = function(e) {
                 if (e.key === 'Enter') createRoom();
             };
@@ -3449,66 +4032,210 @@ function joinPrivateChat(friend, roomId) {
 </html>
 '''
 
-# Data file and functions
+# ==================== STORAGE ====================
+# Backend: 'json' (echoroom_data.json + journal, everything in memory),
+# 'sqlite' (ECHOROOM_SQLITE_FILE) or 'postgres' (DATABASE_URL).
+# Import existing JSON data with: python migrate.py --sqlite echoroom.db
+STORAGE_BACKEND = os.environ.get('ECHOROOM_STORAGE', 'json')
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+DB_POOL_MIN = int(os.environ.get('ECHOROOM_DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('ECHOROOM_DB_POOL_MAX', 10))
+SQLITE_FILE = os.environ.get('ECHOROOM_SQLITE_FILE', 'echoroom.db')
+SQLITE_COMMIT_INTERVAL = float(os.environ.get('ECHOROOM_SQLITE_COMMIT_INTERVAL', 0.05))
+
+# Data file
 DATA_FILE = 'echoroom_data.json'
 
-def load_data():
+# Journal compaction: fold the WAL into a new snapshot every N seconds,
+# or sooner once this many records have been appended
+JOURNAL_COMPACT_INTERVAL = int(os.environ.get('ECHOROOM_COMPACT_INTERVAL', 300))
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get('ECHOROOM_COMPACT_THRESHOLD', 5000))
+
+# Durability: 'sync' (fsync in the handler), 'batched' (group commit with fsync
+# at most every ECHOROOM_FLUSH_INTERVAL seconds) or 'async' (no fsync)
+JOURNAL_DURABILITY = os.environ.get('ECHOROOM_DURABILITY', 'batched')
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get('ECHOROOM_FLUSH_INTERVAL', 0.05))
+
+# History kept per conversation by the in-memory backend; rooms can get a
+# per-type capacity, e.g. ECHOROOM_ROOM_HISTORY_LIMITS="voice=200,private=1000"
+ROOM_HISTORY_LIMIT = int(os.environ.get('ECHOROOM_ROOM_HISTORY_LIMIT', 500))
+PRIVATE_HISTORY_LIMIT = int(os.environ.get('ECHOROOM_PRIVATE_HISTORY_LIMIT', 1000))
+ROOM_TYPE_HISTORY_LIMITS = {
+    room_type.strip(): int(limit)
+    for room_type, _, limit in (item.partition('=') for item in
+                                os.environ.get('ECHOROOM_ROOM_HISTORY_LIMITS', '').split(','))
+    if room_type.strip() and limit
+}
+
+# History beyond those limits moves to compressed segment files under
+# ECHOROOM_ARCHIVE_DIR instead of being dropped ('' = drop it as before)
+ARCHIVE_DIR = os.environ.get('ECHOROOM_ARCHIVE_DIR', 'echoroom_archive')
+ARCHIVE_BLOCK_SIZE = int(os.environ.get('ECHOROOM_ARCHIVE_BLOCK_SIZE', 64))
+
+# History is sent a page at a time; older pages are fetched with a cursor
+HISTORY_PAGE_SIZE = int(os.environ.get('ECHOROOM_HISTORY_PAGE_SIZE', 50))
+HISTORY_PAGE_MAX = 200
+
+def history_page_args(data):
+    """(limit, before, after) of a history request; limit is clamped"""
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r') as f:
-                return json.load(f)
-        else:
-            print(f"📁 Creating new data file: {DATA_FILE}")
-    except Exception as e:
-        print(f"❌ Error loading data: {e}")
+        limit = int(data.get('limit') or HISTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    return limit, data.get('before') or None, data.get('after') or None
+
+def open_storage():
+    """Create the storage backend selected by ECHOROOM_STORAGE"""
+    if STORAGE_BACKEND == 'postgres':
+        from storage_postgres import PostgresStorage
+        return PostgresStorage(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX)
+    if STORAGE_BACKEND == 'sqlite':
+        from storage_sqlite import SqliteStorage
+        return SqliteStorage(SQLITE_FILE, commit_interval=SQLITE_COMMIT_INTERVAL)
+    
+    journal = Journal(DATA_FILE,
+                      compact_interval=JOURNAL_COMPACT_INTERVAL,
+                      compact_threshold=JOURNAL_COMPACT_THRESHOLD,
+                      encoder=DateTimeEncoder,
+                      object_hook=decode_bytes,
+                      durability=JOURNAL_DURABILITY,
+                      flush_interval=JOURNAL_FLUSH_INTERVAL)
+    archive = None
+    if ARCHIVE_DIR:
+        archive = MessageArchive(ARCHIVE_DIR,
+                                 block_size=ARCHIVE_BLOCK_SIZE,
+                                 encoder=DateTimeEncoder,
+                                 object_hook=decode_bytes)
+    return JsonStorage(journal,
+                       room_history_limit=ROOM_HISTORY_LIMIT,
+                       private_history_limit=PRIVATE_HISTORY_LIMIT,
+                       room_type_history_limits=ROOM_TYPE_HISTORY_LIMITS,
+                       archive=archive)
+
+store = open_storage()
+atexit.register(store.close)
+
+# Voice clips, avatars and banners live in the blob store; records keep the id
+BLOB_DIR = os.environ.get('ECHOROOM_BLOB_DIR', 'echoroom_blobs')
+blob_store = BlobStore(BLOB_DIR, Journal(os.path.join(BLOB_DIR, 'index.json'),
+                                         compact_interval=JOURNAL_COMPACT_INTERVAL,
+                                         compact_threshold=JOURNAL_COMPACT_THRESHOLD,
+                                         durability=JOURNAL_DURABILITY,
+                                         flush_interval=JOURNAL_FLUSH_INTERVAL))
+atexit.register(blob_store.close)
+
+def release_message_blobs(messages):
+    """Drop the blob references of deleted or evicted messages"""
+    for msg in messages or ():
+        if msg.get('audioBlob'):
+            blob_store.release(msg['audioBlob'])
+
+def forget_evicted(kind, key, messages):
+    """Messages a bounded history dropped (no archive): release their blobs
+    and take them out of the search index"""
+    release_message_blobs(messages)
+    if search_index is not None:
+        for msg in messages or ():
+            search_index.remove(kind, key, msg.get('id'))
+
+def room_blob_ids(room_id):
+    """Blob ids a room's messages hold, newest first. The history is read
+    a page at a time, so a long (archived) history is never all in memory."""
+    before, cursors = None, set()
+    while True:
+        messages, has_more = store.get_room_history(room_id, HISTORY_PAGE_MAX, before)
+        for msg in reversed(messages):
+            if msg.get('audioBlob'):
+                yield msg['audioBlob']
+        # (a repeated cursor means duplicate ids in a damaged history)
+        if not has_more or not messages or messages[0]['id'] in cursors:
+            return
+        before = messages[0]['id']
+        cursors.add(before)
+
+# Token -> session index in front of the stored session lists
+SESSION_SWEEP_INTERVAL = int(os.environ.get('ECHOROOM_SESSION_SWEEP_INTERVAL', 60))
+session_index = SessionIndex(store.get_sessions, sweep_interval=SESSION_SWEEP_INTERVAL)
+session_index.start()
+atexit.register(session_index.close)
+
+# Full-text message search in its own SQLite file ('' turns search off)
+SEARCH_DB = os.environ.get('ECHOROOM_SEARCH_DB', 'echoroom_search.db')
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
+search_index = MessageSearch(SEARCH_DB) if SEARCH_DB else None
+
+def build_search_index():
+    """First start with search: index the history that is already stored"""
+    count = search_index.build(store.iter_messages())
+    print(f"🔎 Indexed {count} messages for search")
+
+if search_index is not None:
+    atexit.register(search_index.close)
+    if not search_index.is_built():
+        threading.Thread(target=build_search_index, name='search-build', daemon=True).start()
+
+def handle_shutdown_signal(signum, frame):
+    """Turn SIGTERM into a normal exit so atexit flushes pending writes"""
+    # A repeated signal must not interrupt the flush in the atexit handlers
+    signal.signal(signum, signal.SIG_IGN)
+    print("🛑 Shutting down, flushing data...")
+    sys.exit(0)
+
+def install_shutdown_handler():
+    """Flush on SIGTERM however the app is started (app.py, wsgi.py, gunicorn).
+
+    A handler the server installed before us (gunicorn's worker) still runs
+    first. Only the main thread may set signal handlers; elsewhere this is
+    a no-op.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+    
+    def handler(signum, frame):
+        if callable(previous):
+            previous(signum, frame)
+        handle_shutdown_signal(signum, frame)
     
-    # Initialize with empty data structure
-    return {
-        'users_db': {},
-        'rooms_db': {},
-        'messages_db': {},
-        'user_settings': {},
-        'friends_db': {},
-        'friend_requests_db': {},
-        'sessions_db': {},
-        'private_messages_db': {}
-    }
-
-def save_data():
     try:
-        with open(DATA_FILE, 'w') as f:
-            json.dump({
-                'users_db': users_db,
-                'rooms_db': rooms_db,
-                'messages_db': messages_db,
-                'user_settings': user_settings_db,
-                'friends_db': friends_db,
-                'friend_requests_db': friend_requests_db,
-                'sessions_db': sessions_db,
-                'private_messages_db': private_messages_db
-            }, f, indent=2, cls=DateTimeEncoder)  # استخدام الـ encoder المخصص
-        print(f"💾 Data saved to {DATA_FILE}")
-    except Exception as e:
-        print(f"❌ Error saving data: {e}")
-
-# Load data
-data = load_data()
-users_db = data.get('users_db', {})
-rooms_db = data.get('rooms_db', {})
-messages_db = data.get('messages_db', {})
-user_settings_db = data.get('user_settings', {})
-friends_db = data.get('friends_db', {})
-friend_requests_db = data.get('friend_requests_db', {})
-sessions_db = data.get('sessions_db', {})
-private_messages_db = data.get('private_messages_db', {})
-
-active_users = {}
+        signal.signal(signal.SIGTERM, handler)
+    except ValueError:
+        pass
+
+def run_server(host='0.0.0.0', port=5000):
+    """Serve with the server that matches runtime.ASYNC_MODE"""
+    print(f"⚙️ Async mode: {runtime.ASYNC_MODE}")
+    if runtime.ASYNC_MODE == 'threading':
+        # Werkzeug development server, one OS thread per connection
+        socketio.run(app, host=host, port=port, debug=False,
+                     allow_unsafe_werkzeug=True)
+    else:
+        # eventlet.wsgi / gevent pywsgi: green thread per connection
+        socketio.run(app, host=host, port=port, debug=False)
+
+def open_presence():
+    """username -> sid map, shared between workers when PRESENCE_URL is set"""
+    if PRESENCE_URL:
+        presence = RedisPresence(PRESENCE_URL)
+        print(f"🌐 Shared presence: {PRESENCE_URL}")
+    else:
+        presence = LocalPresence()
+    if MESSAGE_QUEUE and MESSAGE_QUEUE != 'local' and STORAGE_BACKEND == 'json':
+        print("⚠️ The JSON storage backend is per-process; use sqlite or postgres "
+              "when running several workers")
+    presence.start()
+    return presence
+
+# active_users may span workers; user_rooms and socket_sessions only hold
+# this worker's sockets (clients stick to one worker for their connection)
+active_users = open_presence()
+atexit.register(active_users.close)
 user_rooms = {}
 socket_sessions = {}
 
 # Create default room if not exists
-if "general" not in rooms_db:
-    rooms_db["general"] = {
+if not store.get_room('general'):
+    store.create_room({
         'id': 'general',
         'name': 'General',
         'description': 'Welcome to EchoRoom!',
@@ -3516,25 +4243,22 @@ if "general" not in rooms_db:
         'creator': 'system',
         'created_at': datetime.now().isoformat(),
         'members': []
-    }
-    save_data()
+    })
 
 # ==================== HELPER FUNCTIONS ====================
 
 def find_user_email(username):
-    for email, user_data in users_db.items():
-        if user_data.get('username') == username:
-            return email
-    return None
+    return store.find_user_email(username)
 
 def get_room_members(room_id):
-    room = rooms_db.get(room_id)
+    room = store.get_room(room_id)
     if not room:
         return []
     
     members = []
+    online = active_users.online(room.get('members', []))
     for username in room.get('members', []):
-        is_connected = username in active_users
+        is_connected = username in online
         members.append({
             'username': username,
             'connected': is_connected
@@ -3542,59 +4266,254 @@ def get_room_members(room_id):
     
     return members
 
+# Member lists reach clients as one snapshot (room_joined / room_members)
+# followed by versioned deltas; a client that sees a version gap asks for a
+# new snapshot. Versions are cluster-wide counters in the presence store.
+
+def members_version_key(room_id):
+    return f"members:{room_id}"
+
+def room_members_snapshot(room_id):
+    """Full member list plus the version the next delta builds on"""
+    # Version first: a change racing with the read is then re-sent as a
+    # delta, and applying a delta twice is harmless
+    version = active_users.version(members_version_key(room_id))
+    return {'room': room_id, 'version': version, 'members': get_room_members(room_id)}
+
+def emit_members_delta(room_id, changes):
+    """Send a room's sockets the changes to its member list.
+
+    Each change is {'op': 'joined' | 'left' | 'online' | 'offline',
+    'username': ...}; 'joined' also carries 'connected'.
+    """
+    version = active_users.next_version(members_version_key(room_id))
+    socketio.emit('room_members_delta', {
+        'room': room_id,
+        'version': version,
+        'changes': changes
+    }, room=room_id)
+
+# Online/offline changes are collected for ECHOROOM_PRESENCE_WINDOW seconds;
+# flaps inside the window are dropped, the rest goes out as one delta per room
+PRESENCE_WINDOW = float(os.environ.get('ECHOROOM_PRESENCE_WINDOW', 1.0))
+# Both aggregators log their counters every ECHOROOM_STATS_LOG_INTERVAL
+# seconds while they move (0 logs them only at shutdown)
+STATS_LOG_INTERVAL = float(os.environ.get('ECHOROOM_STATS_LOG_INTERVAL', 600))
+presence_updates = PresenceAggregator(store.get_user_rooms, emit_members_delta,
+                                      window=PRESENCE_WINDOW,
+                                      log_interval=STATS_LOG_INTERVAL)
+presence_updates.start()
+atexit.register(presence_updates.close)
+
+# ==================== ROOM DIRECTORY ====================
+# Clients build their room list from one get_rooms snapshot and keep it
+# current from room_added / room_removed / room_updated deltas. Entries are
+# summaries without member arrays, and a private room only ever reaches the
+# users who can see it (its creator, members and invitees).
+
+ROOM_DIRECTORY_VERSION = 'rooms:directory'
+
+# Browsing (browse_rooms, /api/rooms) goes through an in-memory index per
+# worker; changes reach every worker as room_directory_changed events
+ROOM_DIRECTORY_PAGE_SIZE = 20
+ROOM_DIRECTORY_PAGE_MAX = 100
+ROOM_DIRECTORY_MAX_AGE = int(os.environ.get('ECHOROOM_DIRECTORY_MAX_AGE', 10))
+
+def last_room_activity(room):
+    """Epoch seconds of a room's newest message, or None"""
+    messages = store.get_room_messages(room['id'], 1)
+    return (timestamp_seconds(messages[-1].get('timestamp')) or None) if messages else None
+
+room_directory = RoomDirectory()
+directory_version = active_users.version(ROOM_DIRECTORY_VERSION)
+print(f"🗂️ Room directory: {room_directory.build(store.list_rooms(), last_room_activity)} rooms")
+room_directory.applied(directory_version)
+
+def handle_room_directory_changed(data):
+    """Cluster event: refresh one room's directory entry"""
+    room_id = data['room_id']
+    if 'activity' in data:
+        room_directory.touch(room_id, data['activity'])
+    else:
+        room = store.get_room(room_id)
+        if room is None:
+            room_directory.remove(room_id)
+        else:
+            room_directory.put(room)
+    room_directory.applied(data['version'])
+
+active_users.subscribe('room_directory_changed', handle_room_directory_changed)
+
+def room_directory_changed(room_id, **change):
+    """Publish a change to a room's directory entry; returns the new
+    ROOM_DIRECTORY_VERSION, which the room-list deltas for it carry"""
+    version = active_users.next_version(ROOM_DIRECTORY_VERSION)
+    active_users.publish('room_directory_changed', dict(change, room_id=room_id, version=version))
+    return version
+
+def note_room_activity(room_id):
+    """Record a message in a room for the 'activity' sort order"""
+    now = time.time()
+    if room_directory.is_stale(room_id, now):
+        room_directory_changed(room_id, activity=now)
+
+def browse_room_directory(username, params):
+    """One directory page for `params` (query, sort, cursor, limit).
+
+    `username` None lists public rooms only. Raises ValueError on bad input.
+    """
+    try:
+        limit = int(params.get('limit') or ROOM_DIRECTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid limit')
+    limit = max(1, min(limit, ROOM_DIRECTORY_PAGE_MAX))
+    query = str(params.get('query') or '')[:100]
+    sort = params.get('sort') or 'members'
+    cursor = params.get('cursor') or None
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError('Invalid cursor')
+    
+    rooms, next_cursor = room_directory.browse(username, query, sort, cursor, limit)
+    return {
+        'query': query,
+        'sort': sort,
+        'cursor': cursor,
+        'rooms': rooms,
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None
+    }
+
+def room_visible_to(room, username):
+    audience = room_audience(room)
+    return audience is None or username in audience
+
+def room_directory_snapshot(username):
+    """Room summaries `username` can see plus the version deltas build on"""
+    # Version first, as in room_members_snapshot: deltas are idempotent
+    version = active_users.version(ROOM_DIRECTORY_VERSION)
+    rooms = [room_summary(room) for room in store.list_rooms() if room_visible_to(room, username)]
+    return {'version': version, 'rooms': rooms}
+
+def emit_room_delta(event, room, audience, version):
+    """Send one room-list delta to `audience` (usernames; None: every socket)"""
+    if audience is not None and not audience:
+        return
+    data = {
+        'version': version,
+        'room': room_summary(room)
+    }
+    if audience is None:
+        socketio.emit(event, data)
+        return
+    for username in audience:
+        sid = active_users.get(username)
+        if sid:
+            socketio.emit(event, data, room=sid)
+
+def emit_room_count_update(room_id):
+    """Send a public room's current summary to every socket"""
+    # Version first: a delta never carries older state than a lower version
+    version = room_directory_changed(room_id)
+    room = store.get_room(room_id)
+    if room is not None and room_audience(room) is None:
+        emit_room_delta('room_updated', room, None, version)
+
+# A public room's member count goes to every socket, so joins and leaves
+# are collected for ECHOROOM_ROOM_UPDATE_WINDOW seconds and each room that
+# changed is announced once
+ROOM_UPDATE_WINDOW = float(os.environ.get('ECHOROOM_ROOM_UPDATE_WINDOW', 1.0))
+room_updates = RoomUpdateAggregator(emit_room_count_update, window=ROOM_UPDATE_WINDOW,
+                                    log_interval=STATS_LOG_INTERVAL)
+room_updates.start()
+atexit.register(room_updates.close)
+
+def emit_room_changed(room, audience_before):
+    """Announce a changed room; users who gained or lost sight of a
+    private room get room_added / room_removed instead of room_updated"""
+    audience = room_audience(room)
+    if audience is None and audience_before is None:
+        room_updates.record(room['id'])
+        return
+    version = room_directory_changed(room['id'])
+    if audience is None or audience_before is None:
+        emit_room_delta('room_updated', room, audience, version)
+        return
+    emit_room_delta('room_added', room, audience - audience_before, version)
+    emit_room_delta('room_removed', room, audience_before - audience, version)
+    emit_room_delta('room_updated', room, audience & audience_before, version)
+
 def are_friends(user1, user2):
-    return (user2 in friends_db.get(user1, [])) and (user1 in friends_db.get(user2, []))
+    return store.are_friends(user1, user2)
+
+def get_display_name(username):
+    settings = store.get_settings(username) or {}
+    return settings.get('displayName', username)
 
 def create_session(email):
     """Create a new session for user"""
     token = generate_session_token()
-    expiry = datetime.now() + timedelta(days=SESSION_EXPIRY_DAYS)
-    
-    if email not in sessions_db:
-        sessions_db[email] = []
+    now = datetime.now()
+    expiry = now + timedelta(days=SESSION_EXPIRY_DAYS)
     
-    sessions_db[email].append({
+    session = {
         'token': token,
-        'created_at': datetime.now().isoformat(),
+        'created_at': now.isoformat(),
         'expires_at': expiry.isoformat(),
         'ip': request.remote_addr if request else 'unknown'
-    })
+    }
+    
+    # Drop expired sessions here, on the write path, so validation never writes
+    stored = store.get_sessions(email)
+    sessions = [s for s in stored
+                if datetime.fromisoformat(s['expires_at']) > now]
+    sessions.append(session)
     
     # Keep only last 5 sessions per user
-    if len(sessions_db[email]) > 5:
-        sessions_db[email] = sessions_db[email][-5:]
+    sessions = sessions[-5:]
+    store.save_sessions(email, sessions)
+    
+    kept = [s['token'] for s in sessions]
+    session_index.add(email, session)
+    session_index.retain(email, kept)
     
-    save_data()
+    # Sockets (on any worker) still logged in with a trimmed session lose it now
+    dropped = [s['token'] for s in stored if s['token'] not in kept]
+    if dropped:
+        active_users.publish('sessions_revoked', {'email': email, 'tokens': dropped})
     return token
 
 def validate_session(email, token):
-    """Validate user session token"""
-    if email not in sessions_db:
-        return False
-    
-    now = datetime.now()
-    valid_sessions = []
-    is_valid = False
-    
-    for session in sessions_db[email]:
-        expiry = datetime.fromisoformat(session['expires_at'])
-        if expiry > now and session['token'] == token:
-            is_valid = True
-            valid_sessions.append(session)
-    
-    # Remove expired sessions
-    sessions_db[email] = valid_sessions
-    save_data()
-    
-    return is_valid
-
-def invalidate_all_sessions(email):
-    """Invalidate all sessions for a user"""
-    if email in sessions_db:
-        sessions_db[email] = []
-        save_data()
-        return True
-    return False
+    """Validate user session token (in-memory lookup, no storage writes)"""
+    return session_index.validate(email, token)
+
+def invalidate_all_sessions(email, keep_token=None):
+    """Invalidate all sessions for a user (except `keep_token`, if given)"""
+    sessions = store.get_sessions(email)
+    kept = [s for s in sessions if keep_token and s['token'] == keep_token]
+    
+    changed = len(kept) != len(sessions)
+    if changed:
+        store.save_sessions(email, kept)
+    
+    # Every worker drops its cached copies
+    active_users.publish('sessions_revoked', {'email': email, 'keep_token': keep_token})
+    return changed
+
+def handle_sessions_revoked(data):
+    """Cluster event: reindex the user's remaining sessions and drop socket auth"""
+    session_index.load(data['email'])
+    revoke_socket_auth(data['email'], data.get('keep_token'), data.get('tokens'))
+
+active_users.subscribe('sessions_revoked', handle_sessions_revoked)
+
+def revoke_socket_auth(email, keep_token=None, tokens=None):
+    """Drop the cached authentication of every socket logged in as `email`
+    (only those on one of `tokens`, if given)"""
+    for session in list(socket_sessions.values()):
+        if session['email'] != email or session['token'] == keep_token:
+            continue
+        if tokens is None or session['token'] in tokens:
+            session.pop('auth_expires', None)
 
 def get_private_chat_key(user1, user2):
     """Get a consistent key for private messages between two users"""
@@ -3602,18 +4521,15 @@ def get_private_chat_key(user1, user2):
     sorted_users = sorted([user1, user2])
     return f"{sorted_users[0]}_{sorted_users[1]}"
 
-def get_private_messages(user1, user2):
-    """Get private messages between two users"""
+def get_private_messages(user1, user2, limit, before=None, after=None):
+    """One page of private messages between two users; returns (messages, has_more)"""
     key = get_private_chat_key(user1, user2)
-    return private_messages_db.get(key, [])
+    return store.get_private_history(key, limit, before, after)
 
 def add_private_message(from_user, to_user, message, timestamp):
     """Add a private message to the database"""
     key = get_private_chat_key(from_user, to_user)
     
-    if key not in private_messages_db:
-        private_messages_db[key] = []
-    
     message_data = {
         'id': str(uuid.uuid4())[:8],
         'from': from_user,
@@ -3624,22 +4540,65 @@ def add_private_message(from_user, to_user, message, timestamp):
         'type': 'private'
     }
     
-    private_messages_db[key].append(message_data)
-    
-    # Keep only last 1000 messages per chat
-    if len(private_messages_db[key]) > 1000:
-        private_messages_db[key] = private_messages_db[key][-1000:]
-    
-    save_data()
+    forget_evicted('private', key, store.add_private_message(key, message_data))
+    if search_index is not None:
+        search_index.add('private', key, message_data)
     
     print(f"📨 Private message saved: {from_user} -> {to_user}: {message[:50]}...")
     return message_data
 
 # ==================== FLASK ROUTES ====================
 
+# The template has no template variables: build the page (and its CSS/JS
+# assets) once instead of rendering it per request
+INDEX_PAGE, PAGE_ASSETS = build_page(HTML_TEMPLATE, os.path.getmtime(__file__))
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return INDEX_PAGE.response(REVALIDATE)
+
+@app.route('/assets/<name>')
+def page_asset(name):
+    asset = PAGE_ASSETS.get(name)
+    if asset is None:
+        return '', 404
+    return asset.response(IMMUTABLE)
+
+@app.route('/blobs/<blob_id>')
+def serve_blob(blob_id):
+    entry = blob_store.get(blob_id)
+    if entry is None:
+        return '', 404
+    # conditional=True answers Range requests (206) and If-None-Match (304)
+    response = send_file(blob_store.path(blob_id), mimetype=served_type(entry['type']),
+                         conditional=True, etag=blob_id, last_modified=None)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/api/rooms')
+def api_rooms():
+    # Public rooms only, the same answer for everyone, so shared caches may
+    # keep it for a few seconds and then revalidate against the ETag. The
+    # tag is the cluster-wide directory version, so every worker gives the
+    # same one; a worker still applying the newest change answers untagged.
+    version = active_users.version(ROOM_DIRECTORY_VERSION)
+    current = room_directory.version >= version
+    etag = hashlib.sha1(f"{version}?".encode() + request.query_string).hexdigest()[:32]
+    if current and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        try:
+            page = browse_room_directory(None, request.args)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        response = app.response_class(json.dumps(page), mimetype='application/json')
+    if not current:
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={ROOM_DIRECTORY_MAX_AGE}'
+    return response
 
 @app.route('/favicon.ico')
 def favicon():
@@ -3653,25 +4612,22 @@ def handle_connect():
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    # Remove from active users
-    for username, sid in list(active_users.items()):
-        if sid == request.sid:
-            del active_users[username]
-            if username in user_rooms:
-                del user_rooms[username]
-            print(f"❌ User disconnected: {username}")
-            
-            # Notify rooms user was in
-            for room_id, room in rooms_db.items():
-                if username in room.get('members', []):
-                    socketio.emit('room_members_updated', 
-                                get_room_members(room_id),
-                                room=room_id)
-            break
-    
-    # Remove socket session
-    if request.sid in socket_sessions:
-        del socket_sessions[request.sid]
+    # socket_sessions is the sid -> user map; anonymous sockets are not in it
+    session = socket_sessions.pop(request.sid, None)
+    if not session:
+        return
+    username = session['username']
+    
+    # Unless the user is already online again on another socket
+    if active_users.get(username) != request.sid:
+        return
+    del active_users[username]
+    if username in user_rooms:
+        del user_rooms[username]
+    print(f"❌ User disconnected: {username}")
+    
+    # The rooms the user is a member of hear about it with the next batch
+    presence_updates.record(username, False)
 
 @socketio.on('auto_login')
 def handle_auto_login(data):
@@ -3686,11 +4642,11 @@ def handle_auto_login(data):
         emit('auto_login_error', {'message': 'Session expired'})
         return
     
-    if email not in users_db:
+    user_data = store.get_user(email)
+    if not user_data:
         emit('auto_login_error', {'message': 'User not found'})
         return
     
-    user_data = users_db[email]
     username = user_data.get('username')
     
     if not username:
@@ -3704,7 +4660,10 @@ def handle_auto_login(data):
         'username': username
     }
     
+    was_online = username in active_users
     active_users[username] = request.sid
+    if not was_online:
+        presence_updates.record(username, True)
     
     emit('auto_login_success', {
         'username': username,
@@ -3730,47 +4689,42 @@ def handle_signup(data):
         return
     
     # Check if email already exists
-    if email in users_db:
+    if store.get_user(email):
         emit('signup_error', {'message': 'Email already registered'})
         return
     
     # Check if username already exists
-    for user_data in users_db.values():
-        if user_data.get('username') == username:
-            emit('signup_error', {'message': 'Username already taken'})
-            return
+    if store.find_user_email(username):
+        emit('signup_error', {'message': 'Username already taken'})
+        return
     
     # Hash password
     hashed_password, salt = hash_password(password)
     
     # Create user
-    users_db[email] = {
+    store.create_user(email, {
         'username': username,
         'password_hash': hashed_password,
         'salt': salt,
         'premium': False,
         'created_at': datetime.now().isoformat(),
         'verified': False
-    }
+    })
     
     # Initialize user data structures
-    friends_db[username] = []
-    friend_requests_db[username] = []
-    user_settings_db[username] = {
+    store.save_settings(username, {
         'displayName': username,
         'avatar': None,
         'banner': None,
         'bio': '',
         'theme': 'dark'
-    }
+    })
     
     # Create session if remember me is enabled
     session_token = None
     if remember_me:
         session_token = create_session(email)
     
-    save_data()
-    
     # Send welcome email
     send_welcome_email(email, username)
     
@@ -3786,17 +4740,18 @@ def handle_login(data):
     password = data.get('password', '')
     remember_me = data.get('remember_me', True)
     
-    if email not in users_db:
+    user_data = store.get_user(email)
+    if not user_data:
         emit('login_error', {'message': 'Invalid email or password'})
         return
     
-    user_data = users_db[email]
-    
     # Verify password
     if not verify_password(password, user_data['password_hash'], user_data['salt']):
         emit('login_error', {'message': 'Invalid email or password'})
         return
     
+    upgrade_password_hash(email, user_data, password)
+    
     username = user_data['username']
     
     # Create session
@@ -3811,7 +4766,10 @@ def handle_login(data):
         'username': username
     }
     
+    was_online = username in active_users
     active_users[username] = request.sid
+    if not was_online:
+        presence_updates.record(username, True)
     
     emit('login_success', {
         'username': username,
@@ -3831,12 +4789,11 @@ def handle_change_password(data):
         emit('session_expired', {'message': 'Session expired'})
         return
     
-    if email not in users_db:
+    user_data = store.get_user(email)
+    if not user_data:
         emit('password_error', {'message': 'User not found'})
         return
     
-    user_data = users_db[email]
-    
     # Verify current password
     if not verify_password(current_password, user_data['password_hash'], user_data['salt']):
         emit('password_error', {'message': 'Current password is incorrect'})
@@ -3846,10 +4803,13 @@ def handle_change_password(data):
     hashed_password, salt = hash_password(new_password)
     
     # Update password
-    users_db[email]['password_hash'] = hashed_password
-    users_db[email]['salt'] = salt
+    store.update_user(email, {
+        'password_hash': hashed_password,
+        'salt': salt
+    })
     
-    save_data()
+    # Sign out every other device; this one keeps its session
+    invalidate_all_sessions(email, keep_token=token)
     
     emit('password_changed', {'success': True})
 
@@ -3866,7 +4826,7 @@ def handle_logout_all(data):
     invalidate_all_sessions(email)
     
     # Disconnect user if online
-    username = users_db[email]['username']
+    username = store.get_user(email)['username']
     if username in active_users:
         sid = active_users[username]
         socketio.emit('logged_out_all', {}, room=sid)
@@ -3877,16 +4837,20 @@ def handle_logout_all(data):
 # ========== SECURITY MIDDLEWARE ==========
 def check_auth(sid):
     """Check if socket has valid authentication"""
-    if sid not in socket_sessions:
+    session = socket_sessions.get(sid)
+    if session is None:
         return None
     
-    session = socket_sessions[sid]
-    email = session['email']
-    token = session['token']
+    # Validated before and not expired yet. Revoking the user's sessions
+    # drops 'auth_expires' (see revoke_socket_auth).
+    if session.get('auth_expires', 0) > time.time():
+        return session
     
-    if not validate_session(email, token):
+    expires = session_index.expires_at(session['email'], session['token'])
+    if expires is None:
         return None
     
+    session['auth_expires'] = expires
     return session
 
 # ========== PROTECTED SOCKET EVENTS ==========
@@ -3931,7 +4895,7 @@ def handle_join_room(data):
     
     # Regular room joining logic
     if username in active_users:
-        room = rooms_db.get(room_id)
+        room = store.get_room(room_id)
         if room and room.get('type') == 'private':
             if room.get('creator') != username and username not in room.get('invited', []):
                 creator = room.get('creator')
@@ -3942,22 +4906,23 @@ def handle_join_room(data):
         join_room(room_id)
         user_rooms[username] = room_id
         
-        if room_id in rooms_db:
-            room = rooms_db[room_id]
-            if username not in room.get('members', []):
-                room['members'] = room.get('members', []) + [username]
-                save_data()
+        audience_before = room_audience(room) if room else None
+        joined = room is not None and store.add_room_member(room_id, username)
+        if joined:
+            room = store.get_room(room_id)
         
         print(f"✅ {username} joined room: {room_id}")
         
+        snapshot = room_members_snapshot(room_id)
         emit('room_joined', {
-            'room': rooms_db.get(room_id, {}),
-            'members': get_room_members(room_id)
+            'room': room or {},
+            'members': snapshot['members'],
+            'members_version': snapshot['version']
         })
         
-        socketio.emit('room_members_updated', 
-                     get_room_members(room_id),
-                     room=room_id)
+        if joined:
+            emit_members_delta(room_id, [{'op': 'joined', 'username': username, 'connected': True}])
+            emit_room_changed(room, audience_before)
 
 @socketio.on('leave_room')
 def handle_leave_room(data):
@@ -3978,26 +4943,25 @@ def handle_leave_room(data):
         return
     
     # Don't leave private chat rooms from database
+    room = None
+    left = False
     if not room_id.startswith('dm_'):
-        if room_id in rooms_db:
-            room = rooms_db[room_id]
-            if username in room.get('members', []):
-                room['members'] = [m for m in room['members'] if m != username]
-                save_data()
+        room = store.get_room(room_id)
+        audience_before = room_audience(room) if room else None
+        left = room is not None and store.remove_room_member(room_id, username)
     
     leave_room(room_id)
     
     if username in user_rooms and user_rooms[username] == room_id:
         del user_rooms[username]
     
-    if not room_id.startswith('dm_'):
-        socketio.emit('room_members_updated', 
-                     get_room_members(room_id),
-                     room=room_id)
+    if left:
+        emit_members_delta(room_id, [{'op': 'left', 'username': username}])
+        emit_room_changed(store.get_room(room_id), audience_before)
     
     emit('room_left', {
         'room_id': room_id,
-        'message': f'Left room {rooms_db.get(room_id, {}).get("name", "")}'
+        'message': f'Left room {(room or {}).get("name", "")}'
     })
 
 @socketio.on('delete_room')
@@ -4023,8 +4987,8 @@ def handle_delete_room(data):
         emit('room_deleted', {'message': 'Cannot delete private chats'})
         return
     
-    if room_id in rooms_db:
-        room = rooms_db[room_id]
+    room = store.get_room(room_id)
+    if room:
         if room.get('creator') != username:
             emit('room_deleted', {'message': 'Only room creator can delete room'})
             return
@@ -4034,14 +4998,14 @@ def handle_delete_room(data):
             'message': 'Room has been deleted by the creator'
         }, room=room_id)
         
-        del rooms_db[room_id]
-        
-        if room_id in messages_db:
-            del messages_db[room_id]
+        blob_ids = list(room_blob_ids(room_id))
+        store.delete_room(room_id)
+        for blob_id in blob_ids:
+            blob_store.release(blob_id)
+        if search_index is not None:
+            search_index.drop('room', room_id)
         
-        save_data()
-        
-        socketio.emit('room_list', list(rooms_db.values()), broadcast=True)
+        emit_room_delta('room_removed', room, room_audience(room), room_directory_changed(room_id))
         
         emit('room_deleted', {
             'room_id': room_id,
@@ -4066,8 +5030,8 @@ def handle_get_invite_link(data):
         emit('invite_link_error', {'message': 'Cannot generate invite links for private chats'})
         return
     
-    if room_id in rooms_db:
-        room = rooms_db[room_id]
+    room = store.get_room(room_id)
+    if room:
         if room.get('type') == 'private' and room.get('creator') != username:
             emit('invite_link_error', {'message': 'Only room creator can generate invite links'})
             return
@@ -4090,26 +5054,21 @@ def handle_message(data):
         return
     
     message_id = str(uuid.uuid4())[:8]
-    user_settings = user_settings_db.get(username, {})
     
     message = {
         'id': message_id,
         'username': username,
-        'displayName': user_settings.get('displayName', username),
+        'displayName': get_display_name(username),
         'message': message_text,
         'server': server,
         'timestamp': data.get('timestamp', datetime.now().isoformat()),
         'type': 'server'
     }
     
-    if server not in messages_db:
-        messages_db[server] = []
-    messages_db[server].append(message)
-    
-    if len(messages_db[server]) > 500:
-        messages_db[server] = messages_db[server][-500:]
-    
-    save_data()
+    forget_evicted('room', server, store.add_room_message(server, message))
+    note_room_activity(server)
+    if search_index is not None:
+        search_index.add('room', server, message)
     
     print(f"📨 Room message sent: {username} -> {server}: {message_text[:50]}...")
     emit('message', message, room=server)
@@ -4122,36 +5081,36 @@ def handle_voice_message(data):
         return
     
     username = session['username']
-    audio_data = data.get('audioData')
-    duration = data.get('duration', 0)
     server = data.get('server')
     timestamp = data.get('timestamp', datetime.now().isoformat())
     
-    if not audio_data or not server:
+    if not server:
+        return
+    
+    try:
+        clip = process_voice_payload(data)
+    except VoiceRejected as e:
+        emit('voice_message_error', {'message': str(e)})
         return
+    duration = clip['duration']
     
     message_id = str(uuid.uuid4())[:8]
-    user_settings = user_settings_db.get(username, {})
     
     message = {
         'id': message_id,
         'username': username,
-        'displayName': user_settings.get('displayName', username),
-        'audioData': audio_data,
+        'displayName': get_display_name(username),
+        'audioBlob': blob_store.put(clip['audio'], clip['mimeType']),
+        'mimeType': clip['mimeType'],
         'duration': duration,
+        'waveform': clip['waveform'],
         'server': server,
         'timestamp': timestamp,
         'type': 'voice'
     }
     
-    if server not in messages_db:
-        messages_db[server] = []
-    messages_db[server].append(message)
-    
-    if len(messages_db[server]) > 500:
-        messages_db[server] = messages_db[server][-500:]
-    
-    save_data()
+    forget_evicted('room', server, store.add_room_message(server, message))
+    note_room_activity(server)
     
     print(f"🎤 Voice message sent: {username} -> {server} ({duration}s)")
     emit('voice_message', message, room=server)
@@ -4167,11 +5126,9 @@ def handle_private_voice_message(data):
     
     from_user = session['username']
     to_user = data.get('to')
-    audio_data = data.get('audioData')
-    duration = data.get('duration', 0)
     timestamp = data.get('timestamp', datetime.now().isoformat())
     
-    if not to_user or not audio_data:
+    if not to_user or not (data.get('audio') or data.get('audioData')):
         emit('private_message_error', {'message': 'Missing required fields'})
         return
     
@@ -4179,13 +5136,17 @@ def handle_private_voice_message(data):
         emit('private_message_error', {'message': 'You can only message friends'})
         return
     
-    key = get_private_chat_key(from_user, to_user)
+    try:
+        clip = process_voice_payload(data)
+    except VoiceRejected as e:
+        emit('private_message_error', {'message': str(e)})
+        return
+    duration = clip['duration']
     
-    if key not in private_messages_db:
-        private_messages_db[key] = []
+    key = get_private_chat_key(from_user, to_user)
     
     message_id = str(uuid.uuid4())[:8]
-    from_settings = user_settings_db.get(from_user, {})
+    audio_blob = blob_store.put(clip['audio'], clip['mimeType'])
     
     sorted_users = sorted([from_user, to_user])
     room_id = f"dm_{sorted_users[0]}_{sorted_users[1]}"
@@ -4194,28 +5155,27 @@ def handle_private_voice_message(data):
         'id': message_id,
         'from': from_user,
         'to': to_user,
-        'audioData': audio_data,
+        'audioBlob': audio_blob,
+        'mimeType': clip['mimeType'],
         'duration': duration,
+        'waveform': clip['waveform'],
         'timestamp': timestamp,
         'room_id': room_id,
         'type': 'voice'
     }
     
-    private_messages_db[key].append(message_data)
-    
-    if len(private_messages_db[key]) > 1000:
-        private_messages_db[key] = private_messages_db[key][-1000:]
-    
-    save_data()
+    forget_evicted('private', key, store.add_private_message(key, message_data))
     
     formatted_message = {
         'id': message_id,
         'from': from_user,
         'to': to_user,
-        'audioData': audio_data,
+        'audioBlob': audio_blob,
+        'mimeType': clip['mimeType'],
         'duration': duration,
+        'waveform': clip['waveform'],
         'timestamp': timestamp,
-        'displayName': from_settings.get('displayName', from_user),
+        'displayName': get_display_name(from_user),
         'room_id': room_id,
         'type': 'voice'
     }
@@ -4257,10 +5217,6 @@ def handle_private_message(data):
     sorted_users = sorted([from_user, to_user])
     room_id = f"dm_{sorted_users[0]}_{sorted_users[1]}"
     
-    # Get display names
-    from_settings = user_settings_db.get(from_user, {})
-    to_settings = user_settings_db.get(to_user, {})
-    
     # Prepare message for both users
     formatted_message = {
         'id': message_data['id'],
@@ -4268,7 +5224,7 @@ def handle_private_message(data):
         'to': to_user,
         'message': message_text,
         'timestamp': timestamp,
-        'displayName': from_settings.get('displayName', from_user),
+        'displayName': get_display_name(from_user),
         'room_id': room_id,
         'type': 'private'
     }
@@ -4290,187 +5246,6 @@ def handle_private_message(data):
     print(f"✅✅✅ Private message sent successfully: {from_user} -> {to_user}")
 
 
-@socketio.on('voice_message')
-def handle_voice_message(data):
-    session = check_auth(request.sid)
-    if not session:
-        emit('session_expired', {'message': 'Please login again'})
-        return
-    
-    username = session['username']
-    audio_data = data.get('audioData')
-    duration = data.get('duration', 0)
-    server = data.get('server')
-    timestamp = data.get('timestamp', datetime.now().isoformat())
-    
-    if not audio_data or not server:
-        return
-    
-    message_id = str(uuid.uuid4())[:8]
-    user_settings = user_settings_db.get(username, {})
-    
-    message = {
-        'id': message_id,
-        'username': username,
-        'displayName': user_settings.get('displayName', username),
-        'audioData': audio_data,
-        'duration': duration,
-        'server': server,
-        'timestamp': timestamp,
-        'type': 'voice'
-    }
-    
-    if server not in messages_db:
-        messages_db[server] = []
-    messages_db[server].append(message)
-    
-    if len(messages_db[server]) > 500:
-        messages_db[server] = messages_db[server][-500:]
-    
-    save_data()
-    
-    print(f"🎤 Voice message sent: {username} -> {server} ({duration}s)")
-    emit('voice_message', message, room=server)
-
-
-@socketio.on('private_voice_message')
-def handle_private_voice_message(data):
-    print("🎤 SERVER: private_voice_message received")
-    
-    session = check_auth(request.sid)
-    if not session:
-        emit('session_expired', {'message': 'Please login again'})
-        return
-    
-    from_user = session['username']
-    to_user = data.get('to')
-    audio_data = data.get('audioData')
-    duration = data.get('duration', 0)
-    timestamp = data.get('timestamp', datetime.now().isoformat())
-    
-    if not to_user or not audio_data:
-        emit('private_message_error', {'message': 'Missing required fields'})
-        return
-    
-    if not are_friends(from_user, to_user):
-        emit('private_message_error', {'message': 'You can only message friends'})
-        return
-    
-    key = get_private_chat_key(from_user, to_user)
-    
-    if key not in private_messages_db:
-        private_messages_db[key] = []
-    
-    message_id = str(uuid.uuid4())[:8]
-    from_settings = user_settings_db.get(from_user, {})
-    
-    sorted_users = sorted([from_user, to_user])
-    room_id = f"dm_{sorted_users[0]}_{sorted_users[1]}"
-    
-    message_data = {
-        'id': message_id,
-        'from': from_user,
-        'to': to_user,
-        'audioData': audio_data,
-        'duration': duration,
-        'timestamp': timestamp,
-        'room_id': room_id,
-        'type': 'voice'
-    }
-    
-    private_messages_db[key].append(message_data)
-    
-    if len(private_messages_db[key]) > 1000:
-        private_messages_db[key] = private_messages_db[key][-1000:]
-    
-    save_data()
-    
-    formatted_message = {
-        'id': message_id,
-        'from': from_user,
-        'to': to_user,
-        'audioData': audio_data,
-        'duration': duration,
-        'timestamp': timestamp,
-        'displayName': from_settings.get('displayName', from_user),
-        'room_id': room_id,
-        'type': 'voice'
-    }
-    
-    socketio.emit('private_voice_message', formatted_message, room=room_id)
-    
-    print(f"✅ Private voice message sent: {from_user} -> {to_user} ({duration}s)")
-
-@socketio.on('private_voice_message')
-def handle_private_voice_message(data):
-    print("🎤 SERVER: private_voice_message received")
-    
-    session = check_auth(request.sid)
-    if not session:
-        emit('session_expired', {'message': 'Please login again'})
-        return
-    
-    from_user = session['username']
-    to_user = data.get('to')
-    audio_data = data.get('audioData')
-    duration = data.get('duration', 0)
-    timestamp = data.get('timestamp', datetime.now().isoformat())
-    
-    if not to_user or not audio_data:
-        emit('private_message_error', {'message': 'Missing required fields'})
-        return
-    
-    if not are_friends(from_user, to_user):
-        emit('private_message_error', {'message': 'You can only message friends'})
-        return
-    
-    key = get_private_chat_key(from_user, to_user)
-    
-    if key not in private_messages_db:
-        private_messages_db[key] = []
-    
-    message_id = str(uuid.uuid4())[:8]
-    from_settings = user_settings_db.get(from_user, {})
-    
-    sorted_users = sorted([from_user, to_user])
-    room_id = f"dm_{sorted_users[0]}_{sorted_users[1]}"
-    
-    message_data = {
-        'id': message_id,
-        'from': from_user,
-        'to': to_user,
-        'audioData': audio_data,
-        'duration': duration,
-        'timestamp': timestamp,
-        'room_id': room_id,
-        'type': 'voice'
-    }
-    
-    private_messages_db[key].append(message_data)
-    
-    if len(private_messages_db[key]) > 1000:
-        private_messages_db[key] = private_messages_db[key][-1000:]
-    
-    save_data()
-    
-    formatted_message = {
-        'id': message_id,
-        'from': from_user,
-        'to': to_user,
-        'audioData': audio_data,
-        'duration': duration,
-        'timestamp': timestamp,
-        'displayName': from_settings.get('displayName', from_user),
-        'room_id': room_id,
-        'type': 'voice'
-    }
-    
-    socketio.emit('private_voice_message', formatted_message, room=room_id)
-    
-    print(f"✅ Private voice message sent: {from_user} -> {to_user} ({duration}s)")
-
-
-
 @socketio.on('get_private_messages')
 def handle_get_private_messages(data):
     session = check_auth(request.sid)
@@ -4489,18 +5264,23 @@ def handle_get_private_messages(data):
         emit('private_messages_error', {'message': 'You can only view messages with friends'})
         return
     
-    messages = get_private_messages(username, friend)
+    limit, before, after = history_page_args(data)
+    messages, has_more = get_private_messages(username, friend, limit, before, after)
     
     # Create consistent room ID
     sorted_users = sorted([username, friend])
     room_id = f"dm_{sorted_users[0]}_{sorted_users[1]}"
     
+    # Display names of the two participants
+    display_names = {
+        username: get_display_name(username),
+        friend: get_display_name(friend)
+    }
+    
     # Format messages for display
     formatted_messages = []
     for msg in messages:
-        # Get display name from user settings
-        from_user_settings = user_settings_db.get(msg['from'], {})
-        display_name = from_user_settings.get('displayName', msg['from'])
+        display_name = display_names.get(msg['from']) or get_display_name(msg['from'])
         
         formatted_messages.append({
             'id': msg['id'],
@@ -4508,17 +5288,30 @@ def handle_get_private_messages(data):
             'to': msg['to'],
             'username': msg['from'],
             'displayName': display_name,
-            'message': msg['message'],
+            'message': msg.get('message'),
             'room_id': room_id,
             'timestamp': msg['timestamp'],
             'type': 'private'
         })
+        if msg.get('type') == 'voice':
+            formatted_messages[-1].update({
+                'audioBlob': msg.get('audioBlob'),
+                'audio': msg.get('audio'),
+                'audioData': msg.get('audioData'),
+                'mimeType': msg.get('mimeType'),
+                'duration': msg.get('duration', 0),
+                'waveform': msg.get('waveform'),
+                'type': 'voice'
+            })
     
     print(f"📨 Retrieved {len(formatted_messages)} private messages between {username} and {friend}")
     emit('private_messages', {
         'friend': friend,
         'room_id': room_id,
-        'messages': formatted_messages
+        'messages': formatted_messages,
+        'before': before,
+        'after': after,
+        'has_more': has_more
     })
 
 @socketio.on('delete_message')
@@ -4543,26 +5336,26 @@ def handle_delete_message(data):
             user1, user2 = parts[1], parts[2]
             key = get_private_chat_key(user1, user2)
             
-            if key in private_messages_db:
-                for i, msg in enumerate(private_messages_db[key]):
-                    if msg.get('id') == message_id and msg.get('from') == username:
-                        del private_messages_db[key][i]
-                        save_data()
-                        emit('message_deleted', {'message_id': message_id}, room=room_id)
-                        break
+            msg = store.get_private_message(key, message_id)
+            if msg and msg.get('from') == username:
+                if store.delete_private_message(key, message_id):
+                    release_message_blobs([msg])
+                    if search_index is not None:
+                        search_index.remove('private', key, message_id)
+                emit('message_deleted', {'message_id': message_id}, room=room_id)
     else:
         # Regular room message
-        if room_id in messages_db:
-            for i, msg in enumerate(messages_db[room_id]):
-                if msg.get('id') == message_id:
-                    room = rooms_db.get(room_id, {})
-                    can_delete = msg.get('username') == username or room.get('creator') == username
-                    
-                    if can_delete:
-                        del messages_db[room_id][i]
-                        save_data()
-                        emit('message_deleted', {'message_id': message_id}, room=room_id)
-                        break
+        msg = store.get_room_message(room_id, message_id)
+        if msg:
+            room = store.get_room(room_id) or {}
+            can_delete = msg.get('username') == username or room.get('creator') == username
+            
+            if can_delete:
+                if store.delete_room_message(room_id, message_id):
+                    release_message_blobs([msg])
+                    if search_index is not None:
+                        search_index.remove('room', room_id, message_id)
+                emit('message_deleted', {'message_id': message_id}, room=room_id)
 
 @socketio.on('get_room_messages')
 def handle_get_room_messages(data):
@@ -4587,13 +5380,108 @@ def handle_get_room_messages(data):
             friend = user2 if user1 == username else user1
             
             # Get private messages
-            handle_get_private_messages({
-                'friend': friend
+            handle_get_private_messages(dict(data, friend=friend))
+    else:
+        # Regular room messages: the newest page, or an older/newer one by cursor
+        limit, before, after = history_page_args(data)
+        room_messages, has_more = store.get_room_history(room_id, limit, before, after)
+        if before or after:
+            emit('chat_messages_page', {
+                'room': room_id,
+                'messages': room_messages,
+                'before': before,
+                'after': after,
+                'has_more': has_more
             })
+        else:
+            emit('chat_messages', room_messages)
+
+@socketio.on('get_room_members')
+def handle_get_room_members(data):
+    session = check_auth(request.sid)
+    if not session:
+        return
+    
+    room_id = data.get('room')
+    if not room_id or room_id.startswith('dm_'):
+        return
+    
+    room = store.get_room(room_id)
+    if not room:
+        return
+    if room.get('type') == 'private' and not store.is_room_member(room_id, session['username']):
+        return
+    
+    emit('room_members', room_members_snapshot(room_id))
+
+def searchable_conversations(username):
+    """Search scope of a user: rooms they belong to and chats with their friends"""
+    conversations = [conversation_id('room', room_id) for room_id in store.get_user_rooms(username)]
+    conversations += [conversation_id('private', get_private_chat_key(username, friend))
+                      for friend in store.get_friends(username)
+                      if store.are_friends(username, friend)]
+    return conversations
+
+def format_search_hit(hit, username):
+    """Search hit as sent to the client, pointing at the room or DM to open"""
+    result = {
+        'id': hit['id'],
+        'sender': hit['sender'],
+        'message': hit['message'],
+        'timestamp': hit['timestamp'],
+        'score': hit['score'],
+        'type': hit['kind']
+    }
+    if hit['kind'] == 'private':
+        # The chat key is both usernames, sorted and joined by '_'
+        key = hit['key']
+        friend = key[len(username) + 1:] if key.startswith(username + '_') else key[:-len(username) - 1]
+        result.update(room=f"dm_{key}", friend=friend)
     else:
-        # Regular room messages
-        room_messages = messages_db.get(room_id, [])
-        emit('chat_messages', room_messages[-100:])
+        room = store.get_room(hit['key']) or {}
+        result.update(room=hit['key'], roomName=room.get('name', hit['key']))
+    return result
+
+@socketio.on('search_messages')
+def handle_search_messages(data):
+    session = check_auth(request.sid)
+    if not session:
+        return
+    
+    if search_index is None:
+        emit('search_error', {'message': 'Search is not enabled on this server'})
+        return
+    
+    username = session['username']
+    query = data.get('query')
+    if not isinstance(query, str) or not query.strip():
+        emit('search_results', {'query': query, 'results': [], 'offset': 0,
+                                'next_offset': None, 'has_more': False})
+        return
+    
+    try:
+        offset = max(0, int(data.get('offset') or 0))
+        limit = max(1, min(int(data.get('limit') or SEARCH_PAGE_SIZE), SEARCH_PAGE_MAX))
+    except (TypeError, ValueError):
+        offset, limit = 0, SEARCH_PAGE_SIZE
+    
+    # Optionally only the conversation that is open (room id or dm_ id)
+    conversations = searchable_conversations(username)
+    scope = data.get('room')
+    if scope:
+        scope_id = (conversation_id('private', scope[3:]) if scope.startswith('dm_')
+                    else conversation_id('room', scope))
+        conversations = [c for c in conversations if c == scope_id]
+    
+    hits, has_more = search_index.search(query[:200], conversations, limit, offset)
+    emit('search_results', {
+        'query': query,
+        'room': scope,
+        'results': [format_search_hit(hit, username) for hit in hits],
+        'offset': offset,
+        'next_offset': offset + len(hits) if has_more else None,
+        'has_more': has_more
+    })
 
 @socketio.on('get_rooms')
 def handle_get_rooms():
@@ -4601,7 +5489,21 @@ def handle_get_rooms():
     if not session:
         return
     
-    emit('room_list', list(rooms_db.values()))
+    emit('room_list', room_directory_snapshot(session['username']))
+
+@socketio.on('browse_rooms')
+def handle_browse_rooms(data):
+    session = check_auth(request.sid)
+    if not session:
+        emit('session_expired', {'message': 'Please login again'})
+        return
+    
+    try:
+        page = browse_room_directory(session['username'], data or {})
+    except ValueError as e:
+        emit('room_directory_error', {'message': str(e)})
+        return
+    emit('room_directory', page)
 
 @socketio.on('create_room')
 def handle_create_room(data):
@@ -4631,14 +5533,13 @@ def handle_create_room(data):
         'invited': []
     }
     
-    rooms_db[room_id] = room
-    save_data()
+    store.create_room(room)
     
     if username in active_users:
         join_room(room_id)
     
     emit('room_created', {'room': room})
-    socketio.emit('room_list', list(rooms_db.values()), broadcast=True)
+    emit_room_delta('room_added', room, room_audience(room), room_directory_changed(room_id))
 
 @socketio.on('create_private_chat')
 def handle_create_private_chat(data):
@@ -4674,6 +5575,40 @@ def handle_create_private_chat(data):
         'room_id': room_id
     })
 
+# Settings fields uploaded as data URLs; stored as '<field>Blob' ids
+SETTINGS_IMAGES = ('avatar', 'banner')
+
+def read_settings_image(value):
+    """Bytes and MIME type of an uploaded avatar/banner, or (None, None).
+
+    The type is read from the image itself, never from the data URL
+    header; ValueError for anything but PNG, JPEG, GIF or WebP.
+    """
+    image, _ = read_data_url(value, None)
+    if image is None:
+        return None, None
+    mime_type = sniff_image(image)
+    if mime_type is None:
+        raise ValueError('Profile images must be PNG, JPEG, GIF or WebP')
+    return image, mime_type
+
+def store_settings_images(username, current, updates):
+    """Move uploaded avatar/banner images from `updates` into the blob store.
+    Raises ValueError (storing nothing) if one of them is not an image."""
+    images = {}
+    for field in SETTINGS_IMAGES:
+        # Blob ids are only ever set here, never taken from the client
+        updates.pop(f'{field}Blob', None)
+        images[field] = read_settings_image(updates.get(field))
+    for field, (image, mime_type) in images.items():
+        if image is None:
+            continue
+        blob_id = blob_store.put(image, mime_type)
+        # Re-saving the same image adds and drops one reference: no change
+        blob_store.release(current.get(f'{field}Blob'))
+        updates[field] = None
+        updates[f'{field}Blob'] = blob_id
+
 @socketio.on('get_user_settings')
 def handle_get_user_settings(data):
     session = check_auth(request.sid)
@@ -4682,17 +5617,28 @@ def handle_get_user_settings(data):
     
     username = session['username']
     
-    if username not in user_settings_db:
-        user_settings_db[username] = {
+    settings = store.get_settings(username)
+    if settings is None:
+        settings = {
             'displayName': username,
             'avatar': None,
             'banner': None,
             'bio': '',
             'theme': 'dark'
         }
-        save_data()
+        store.save_settings(username, settings)
+    elif any(read_data_url(settings.get(field), 'image/png')[0] for field in SETTINGS_IMAGES):
+        # Saved before the blob store existed: move the images out once
+        settings = dict(settings)
+        for field in SETTINGS_IMAGES:
+            try:
+                read_settings_image(settings.get(field))
+            except ValueError:
+                settings[field] = None  # not an image: dropped
+        store_settings_images(username, settings, settings)
+        store.save_settings(username, settings)
     
-    emit('user_settings', user_settings_db[username])
+    emit('user_settings', settings)
 
 @socketio.on('update_user_settings')
 def handle_update_user_settings(data):
@@ -4704,11 +5650,15 @@ def handle_update_user_settings(data):
     username = session['username']
     settings = data.get('settings', {})
     
-    if username not in user_settings_db:
-        user_settings_db[username] = {}
-    
-    user_settings_db[username].update(settings)
-    save_data()
+    current_settings = dict(store.get_settings(username) or {})
+    settings = dict(settings)
+    try:
+        store_settings_images(username, current_settings, settings)
+    except ValueError as e:
+        emit('user_settings_updated', {'success': False, 'message': str(e)})
+        return
+    current_settings.update(settings)
+    store.save_settings(username, current_settings)
     
     emit('user_settings_updated', {'success': True})
 
@@ -4736,9 +5686,10 @@ def handle_activate_premium(data):
         emit('premium_error', {'message': 'Invalid upgrade code'})
         return
     
-    users_db[user_email]['premium'] = True
-    users_db[user_email]['premium_until'] = (datetime.now() + timedelta(days=30)).isoformat()
-    save_data()
+    store.update_user(user_email, {
+        'premium': True,
+        'premium_until': (datetime.now() + timedelta(days=30)).isoformat()
+    })
     
     emit('premium_activated', {'username': username})
 
@@ -4761,13 +5712,7 @@ def handle_send_friend_request(data):
         return
     
     # Check if user exists
-    user_exists = False
-    for user_data in users_db.values():
-        if user_data.get('username') == to_user:
-            user_exists = True
-            break
-    
-    if not user_exists:
+    if not store.find_user_email(to_user):
         emit('friend_request_error', {'message': 'User not found'})
         return
     
@@ -4777,18 +5722,12 @@ def handle_send_friend_request(data):
         return
     
     # Check if request already sent
-    if to_user in friend_requests_db.get(from_user, []):
+    if to_user in store.get_friend_requests(from_user):
         emit('friend_request_error', {'message': 'Friend request already sent'})
         return
     
-    # Initialize friend requests for recipient if not exists
-    if to_user not in friend_requests_db:
-        friend_requests_db[to_user] = []
-    
-    # Check if request already exists
-    if from_user not in friend_requests_db[to_user]:
-        friend_requests_db[to_user].append(from_user)
-        save_data()
+    # Add request unless it already exists
+    store.add_friend_request(to_user, from_user)
     
     # Notify recipient if online
     if to_user in active_users:
@@ -4806,7 +5745,7 @@ def handle_get_friend_requests(data):
     
     username = session['username']
     
-    requests = friend_requests_db.get(username, [])
+    requests = store.get_friend_requests(username)
     emit('friend_requests', {'requests': requests})
 
 @socketio.on('accept_friend_request')
@@ -4824,25 +5763,15 @@ def handle_accept_friend_request(data):
         return
     
     # Check if request exists
-    if friend_username not in friend_requests_db.get(username, []):
+    if friend_username not in store.get_friend_requests(username):
         emit('friend_request_error', {'message': 'Friend request not found'})
         return
     
     # Remove from friend requests
-    friend_requests_db[username] = [r for r in friend_requests_db.get(username, []) if r != friend_username]
+    store.remove_friend_request(username, friend_username)
     
     # Add to friends lists
-    if username not in friends_db:
-        friends_db[username] = []
-    if friend_username not in friends_db[username]:
-        friends_db[username].append(friend_username)
-    
-    if friend_username not in friends_db:
-        friends_db[friend_username] = []
-    if username not in friends_db[friend_username]:
-        friends_db[friend_username].append(username)
-    
-    save_data()
+    store.add_friendship(username, friend_username)
     
     # Create room ID for the private chat
     sorted_users = sorted([username, friend_username])
@@ -4852,7 +5781,7 @@ def handle_accept_friend_request(data):
     if username in active_users:
         # Update friends list for current user
         friends_list = []
-        for friend in friends_db.get(username, []):
+        for friend in store.get_friends(username):
             is_connected = friend in active_users
             friends_list.append({
                 'username': friend,
@@ -4866,7 +5795,7 @@ def handle_accept_friend_request(data):
     if friend_username in active_users:
         # Update friends list for friend
         friends_list = []
-        for friend in friends_db.get(friend_username, []):
+        for friend in store.get_friends(friend_username):
             is_connected = friend in active_users
             friends_list.append({
                 'username': friend,
@@ -4890,9 +5819,7 @@ def handle_decline_friend_request(data):
     if not friend_username:
         return
     
-    if username in friend_requests_db:
-        friend_requests_db[username] = [r for r in friend_requests_db[username] if r != friend_username]
-        save_data()
+    store.remove_friend_request(username, friend_username)
     
     if username in active_users:
         emit('friend_request_declined', {
@@ -4914,13 +5841,7 @@ def handle_remove_friend(data):
         return
     
     # Remove from friends lists
-    if username in friends_db:
-        friends_db[username] = [f for f in friends_db[username] if f != friend_username]
-    
-    if friend_username in friends_db:
-        friends_db[friend_username] = [f for f in friends_db[friend_username] if f != username]
-    
-    save_data()
+    store.remove_friendship(username, friend_username)
     
     # Notify both users
     if username in active_users:
@@ -4928,7 +5849,7 @@ def handle_remove_friend(data):
         
         # Update friends list
         friends_list = []
-        for friend in friends_db.get(username, []):
+        for friend in store.get_friends(username):
             is_connected = friend in active_users
             friends_list.append({
                 'username': friend,
@@ -4941,7 +5862,7 @@ def handle_remove_friend(data):
         
         # Update friends list for friend
         friends_list = []
-        for friend in friends_db.get(friend_username, []):
+        for friend in store.get_friends(friend_username):
             is_connected = friend in active_users
             friends_list.append({
                 'username': friend,
@@ -4958,7 +5879,7 @@ def handle_get_friends(data):
     username = session['username']
     
     friends_list = []
-    for friend in friends_db.get(username, []):
+    for friend in store.get_friends(username):
         is_connected = friend in active_users
         friends_list.append({
             'username': friend,
@@ -4983,12 +5904,11 @@ def handle_add_friend_to_room(data):
         return
     
     # Check if room exists
-    if room_id not in rooms_db:
+    room = store.get_room(room_id)
+    if not room:
         emit('friend_added_to_room_error', {'message': 'Room not found'})
         return
     
-    room = rooms_db[room_id]
-    
     # Check if user is room creator
     if room.get('creator') != username:
         emit('friend_added_to_room_error', {'message': 'Only room creator can add friends'})
@@ -5005,17 +5925,13 @@ def handle_add_friend_to_room(data):
         return
     
     # Add friend to room members
-    if friend_username not in room.get('members', []):
-        room['members'] = room.get('members', []) + [friend_username]
+    audience_before = room_audience(room)
+    added = store.add_room_member(room_id, friend_username)
     
     # Add to invited list
-    if 'invited' not in room:
-        room['invited'] = []
-    
-    if friend_username not in room['invited']:
-        room['invited'].append(friend_username)
-    
-    save_data()
+    store.add_room_invite(room_id, friend_username)
+    if added:
+        emit_room_changed(store.get_room(room_id), audience_before)
     
     # Notify friend if online
     if friend_username in active_users:
@@ -5031,9 +5947,9 @@ def handle_add_friend_to_room(data):
     })
     
     # Update room members for everyone in the room
-    socketio.emit('room_members_updated', 
-                 get_room_members(room_id),
-                 room=room_id)
+    if added:
+        emit_members_delta(room_id, [{'op': 'joined', 'username': friend_username,
+                                      'connected': friend_username in active_users}])
 
 @socketio.on('start_call')
 def handle_start_call(data):
@@ -5057,7 +5973,7 @@ def handle_start_call(data):
         }, room=room_id, include_self=False)
         return
     
-    room = rooms_db.get(room_id, {})
+    room = store.get_room(room_id) or {}
     if room.get('type') != 'private':
         emit('call_error', {'message': 'Calls only allowed in private rooms or DMs'})
         return
@@ -5104,10 +6020,8 @@ if __name__ == '__main__':
     print("\n🚀 Access: http://localhost:5000")
     print("=" * 60)
     
-    socketio.run(app, 
-                 host='0.0.0.0', 
-                 port=5000, 
-                 debug=False, 
-                 allow_unsafe_werkzeug=True)
+    install_shutdown_handler()
+    
+    run_server()
 
 
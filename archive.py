@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Message Archive Module
+Older history spilled to compressed, time-partitioned segment files on disk
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+# ==================== ON-DISK LAYOUT ====================
+# <root>/<collection>/<sha1 of the conversation key>/
+#     YYYY-MM-DD.seg   blocks of messages whose first message is from that
+#                      day; each block is one zlib stream of JSON lines,
+#                      appended and never rewritten
+#     index.jsonl      sparse index, one line per block (file, offset,
+#                      length, first sequence number, count, time range,
+#                      first and last message id), plus one line per
+#                      deleted archived message
+#
+# Sequence numbers count archived messages per conversation, oldest = 0.
+# Messages handed over one at a time wait in a per-conversation write
+# buffer (numbered after the last block) until there are enough for a block.
+# Index lines written by older versions also list every id of the block;
+# those lists are ignored.
+
+class Conversation:
+    """Sparse index of one conversation's archive (loaded on first use)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.blocks = []      # index entries, oldest first
+        self.starts = []      # first seq of each block, for bisect
+        self.deleted = set()  # ids of archived messages deleted later
+        self.last_id = None   # newest message id written to a block
+        self.pending = []     # write buffer, oldest first
+
+    @property
+    def block_end(self):
+        """Seq of the first message not in a block"""
+        if not self.blocks:
+            return 0
+        last = self.blocks[-1]
+        return last['seq'] + last['count']
+
+    @property
+    def next_seq(self):
+        return self.block_end + len(self.pending)
+
+    def add_block(self, entry):
+        entry.pop('ids', None)
+        self.blocks.append(entry)
+        self.starts.append(entry['seq'])
+        self.last_id = entry['last_id']
+
+    def block_of(self, seq):
+        return bisect.bisect_right(self.starts, seq) - 1
+
+class MessageArchive:
+    """Append-only cold tier behind the in-memory message logs.
+
+    The in-memory backend hands over each message its ring buffer evicts;
+    they are written out a block at a time. The index keeps a few fields
+    per block, not per message: reads bisect the blocks by sequence
+    number and decode only the blocks a page touches, and recently decoded
+    ones are kept in a small LRU cache. Message ids are random, so a
+    message id is found through an LRU of the `locate_cache` ids served
+    most recently (page cursors are always among them), then a block's
+    first/last id, and only then by decoding blocks newest first. At most
+    `max_conversations` indexes stay loaded; the least recently used one
+    with an empty write buffer is unloaded when another is needed.
+    """
+
+    def __init__(self, root, block_size=64, compress_level=6, cache_blocks=32,
+                 locate_cache=4096, max_conversations=256, encoder=None, object_hook=None):
+        self.root = os.path.abspath(root)
+        self.block_size = block_size
+        self.compress_level = compress_level
+        self.cache_blocks = cache_blocks
+        self.locate_cache = locate_cache
+        self.max_conversations = max_conversations
+        self.encoder = encoder
+        self.object_hook = object_hook
+
+        self._conversations = OrderedDict()  # conversation path -> Conversation
+        self._cache = OrderedDict()  # (conversation path, block number) -> messages
+        self._located = OrderedDict()  # (conversation path, message id) -> seq
+        self._lock = threading.RLock()
+        os.makedirs(self.root, exist_ok=True)
+
+    # ==================== INDEX ====================
+
+    def _path(self, collection, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, collection, digest)
+
+    def _conversation(self, collection, key):
+        path = self._path(collection, key)
+        conversation = self._conversations.get(path)
+        if conversation is not None:
+            self._conversations.move_to_end(path)
+            return conversation
+
+        conversation = self._conversations[path] = Conversation(path)
+        self._load_index(conversation)
+        if len(self._conversations) > self.max_conversations:
+            # Buffered messages are in memory only: keep those conversations
+            for other_path, other in self._conversations.items():
+                if other_path != path and not other.pending:
+                    self._unload(other_path)
+                    break
+        return conversation
+
+    def _unload(self, path):
+        """Forget a conversation's index and everything cached from it"""
+        self._conversations.pop(path, None)
+        for cache_key in [k for k in self._cache if k[0] == path]:
+            del self._cache[cache_key]
+        for located_key in [k for k in self._located if k[0] == path]:
+            del self._located[located_key]
+
+    def _load_index(self, conversation):
+        index_file = os.path.join(conversation.path, 'index.jsonl')
+        if not os.path.exists(index_file):
+            return
+        with open(index_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn line after a crash
+                if 'block' in record:
+                    conversation.add_block(record['block'])
+                elif 'deleted' in record:
+                    conversation.deleted.add(record['deleted'])
+
+    @staticmethod
+    def _append_index(conversation, record):
+        with open(os.path.join(conversation.path, 'index.jsonl'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    # ==================== BLOCKS ====================
+
+    @staticmethod
+    def _partition(message):
+        timestamp = message.get('timestamp')
+        if isinstance(timestamp, str) and DATE_RE.match(timestamp):
+            return timestamp[:10]
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+    def _decode_block(self, path, entry):
+        with open(os.path.join(path, entry['file']), 'rb') as f:
+            f.seek(entry['offset'])
+            payload = zlib.decompress(f.read(entry['length']))
+        return [json.loads(line, object_hook=self.object_hook)
+                for line in payload.decode('utf-8').splitlines()]
+
+    def _read_block(self, conversation, number):
+        cache_key = (conversation.path, number)
+        messages = self._cache.get(cache_key)
+        if messages is not None:
+            self._cache.move_to_end(cache_key)
+            return messages
+
+        messages = self._decode_block(conversation.path, conversation.blocks[number])
+        self._cache[cache_key] = messages
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return messages
+
+    def append(self, collection, key, message):
+        """Archive one message (the conversation's next oldest).
+
+        It is buffered until `block_size` messages are waiting; returns the
+        messages written out as a block by this call (usually []). Buffered
+        messages are only in memory: the caller keeps them durable until
+        they come back from here.
+        """
+        with self._lock:
+            conversation = self._conversation(collection, key)
+            conversation.pending.append(message)
+            if len(conversation.pending) < self.block_size:
+                return []
+            messages = conversation.pending
+            self._write_block(conversation, messages)
+            conversation.pending = []
+            return messages
+
+    def pending(self, collection, key):
+        """Messages waiting in the write buffer, oldest first"""
+        with self._lock:
+            path = self._path(collection, key)
+            conversation = self._conversations.get(path)
+            return list(conversation.pending) if conversation is not None else []
+
+    def _write_block(self, conversation, messages):
+        """Write `messages` (oldest first) as one block; durable on return"""
+        with self._lock:
+            os.makedirs(conversation.path, exist_ok=True)
+
+            lines = '\n'.join(json.dumps(m, separators=(',', ':'), cls=self.encoder)
+                              for m in messages)
+            payload = zlib.compress(lines.encode('utf-8'), self.compress_level)
+            file_name = f"{self._partition(messages[0])}.seg"
+            with open(os.path.join(conversation.path, file_name), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+
+            entry = {
+                'file': file_name,
+                'offset': offset,
+                'length': len(payload),
+                'seq': conversation.block_end,
+                'count': len(messages),
+                'first_ts': messages[0].get('timestamp'),
+                'last_ts': messages[-1].get('timestamp'),
+                'first_id': messages[0].get('id'),
+                'last_id': messages[-1].get('id'),
+            }
+            self._append_index(conversation, {'block': entry})
+            conversation.add_block(entry)
+
+    # ==================== LOOKUPS ====================
+
+    def _remember(self, conversation, message_id, seq):
+        if message_id is None:
+            return
+        located_key = (conversation.path, message_id)
+        self._located[located_key] = seq
+        self._located.move_to_end(located_key)
+        while len(self._located) > self.locate_cache:
+            self._located.popitem(last=False)
+
+    def _locate(self, conversation, message_id):
+        """Sequence number of an archived message, or None"""
+        if message_id is None:
+            return None
+        for offset, message in enumerate(conversation.pending):
+            if message.get('id') == message_id:
+                return conversation.block_end + offset
+
+        seq = self._located.get((conversation.path, message_id))
+        if seq is not None and seq < conversation.block_end:
+            return seq
+
+        for number in range(len(conversation.blocks) - 1, -1, -1):
+            entry = conversation.blocks[number]
+            if entry.get('first_id') == message_id:
+                return entry['seq']
+            if entry.get('last_id') == message_id:
+                return entry['seq'] + entry['count'] - 1
+        for number in range(len(conversation.blocks) - 1, -1, -1):
+            for offset, message in enumerate(self._read_block(conversation, number)):
+                if message.get('id') == message_id:
+                    seq = conversation.blocks[number]['seq'] + offset
+                    self._remember(conversation, message_id, seq)
+                    return seq
+        return None
+
+    def _walk(self, conversation, seq, step, count):
+        """Up to `count` live messages from `seq` on, in walking order"""
+        found = []
+        block_end = conversation.block_end
+        end = conversation.next_seq
+        while len(found) < count and 0 <= seq < end:
+            if seq >= block_end:
+                found.append(conversation.pending[seq - block_end])
+                seq += step
+                continue
+            number = conversation.block_of(seq)
+            entry = conversation.blocks[number]
+            messages = self._read_block(conversation, number)
+            while len(found) < count and entry['seq'] <= seq < entry['seq'] + entry['count']:
+                message = messages[seq - entry['seq']]
+                if message.get('id') not in conversation.deleted:
+                    found.append(message)
+                    # The client pages on from here with this id as its cursor
+                    self._remember(conversation, message.get('id'), seq)
+                seq += step
+        return found
+
+    def messages(self, collection, key):
+        """Every live archived message, oldest first, decoding one block at
+        a time (without going through the block cache)"""
+        with self._lock:
+            conversation = self._conversation(collection, key)
+            path = conversation.path
+            blocks = list(conversation.blocks)
+            pending = list(conversation.pending)
+            deleted = conversation.deleted
+        for entry in blocks:
+            try:
+                messages = self._decode_block(path, entry)
+            except FileNotFoundError:
+                return  # dropped meanwhile
+            for message in messages:
+                if message.get('id') not in deleted:
+                    yield message
+        yield from pending
+
+    def last_id(self, collection, key):
+        with self._lock:
+            return self._conversation(collection, key).last_id
+
+    def get(self, collection, key, message_id):
+        with self._lock:
+            conversation = self._conversation(collection, key)
+            if not conversation.next_seq or message_id in conversation.deleted:
+                return None
+            seq = self._locate(conversation, message_id)
+            if seq is None:
+                return None
+            return self._walk(conversation, seq, 1, 1)[0]
+
+    def before(self, collection, key, message_id, limit):
+        """Archived messages older than `message_id` (None: the newest ones).
+
+        Returns (messages oldest first, has_more).
+        """
+        with self._lock:
+            conversation = self._conversation(collection, key)
+            if message_id is None:
+                seq = conversation.next_seq - 1
+            else:
+                seq = self._locate(conversation, message_id)
+                if seq is None:
+                    return [], False
+                seq -= 1
+            messages = self._walk(conversation, seq, -1, limit + 1)
+            return messages[:limit][::-1], len(messages) > limit
+
+    def after(self, collection, key, message_id, limit):
+        """Archived messages newer than `message_id`; (messages, has_more)"""
+        with self._lock:
+            conversation = self._conversation(collection, key)
+            seq = self._locate(conversation, message_id)
+            if seq is None:
+                return [], False
+            messages = self._walk(conversation, seq + 1, 1, limit + 1)
+            return messages[:limit], len(messages) > limit
+
+    # ==================== CHANGES ====================
+
+    def delete(self, collection, key, message_id):
+        """Hide an archived message; returns True if it was there"""
+        with self._lock:
+            conversation = self._conversation(collection, key)
+            if message_id in conversation.deleted:
+                return False
+            seq = self._locate(conversation, message_id)
+            if seq is None:
+                return False
+            if seq >= conversation.block_end:
+                # Not written yet: just leave it out of the buffer
+                del conversation.pending[seq - conversation.block_end]
+                return True
+            self._append_index(conversation, {'deleted': message_id})
+            conversation.deleted.add(message_id)
+            return True
+
+    def drop(self, collection, key):
+        """Remove a conversation's whole archive"""
+        with self._lock:
+            path = self._path(collection, key)
+            self._unload(path)
+            shutil.rmtree(path, ignore_errors=True)
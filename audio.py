@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Voice Clip Module
+Validation, size/duration caps, Opus transcoding and waveform previews
+"""
+
+import hashlib
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+
+import runtime
+from runtime import BlockingPool
+
+# ==================== CONTAINERS ====================
+# (name, MIME type, magic bytes, offset of the magic)
+
+CONTAINERS = (
+    ('webm', 'audio/webm', b'\x1a\x45\xdf\xa3', 0),  # EBML: WebM / Matroska
+    ('ogg', 'audio/ogg', b'OggS', 0),
+    ('mp4', 'audio/mp4', b'ftyp', 4),
+    ('wav', 'audio/wav', b'WAVE', 8),
+    ('mp3', 'audio/mpeg', b'ID3', 0),
+)
+
+def sniff_container(data):
+    """(container name, canonical MIME type) of an audio clip, or (None, None)"""
+    for name, mime_type, magic, offset in CONTAINERS:
+        if data[offset:offset + len(magic)] == magic:
+            return name, mime_type
+    # ID3-less MP3 starts straight with a frame sync
+    if len(data) > 1 and data[0] == 0xFF and data[1] & 0xE0 == 0xE0:
+        return 'mp3', 'audio/mpeg'
+    return None, None
+
+# Decoded PCM used for duration and the waveform: mono, 16-bit, 8 kHz
+PCM_RATE = 8000
+OPUS_MIME_TYPE = 'audio/webm;codecs=opus'
+
+class VoiceRejected(ValueError):
+    """The clip is not accepted; the message is safe to show to the sender"""
+
+def waveform_peaks(pcm, points):
+    """Peak level (0-100, relative to the loudest bucket) of `points` buckets"""
+    samples = array('h')
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if not samples:
+        return []
+
+    step = len(samples) / points
+    peaks = []
+    for i in range(points):
+        bucket = samples[int(i * step):max(int((i + 1) * step), int(i * step) + 1)]
+        peaks.append(max((abs(s) for s in bucket), default=0))
+    loudest = max(peaks) or 1
+    return [round(100 * p / loudest) for p in peaks]
+
+class VoiceProcessor:
+    """Checks and shrinks voice clips before they are stored.
+
+    Every clip is size-checked and sniffed for a known container. With
+    ffmpeg available it is also decoded (true duration, waveform preview)
+    and, if `transcode` is set, re-encoded to low-bitrate mono Opus and cut
+    at `max_seconds`. ffmpeg work runs on a small worker pool; results are
+    cached by content hash, so forwarding or re-sending the same clip costs
+    nothing.
+    """
+
+    def __init__(self, max_bytes, max_seconds, transcode=False, bitrate='24k',
+                 ffmpeg=None, workers=2, waveform_points=48,
+                 cache_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.ffmpeg = ffmpeg or shutil.which('ffmpeg')
+        self.transcode = transcode and self.ffmpeg is not None
+        self.bitrate = bitrate
+        self.workers = workers
+        self.waveform_points = waveform_points
+        self.cache_bytes = cache_bytes
+
+        self._cache = OrderedDict()   # sha256 of the upload -> processed clip
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _worker_pool(self):
+        # Created on first use; the lock keeps concurrent first uploads from
+        # each starting (and leaking) a pool
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = BlockingPool(self.workers, 'voice-processor')
+        return self._pool
+
+    # ==================== CACHE ====================
+
+    def _cache_get(self, key):
+        with self._lock:
+            clip = self._cache.get(key)
+            if clip is not None:
+                self._cache.move_to_end(key)
+            return clip
+
+    def _cache_put(self, key, clip):
+        size = len(clip['audio'])
+        if size > self.cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = clip
+            self._cached_bytes += size
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted['audio'])
+
+    # ==================== FFMPEG ====================
+
+    def _ffmpeg(self, args, data):
+        subprocess = runtime.original('subprocess')
+        try:
+            result = subprocess.run([self.ffmpeg, '-nostdin', '-v', 'error',
+                                     '-i', 'pipe:0', *args],
+                                    input=data, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, timeout=60)
+        except subprocess.TimeoutExpired:
+            raise VoiceRejected('Voice message took too long to process')
+        if result.returncode != 0:
+            raise VoiceRejected('Could not decode voice message')
+        return result.stdout
+
+    def _decode(self, data):
+        """Mono 16-bit PCM of (slightly more than) the first max_seconds"""
+        return self._ffmpeg(['-t', str(self.max_seconds + 1), '-vn', '-ac', '1',
+                             '-ar', str(PCM_RATE), '-f', 's16le', 'pipe:1'], data)
+
+    def _encode_opus(self, data):
+        # A real file rather than a pipe, so the WebM header gets its duration
+        fd, path = tempfile.mkstemp(suffix='.webm')
+        os.close(fd)
+        try:
+            self._ffmpeg(['-t', str(self.max_seconds), '-vn', '-map_metadata', '-1',
+                          '-ac', '1', '-c:a', 'libopus', '-b:a', self.bitrate,
+                          '-application', 'voip', '-y', path], data)
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+    def _process(self, data, mime_type):
+        pcm = self._decode(data)
+        seconds = len(pcm) / 2 / PCM_RATE
+        if seconds <= 0:
+            raise VoiceRejected('Voice message is empty')
+        if seconds > self.max_seconds + 0.5 and not self.transcode:
+            raise VoiceRejected(f'Voice messages are limited to {self.max_seconds} seconds')
+
+        if self.transcode:
+            encoded = self._encode_opus(data)
+            # Keep the upload when it is already smaller and within the cap
+            if len(encoded) < len(data) or seconds > self.max_seconds:
+                data, mime_type = encoded, OPUS_MIME_TYPE
+            pcm = pcm[:self.max_seconds * PCM_RATE * 2]
+            seconds = min(seconds, self.max_seconds)
+
+        return {
+            'audio': data,
+            'mimeType': mime_type,
+            'duration': max(1, round(seconds)),
+            'waveform': waveform_peaks(pcm, self.waveform_points),
+        }
+
+    # ==================== PUBLIC API ====================
+
+    def process(self, data, mime_type, claimed_duration=0):
+        """Validate a clip; returns {'audio', 'mimeType', 'duration', 'waveform'}.
+
+        Raises VoiceRejected for clips that are too large, too long, empty
+        or not audio at all.
+        """
+        if not data:
+            raise VoiceRejected('Voice message is empty')
+        if len(data) > self.max_bytes:
+            raise VoiceRejected(f'Voice messages are limited to {self.max_bytes // 1024} KB')
+
+        container, canonical_type = sniff_container(data)
+        if container is None:
+            raise VoiceRejected('Unsupported audio format')
+        # The client's type may carry a codecs parameter; keep it if it agrees
+        if (mime_type or '').split(';')[0].strip() != canonical_type:
+            mime_type = canonical_type
+
+        if self.ffmpeg is None:
+            # Nothing to measure with: trust the client's duration within the cap
+            try:
+                duration = float(claimed_duration or 0)
+            except (TypeError, ValueError):
+                duration = 0
+            if not math.isfinite(duration):
+                raise VoiceRejected('Invalid voice message duration')
+            if duration > self.max_seconds:
+                raise VoiceRejected(f'Voice messages are limited to {self.max_seconds} seconds')
+            return {'audio': data, 'mimeType': mime_type,
+                    'duration': max(0, round(duration)), 'waveform': None}
+
+        key = hashlib.sha256(data).hexdigest()
+        clip = self._cache_get(key)
+        if clip is None:
+            clip = self._worker_pool().run(self._process, data, mime_type)
+            self._cache_put(key, clip)
+        return clip
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
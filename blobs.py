@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Blob Store Module
+Content-addressed media files (voice clips, avatars, banners) on local disk
+"""
+
+import hashlib
+import os
+import re
+import threading
+
+BLOB_ID_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# ==================== MEDIA TYPES ====================
+# Blobs are served from the app's own origin, so a blob's type must never
+# come from the client: images are recognized by their magic bytes (as
+# audio.sniff_container does for voice clips) and anything else is served
+# as an opaque download. Each entry: (MIME type, ((magic, offset), ...)).
+
+IMAGE_TYPES = (
+    ('image/png', ((b'\x89PNG\r\n\x1a\n', 0),)),
+    ('image/jpeg', ((b'\xff\xd8\xff', 0),)),
+    ('image/gif', ((b'GIF87a', 0),)),
+    ('image/gif', ((b'GIF89a', 0),)),
+    ('image/webp', ((b'RIFF', 0), (b'WEBP', 8))),
+)
+
+def sniff_image(data):
+    """MIME type of a PNG, JPEG, GIF or WebP image, or None"""
+    for mime_type, signature in IMAGE_TYPES:
+        if all(data[offset:offset + len(magic)] == magic for magic, offset in signature):
+            return mime_type
+    return None
+
+def served_type(mime_type):
+    """Content-Type to serve a blob with: audio and the image types above
+    as stored, anything else as a download"""
+    base_type = (mime_type or '').split(';')[0].strip().lower()
+    if base_type.startswith('audio/') or base_type in {t for t, _ in IMAGE_TYPES}:
+        return mime_type
+    return 'application/octet-stream'
+
+def is_blob_id(value):
+    return isinstance(value, str) and BLOB_ID_RE.match(value) is not None
+
+class BlobStore:
+    """Media bytes stored once per content hash, outside the data records.
+
+    A blob id is the SHA-256 of the content, so identical uploads share one
+    file. Every record that points at a blob holds one reference; the file
+    is removed when the last reference is released. The index
+    (id -> size, MIME type, refcount) is persisted through a Journal.
+    """
+
+    def __init__(self, root, journal):
+        self.root = os.path.abspath(root)
+        self.journal = journal
+        self._lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+        self.index = journal.load({'blobs': {}})['blobs']
+        journal.start(lambda: {'blobs': self.index})
+
+    def path(self, blob_id):
+        # Two-level fan-out keeps directories small
+        return os.path.join(self.root, blob_id[:2], blob_id)
+
+    def get(self, blob_id):
+        """Index entry {'size', 'type', 'refs'} or None"""
+        if not is_blob_id(blob_id):
+            return None
+        return self.index.get(blob_id)
+
+    def _write(self, blob_id, data):
+        path = self.path(blob_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def put(self, data, mime_type):
+        """Store bytes (or add a reference to identical ones); returns the blob id"""
+        blob_id = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            entry = self.index.get(blob_id)
+            if entry is None:
+                self._write(blob_id, data)
+                entry = {'size': len(data), 'type': mime_type, 'refs': 0}
+            entry = dict(entry, refs=entry['refs'] + 1)
+            self.index[blob_id] = entry
+            self.journal.set('blobs', blob_id, entry)
+        return blob_id
+
+    def release(self, blob_id):
+        """Drop one reference; the file goes away with the last one"""
+        if not is_blob_id(blob_id):
+            return
+        with self._lock:
+            entry = self.index.get(blob_id)
+            if entry is None:
+                return
+            if entry['refs'] > 1:
+                entry = dict(entry, refs=entry['refs'] - 1)
+                self.index[blob_id] = entry
+                self.journal.set('blobs', blob_id, entry)
+                return
+            del self.index[blob_id]
+            self.journal.delete('blobs', blob_id)
+            try:
+                os.remove(self.path(blob_id))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self.journal.close()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Cluster Module
+Presence shared between workers, cluster-wide events and an in-process
+stand-in for the Socket.IO message queue
+"""
+
+import json
+import queue
+import threading
+import time
+import uuid
+
+import socketio
+
+try:
+    import redis
+except ImportError:  # only needed for a redis:// presence URL
+    redis = None
+
+# ==================== SOCKET.IO MESSAGE QUEUE ====================
+
+class LocalManager(socketio.PubSubManager):
+    """In-process pub/sub client manager.
+
+    Emits take the same publish -> listener -> deliver path as with a real
+    message queue, but everything stays inside this process. Used for
+    tests and single-process runs of the multi-worker code path.
+    """
+    name = 'local'
+
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = queue.Queue()
+
+    def initialize(self):
+        socketio.BaseManager.initialize(self)
+        if not self.write_only:
+            # A daemon thread: a process using the stand-in must still exit
+            self.thread = threading.Thread(target=self._thread, name='socketio-local-queue',
+                                           daemon=True)
+            self.thread.start()
+
+    def _publish(self, data):
+        self.queue.put(data)
+
+    def _listen(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            yield data
+
+    def close(self):
+        """Stop the listener thread"""
+        self.queue.put(None)
+
+# ==================== PRESENCE ====================
+# Both implementations map username -> sid of the user's socket, support
+# the dict operations the handlers use (`in`, [], del, items()) and carry
+# cluster-wide events (publish/subscribe) such as session revocation and
+# counters (e.g. the version of a room's member list).
+
+class LocalPresence(dict):
+    """Single-process presence: a dict, events are delivered synchronously"""
+
+    def __init__(self):
+        super().__init__()
+        self._handlers = {}
+        self._versions = {}
+        self._versions_lock = threading.Lock()
+
+    def online(self, usernames):
+        """The subset of `usernames` that have a connected socket"""
+        return {u for u in usernames if u in self}
+
+    def version(self, name):
+        return self._versions.get(name, 0)
+
+    def next_version(self, name):
+        """Increment a counter; returns the new value"""
+        with self._versions_lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+            return self._versions[name]
+
+    def subscribe(self, event, handler):
+        self._handlers.setdefault(event, []).append(handler)
+
+    def publish(self, event, data):
+        for handler in self._handlers.get(event, ()):
+            handler(data)
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+class RedisPresence:
+    """Presence in a Redis hash, shared by every worker and host.
+
+    Each entry remembers which worker owns the socket. Workers refresh a
+    heartbeat key; entries of a worker whose heartbeat expired (crash,
+    kill -9) are treated as offline and cleaned up lazily.
+    """
+
+    def __init__(self, url, prefix='echoroom', heartbeat_interval=10):
+        if redis is None:
+            raise RuntimeError("redis is required for a Redis presence URL "
+                               "(pip install redis)")
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.heartbeat_interval = heartbeat_interval
+
+        self.key = f"{prefix}:presence"          # username -> "worker sid"
+        self.versions_key = f"{prefix}:versions"  # counter name -> value
+        self.worker_prefix = f"{prefix}:worker:"  # heartbeat keys
+        self.channel = f"{prefix}:events"
+
+        self._handlers = {}
+        self._local = set()   # usernames whose socket lives on this worker
+        self._live = {}       # worker_id -> monotonic time it was seen alive
+        self._stopped = threading.Event()
+        self._threads = []
+
+    # ==================== WORKER LIVENESS ====================
+
+    def _beat(self):
+        self.redis.set(self.worker_prefix + self.worker_id, 1,
+                       ex=self.heartbeat_interval * 3)
+
+    def _is_live(self, worker_id):
+        if worker_id == self.worker_id:
+            return True
+        seen = self._live.get(worker_id)
+        if seen is not None and time.monotonic() - seen < self.heartbeat_interval:
+            return True
+        if self.redis.exists(self.worker_prefix + worker_id):
+            self._live[worker_id] = time.monotonic()
+            return True
+        self._live.pop(worker_id, None)
+        return False
+
+    def _decode(self, username, value):
+        """Stored value -> sid, or None if the owning worker is gone"""
+        if value is None:
+            return None
+        worker_id, sid = value.split(' ', 1)
+        if not self._is_live(worker_id):
+            self.redis.hdel(self.key, username)
+            return None
+        return sid
+
+    # ==================== DICT INTERFACE ====================
+
+    def __setitem__(self, username, sid):
+        self.redis.hset(self.key, username, f"{self.worker_id} {sid}")
+        self._local.add(username)
+
+    def __getitem__(self, username):
+        sid = self._decode(username, self.redis.hget(self.key, username))
+        if sid is None:
+            raise KeyError(username)
+        return sid
+
+    def __delitem__(self, username):
+        self.redis.hdel(self.key, username)
+        self._local.discard(username)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def get(self, username, default=None):
+        try:
+            return self[username]
+        except KeyError:
+            return default
+
+    def items(self):
+        entries = []
+        for username, value in self.redis.hgetall(self.key).items():
+            sid = self._decode(username, value)
+            if sid is not None:
+                entries.append((username, sid))
+        return entries
+
+    def online(self, usernames):
+        """The subset of `usernames` that have a connected socket (one round trip)"""
+        usernames = list(usernames)
+        if not usernames:
+            return set()
+        values = self.redis.hmget(self.key, usernames)
+        return {u for u, v in zip(usernames, values) if self._decode(u, v) is not None}
+
+    # ==================== COUNTERS ====================
+
+    def version(self, name):
+        return int(self.redis.hget(self.versions_key, name) or 0)
+
+    def next_version(self, name):
+        """Increment a cluster-wide counter; returns the new value"""
+        return self.redis.hincrby(self.versions_key, name, 1)
+
+    # ==================== CLUSTER EVENTS ====================
+
+    def subscribe(self, event, handler):
+        self._handlers.setdefault(event, []).append(handler)
+
+    def publish(self, event, data):
+        """Deliver `event` to every worker, this one included"""
+        self.redis.publish(self.channel, json.dumps({'event': event, 'data': data}))
+
+    def _listen_loop(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        while not self._stopped.is_set():
+            message = pubsub.get_message(timeout=1.0)
+            if not message:
+                continue
+            try:
+                payload = json.loads(message['data'])
+                for handler in self._handlers.get(payload['event'], ()):
+                    handler(payload['data'])
+            except Exception as e:
+                print(f"❌ Error handling cluster event: {e}")
+        pubsub.close()
+
+    def _heartbeat_loop(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self._beat()
+            except Exception as e:
+                print(f"❌ Error refreshing presence heartbeat: {e}")
+
+    def start(self):
+        self._beat()
+        for target, name in ((self._listen_loop, 'presence-events'),
+                             (self._heartbeat_loop, 'presence-heartbeat')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Mark this worker's users offline and stop the background threads"""
+        self._stopped.set()
+        try:
+            for username in list(self._local):
+                value = self.redis.hget(self.key, username)
+                if value and value.startswith(self.worker_id + ' '):
+                    self.redis.hdel(self.key, username)
+            self.redis.delete(self.worker_prefix + self.worker_id)
+        except Exception as e:
+            print(f"❌ Error clearing presence on shutdown: {e}")
+        for thread in self._threads:
+            thread.join(timeout=2)
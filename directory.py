@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Room Directory Module
+Searchable, sortable and paginated index of room summaries
+"""
+
+import base64
+import bisect
+import heapq
+import json
+import threading
+from datetime import datetime
+
+from search import tokenize
+
+def room_summary(room):
+    """What the room list shows of a room (no member arrays)"""
+    return {
+        'id': room['id'],
+        'name': room.get('name'),
+        'description': room.get('description', ''),
+        'type': room.get('type', 'public'),
+        'creator': room.get('creator'),
+        'created_at': room.get('created_at'),
+        'member_count': len(room.get('members', []))
+    }
+
+def room_audience(room):
+    """Usernames allowed to see a private room; None for a room everyone sees"""
+    if room.get('type') != 'private':
+        return None
+    audience = {room.get('creator'), *room.get('members', []), *room.get('invited', [])}
+    audience.discard(None)
+    return audience
+
+def timestamp_seconds(value):
+    """Epoch seconds of an ISO timestamp; 0 if it cannot be read"""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+def name_key(name):
+    """Room names are matched the way message search matches text"""
+    return ' '.join(tokenize(name or ''))
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# ==================== SORT ORDERS ====================
+# Every order ends in the room id, so keys are unique and a page cursor
+# (the key of the last room served) says exactly where the next page starts,
+# even if rooms are added or removed in between.
+
+SORT_KEYS = {
+    'members': lambda entry: (-entry.summary['member_count'], entry.key, entry.summary['id']),
+    'activity': lambda entry: (-entry.activity, entry.key, entry.summary['id']),
+    'name': lambda entry: (entry.key, entry.summary['id']),
+}
+
+# What each position of a sort key holds, for checking cursors
+SORT_KEY_TYPES = {
+    'members': (int, str, str),
+    'activity': ((int, float), str, str),
+    'name': (str, str),
+}
+
+def encode_cursor(sort, key):
+    raw = json.dumps([sort, *key], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(sort, cursor):
+    """Sort key a cursor points at; ValueError if it is not one of ours"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or not values or values[0] != sort:
+        raise ValueError('Cursor belongs to another sort order')
+    key = tuple(values[1:])
+    types = SORT_KEY_TYPES[sort]
+    if len(key) != len(types) or not all(isinstance(v, t) for v, t in zip(key, types)):
+        raise ValueError('Invalid cursor')
+    return key
+
+class Entry:
+    __slots__ = ('summary', 'audience', 'key', 'activity')
+
+    def __init__(self, summary, audience, activity):
+        self.summary = summary
+        self.audience = audience
+        self.key = name_key(summary['name'])
+        self.activity = activity
+
+class RoomDirectory:
+    """In-memory directory of every room, for browsing and search.
+
+    Names are indexed two ways: a sorted list of (word, room id) answers
+    word-prefix queries shorter than three characters by bisection, and a
+    trigram -> room ids map narrows longer queries to the few rooms that
+    can contain them as a substring. `version` is the newest cluster-wide
+    version of a change applied here (see applied()), so HTTP responses
+    can be tagged and revalidated cheaply. Activity changes finer than
+    `activity_resolution` seconds are not recorded.
+    """
+
+    def __init__(self, activity_resolution=60):
+        self.activity_resolution = activity_resolution
+        self.version = 0
+
+        self._entries = {}    # room id -> Entry
+        self._words = []      # sorted (word, room id)
+        self._trigrams = {}   # trigram -> set of room ids
+        self._lock = threading.RLock()
+
+    # ---------- Index ----------
+
+    def _index(self, entry):
+        room_id = entry.summary['id']
+        for word in set(entry.key.split()):
+            bisect.insort(self._words, (word, room_id))
+        for trigram in trigrams(entry.key):
+            self._trigrams.setdefault(trigram, set()).add(room_id)
+
+    def _unindex(self, entry):
+        room_id = entry.summary['id']
+        for word in set(entry.key.split()):
+            position = bisect.bisect_left(self._words, (word, room_id))
+            if position < len(self._words) and self._words[position] == (word, room_id):
+                del self._words[position]
+        for trigram in trigrams(entry.key):
+            ids = self._trigrams.get(trigram)
+            if ids is not None:
+                ids.discard(room_id)
+                if not ids:
+                    del self._trigrams[trigram]
+
+    def put(self, room, activity=None):
+        """Add or refresh a room; keeps its known activity unless given"""
+        with self._lock:
+            old = self._entries.get(room['id'])
+            if activity is None:
+                activity = old.activity if old else timestamp_seconds(room.get('created_at'))
+            entry = Entry(room_summary(room), room_audience(room), activity)
+            if old is not None:
+                self._unindex(old)
+            self._entries[room['id']] = entry
+            self._index(entry)
+
+    def remove(self, room_id):
+        with self._lock:
+            entry = self._entries.pop(room_id, None)
+            if entry is not None:
+                self._unindex(entry)
+
+    def touch(self, room_id, activity):
+        """Record a message in a room; True if the recorded activity moved"""
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is None or activity - entry.activity < self.activity_resolution:
+                return False
+            entry.activity = activity
+            return True
+
+    def is_stale(self, room_id, activity):
+        """Would touch() record this activity?"""
+        with self._lock:
+            entry = self._entries.get(room_id)
+            return entry is not None and activity - entry.activity >= self.activity_resolution
+
+    def applied(self, version):
+        """Note that the change numbered `version` (cluster-wide) is in the index"""
+        with self._lock:
+            self.version = max(self.version, version)
+
+    def build(self, rooms, last_activity):
+        """Index existing rooms; `last_activity(room)` gives epoch seconds or None"""
+        for room in rooms:
+            self.put(room, last_activity(room))
+        return len(self._entries)
+
+    # ---------- Queries ----------
+
+    def _matches(self, query):
+        """Room ids whose name contains `query` (already normalized)"""
+        if len(query) < 3:
+            start = bisect.bisect_left(self._words, (query,))
+            ids = set()
+            # Index from `start`: islice would walk the skipped words one by one
+            for i in range(start, len(self._words)):
+                word, room_id = self._words[i]
+                if not word.startswith(query):
+                    break
+                ids.add(room_id)
+            return ids
+        postings = sorted((self._trigrams.get(t, set()) for t in trigrams(query)), key=len)
+        ids = set(postings[0]).intersection(*postings[1:])
+        return {room_id for room_id in ids if query in self._entries[room_id].key}
+
+    def browse(self, username=None, query='', sort='members', cursor=None, limit=20):
+        """One page of the rooms `username` can see (None: public rooms only).
+
+        Returns (rooms, next_cursor); next_cursor is None on the last page.
+        Each room is its summary plus 'last_activity' (epoch seconds).
+        Raises ValueError for an unknown sort order or a bad cursor.
+        """
+        sort_key = SORT_KEYS.get(sort)
+        if sort_key is None:
+            raise ValueError(f'Unknown sort order: {sort}')
+        after = decode_cursor(sort, cursor) if cursor else None
+        query = name_key(query)
+
+        with self._lock:
+            if query:
+                entries = [self._entries[room_id] for room_id in self._matches(query)]
+            else:
+                entries = list(self._entries.values())
+
+            visible = (entry for entry in entries
+                       if entry.audience is None or username in entry.audience)
+            if after is not None:
+                visible = (entry for entry in visible if sort_key(entry) > after)
+            page = heapq.nsmallest(limit + 1, visible, key=sort_key)
+
+            rooms = [dict(entry.summary, last_activity=entry.activity) for entry in page[:limit]]
+            next_cursor = encode_cursor(sort, sort_key(page[limit - 1])) if len(page) > limit else None
+        return rooms, next_cursor
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Message History Module
+Bounded per-conversation message logs with an id index and cursor pages
+"""
+
+from collections import OrderedDict
+
+class MessageLog:
+    """One conversation's kept history: a fixed-capacity ring buffer.
+
+    Every message gets an increasing sequence number. `slots` maps
+    sequence number -> message in arrival order and `by_id` maps message
+    id -> sequence number, so append (including evicting the oldest
+    message when full), lookup and delete by id are all O(1). A deleted
+    message simply leaves a gap in the numbering; reads step over gaps.
+    """
+
+    def __init__(self, maxlen, messages=()):
+        self.maxlen = maxlen
+        self.slots = OrderedDict()  # seq -> message, oldest first
+        self.by_id = {}             # message id -> seq
+        self.first_seq = 0          # no live message has a lower seq
+        self.next_seq = 0
+        for message in messages:
+            self.append(message)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __iter__(self):
+        return iter(self.slots.values())
+
+    def to_list(self):
+        return list(self.slots.values())
+
+    def _unindex(self, message, seq):
+        message_id = message.get('id')
+        # A later message may reuse the id; only drop our own entry
+        if message_id is not None and self.by_id.get(message_id) == seq:
+            del self.by_id[message_id]
+
+    def append(self, message):
+        """Add the newest message; returns the messages pushed out ([] or [oldest])"""
+        evicted = []
+        if self.maxlen is not None and len(self.slots) >= self.maxlen:
+            seq, oldest = self.slots.popitem(last=False)
+            self._unindex(oldest, seq)
+            self.first_seq = seq + 1
+            evicted.append(oldest)
+
+        seq = self.next_seq
+        self.next_seq += 1
+        self.slots[seq] = message
+        if message.get('id') is not None:
+            self.by_id[message['id']] = seq
+        return evicted
+
+    def __contains__(self, message_id):
+        return message_id in self.by_id
+
+    def pop_oldest(self, count):
+        """Remove and return the `count` oldest messages, oldest first"""
+        popped = []
+        while self.slots and len(popped) < count:
+            seq, message = self.slots.popitem(last=False)
+            self._unindex(message, seq)
+            self.first_seq = seq + 1
+            popped.append(message)
+        return popped
+
+    def get(self, message_id):
+        seq = self.by_id.get(message_id)
+        return None if seq is None else self.slots.get(seq)
+
+    def remove(self, message_id):
+        """Delete a message; returns it, or None if it is not in the log"""
+        seq = self.by_id.pop(message_id, None)
+        if seq is None:
+            return None
+        message = self.slots.pop(seq, None)
+        # Keep the walk range tight when the oldest messages go
+        while self.first_seq < self.next_seq and self.first_seq not in self.slots:
+            self.first_seq += 1
+        return message
+
+    # ==================== READS ====================
+    # Reads walk sequence numbers instead of iterating `slots`, so they
+    # never trip over a handler thread appending at the same time.
+
+    def _walk(self, start, step, count):
+        """Up to `count` messages from seq `start` on, in walking order"""
+        found = []
+        seq = start
+        while len(found) < count and self.first_seq <= seq < self.next_seq:
+            message = self.slots.get(seq)
+            if message is not None:
+                found.append(message)
+            seq += step
+        return found
+
+    def head(self, limit):
+        """Oldest `limit` messages, oldest first"""
+        return self._walk(self.first_seq, 1, limit)
+
+    def tail(self, limit):
+        """Newest `limit` messages, oldest first"""
+        return self._walk(self.next_seq - 1, -1, limit)[::-1]
+
+    def page(self, limit, before=None, after=None):
+        """Cursor page (see storage.py): (messages oldest first, has_more)"""
+        cursor = before or after
+        if cursor is None:
+            seq, step = self.next_seq - 1, -1
+        else:
+            seq = self.by_id.get(cursor)
+            if seq is None:
+                return [], False
+            seq, step = (seq - 1, -1) if before else (seq + 1, 1)
+
+        # One extra message tells whether the history goes on past the page
+        messages = self._walk(seq, step, limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        return (messages[::-1] if step < 0 else messages), has_more
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Journal Storage Module
+Append-only write-ahead log (WAL) with periodic snapshot compaction
+"""
+
+import json
+import os
+import glob
+import threading
+import time
+from collections import OrderedDict
+
+# ==================== RECORD FORMAT ====================
+# Each WAL line is a compact JSON array:
+#   ["s", collection, key, value]          -> collection[key] = value
+#   ["d", collection, key]                 -> del collection[key]
+#   ["a", collection, key, item, limit]    -> collection[key].append(item), keep last `limit`
+#   ["r", collection, key, item_id]        -> drop the item with this id from collection[key]
+#   ["t", collection, key, item_id]        -> drop the items up to and including this id
+#   ["sa", collection, key, field, value]  -> collection[key][field] gains value (set-like list)
+#   ["sd", collection, key, field, value]  -> collection[key][field] loses value
+
+OP_SET = 's'
+OP_DELETE = 'd'
+OP_APPEND = 'a'
+OP_REMOVE = 'r'
+OP_TRIM = 't'
+OP_SET_ADD = 'sa'
+OP_SET_DISCARD = 'sd'
+
+
+# ==================== DURABILITY MODES ====================
+# sync:    write + fsync inside the calling handler (no loss window, slowest)
+# batched: writer thread group-commits with fsync at most once per flush_interval
+# async:   writer thread writes as soon as it wakes, no fsync (OS page cache only)
+
+DURABILITY_SYNC = 'sync'
+DURABILITY_BATCHED = 'batched'
+DURABILITY_ASYNC = 'async'
+DURABILITY_MODES = (DURABILITY_SYNC, DURABILITY_BATCHED, DURABILITY_ASYNC)
+
+class Journal:
+    """Write-ahead log for the in-memory collections.
+
+    Mutations are appended to a WAL segment as they happen, so persisting
+    one chat message costs O(message size). Outside of sync mode the
+    handlers only queue records; a writer thread coalesces them and does
+    the I/O. A second thread folds the WAL into a fresh snapshot and drops
+    the old segments.
+    """
+
+    def __init__(self, snapshot_file, compact_interval=300, compact_threshold=5000,
+                 encoder=None, object_hook=None, durability=DURABILITY_BATCHED,
+                 flush_interval=0.05):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+
+        self.snapshot_file = snapshot_file
+        self.compact_interval = compact_interval
+        self.compact_threshold = compact_threshold
+        self.encoder = encoder
+        self.object_hook = object_hook
+        self.durability = durability
+        self.flush_interval = flush_interval
+
+        # _lock guards the segment file; _pending_lock guards the write queue
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._pending_seq = 0
+        self._dirty = threading.Event()
+        self._writer = None
+        self._last_flush = 0.0
+
+        self._compact_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._get_data = None
+
+        self._segment = 0
+        self._file = None
+        self._records_since_compact = 0
+
+    # ==================== SEGMENTS ====================
+
+    def _segment_path(self, segment):
+        return f"{self.snapshot_file}.wal.{segment:08d}"
+
+    def _list_segments(self):
+        segments = []
+        for path in glob.glob(glob.escape(self.snapshot_file) + '.wal.*'):
+            suffix = path.rsplit('.', 1)[-1]
+            if suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+
+    def _open_segment(self, segment):
+        self._segment = segment
+        self._file = open(self._segment_path(segment), 'a', encoding='utf-8')
+
+    def _rotate(self):
+        """Close the current segment and start the next one (caller holds _lock)"""
+        if self._file:
+            self._file.close()
+        self._open_segment(self._segment + 1)
+
+    # ==================== LOAD / REPLAY ====================
+
+    def load(self, default_data):
+        """Load the snapshot and replay every WAL segment written after it"""
+        data, start_segment, segments, replayed = self._read(default_data, cleanup=True)
+
+        if replayed:
+            print(f"📜 Replayed {replayed} journal records")
+
+        # Always append to a fresh segment: the last one may end in a torn line.
+        last_segment = segments[-1] if segments else start_segment - 1
+        self._open_segment(max(last_segment + 1, start_segment))
+        self._records_since_compact = replayed
+        return data
+
+    def read(self, default_data):
+        """Snapshot + replayed WAL, without touching any file (for exports)"""
+        return self._read(default_data, cleanup=False)[0]
+
+    def _read(self, default_data, cleanup):
+        data = default_data
+        start_segment = 0
+        segments = self._list_segments()
+
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                data = json.load(f, object_hook=self.object_hook)
+            start_segment = data.pop('_journal', {}).get('segment', 0)
+            for key, value in default_data.items():
+                data.setdefault(key, value)
+        elif not segments and cleanup:
+            print(f"📁 Creating new data file: {self.snapshot_file}")
+
+        replayed = 0
+        seen_ids = {}
+        for segment in segments:
+            if segment < start_segment:
+                # Already folded into the snapshot; left over from a crash
+                # between writing the snapshot and deleting old segments.
+                if cleanup:
+                    os.remove(self._segment_path(segment))
+                continue
+            replayed += self._replay_segment(data, segment, seen_ids)
+
+        return data, start_segment, segments, replayed
+
+    def _replay_segment(self, data, segment, seen_ids):
+        count = 0
+        with open(self._segment_path(segment), 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line, object_hook=self.object_hook)
+                except ValueError:
+                    # Torn write at the tail of a segment after a crash
+                    print(f"⚠️ Skipping corrupt journal record in segment {segment}")
+                    continue
+                self._apply(data, record, seen_ids)
+                count += 1
+        return count
+
+    @staticmethod
+    def _apply(data, record, seen_ids):
+        """Apply one record. Appends are idempotent by item id: a record can
+        land in the segment *after* the snapshot that already contains it."""
+        op, collection, key = record[0], record[1], record[2]
+        target = data.setdefault(collection, {})
+
+        if op == OP_SET:
+            target[key] = record[3]
+            seen_ids.pop((collection, key), None)
+        elif op == OP_DELETE:
+            target.pop(key, None)
+            seen_ids.pop((collection, key), None)
+        elif op == OP_APPEND:
+            item, limit = record[3], record[4]
+            items = target.setdefault(key, [])
+            item_id = item.get('id') if isinstance(item, dict) else None
+            if item_id is not None:
+                ids = seen_ids.get((collection, key))
+                if ids is None:
+                    ids = seen_ids[(collection, key)] = {
+                        m.get('id') for m in items if isinstance(m, dict)}
+                if item_id in ids:
+                    return
+                ids.add(item_id)
+            items.append(item)
+            if limit and len(items) > limit:
+                del items[:-limit]
+        elif op == OP_REMOVE:
+            item_id = record[3]
+            items = target.get(key)
+            if items:
+                target[key] = [m for m in items
+                               if not (isinstance(m, dict) and m.get('id') == item_id)]
+            ids = seen_ids.get((collection, key))
+            if ids is not None:
+                ids.discard(item_id)
+        elif op == OP_TRIM:
+            # No-op when the item is gone already (e.g. trimmed in the snapshot)
+            item_id = record[3]
+            items = target.get(key) or []
+            for i, m in enumerate(items):
+                if isinstance(m, dict) and m.get('id') == item_id:
+                    del items[:i + 1]
+                    break
+        elif op in (OP_SET_ADD, OP_SET_DISCARD):
+            # No-op when the record is gone (deleted later in the same segment)
+            field, value = record[3], record[4]
+            entry = target.get(key)
+            if not isinstance(entry, dict):
+                return
+            values = entry.setdefault(field, [])
+            if op == OP_SET_ADD and value not in values:
+                values.append(value)
+            elif op == OP_SET_DISCARD and value in values:
+                values.remove(value)
+
+    # ==================== WRITES ====================
+
+    def _encode(self, record):
+        # Handler threads may still be mutating the value; retry on the
+        # rare "changed size during iteration" rather than locking them out.
+        for attempt in range(5):
+            try:
+                return json.dumps(record, separators=(',', ':'), cls=self.encoder)
+            except RuntimeError:
+                time.sleep(0.001 * (attempt + 1))
+        return json.dumps(record, separators=(',', ':'), cls=self.encoder)
+
+    def _write_lines(self, lines, fsync):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(''.join(line + '\n' for line in lines))
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+            self._records_since_compact += len(lines)
+            if self._records_since_compact >= self.compact_threshold:
+                self._wake.set()
+
+    def _submit(self, slot, record):
+        """Write now (sync mode) or queue for the writer thread.
+
+        Records sharing a slot supersede each other: a queued `set` that is
+        overwritten before the writer runs is written once, with the value
+        current at flush time.
+        """
+        if self.durability == DURABILITY_SYNC or self._writer is None:
+            self._write_lines([self._encode(record)], fsync=self.durability == DURABILITY_SYNC)
+            return
+
+        with self._pending_lock:
+            if slot is None:
+                self._pending_seq += 1
+                slot = self._pending_seq
+            else:
+                self._pending.pop(slot, None)
+            self._pending[slot] = record
+        self._dirty.set()
+
+    def set(self, collection, key, value):
+        """Record collection[key] = value"""
+        self._submit((collection, key), [OP_SET, collection, key, value])
+
+    def delete(self, collection, key):
+        """Record del collection[key]"""
+        self._submit((collection, key), [OP_DELETE, collection, key])
+
+    def append(self, collection, key, item, limit=None):
+        """Record collection[key].append(item), trimmed to the last `limit` items"""
+        self._submit(None, [OP_APPEND, collection, key, item, limit])
+
+    def remove(self, collection, key, item_id):
+        """Record the removal of one item (by id) from collection[key]"""
+        self._submit(None, [OP_REMOVE, collection, key, item_id])
+
+    def trim(self, collection, key, item_id):
+        """Record dropping collection[key]'s items up to and including `item_id`"""
+        self._submit(None, [OP_TRIM, collection, key, item_id])
+
+    def set_add(self, collection, key, field, value):
+        """Record adding `value` to the set-like list collection[key][field]"""
+        self._submit(None, [OP_SET_ADD, collection, key, field, value])
+
+    def set_discard(self, collection, key, field, value):
+        """Record removing `value` from the set-like list collection[key][field]"""
+        self._submit(None, [OP_SET_DISCARD, collection, key, field, value])
+
+    def flush(self):
+        """Write every queued record now"""
+        with self._pending_lock:
+            records = list(self._pending.values())
+            self._pending.clear()
+            self._dirty.clear()
+        if records:
+            self._write_lines([self._encode(r) for r in records],
+                              fsync=self.durability != DURABILITY_ASYNC)
+        self._last_flush = time.monotonic()
+        return len(records)
+
+    def _writer_loop(self):
+        while not self._stopped.is_set():
+            self._dirty.wait()
+            if self._stopped.is_set():
+                break
+            if self.durability == DURABILITY_BATCHED:
+                # Let the burst accumulate: at most one flush per interval
+                delay = self._last_flush + self.flush_interval - time.monotonic()
+                if delay > 0:
+                    self._stopped.wait(delay)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Error writing journal: {e}")
+
+    # ==================== COMPACTION ====================
+
+    def _serialize(self, data, segment):
+        snapshot = dict(data)
+        snapshot['_journal'] = {'segment': segment}
+        # Handler threads mutate the dicts while we serialize; retry on the
+        # rare "changed size during iteration" instead of taking a global lock.
+        for attempt in range(5):
+            try:
+                return json.dumps(snapshot, separators=(',', ':'), cls=self.encoder)
+            except RuntimeError:
+                time.sleep(0.01 * (attempt + 1))
+        return json.dumps(snapshot, separators=(',', ':'), cls=self.encoder)
+
+    def compact(self, data):
+        """Write a full snapshot of `data` and drop the WAL segments it covers"""
+        with self._compact_lock:
+            self.flush()
+            with self._lock:
+                old_segment = self._segment
+                self._rotate()
+                self._records_since_compact = 0
+            # Any record in the new segment is either already in `data`
+            # (replay is idempotent) or strictly newer than it.
+            payload = self._serialize(data, old_segment + 1)
+
+            tmp_file = self.snapshot_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+
+            for segment in self._list_segments():
+                if segment <= old_segment:
+                    os.remove(self._segment_path(segment))
+
+        print(f"💾 Data compacted to {self.snapshot_file}")
+
+    def _compaction_loop(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.compact_interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            if self._records_since_compact == 0:
+                continue
+            try:
+                self.compact(self._get_data())
+            except Exception as e:
+                print(f"❌ Error compacting journal: {e}")
+
+    def start(self, get_data):
+        """Start the writer and compaction threads; get_data() returns the live collections"""
+        self._get_data = get_data
+        if self._writer is None and self.durability != DURABILITY_SYNC:
+            self._writer = threading.Thread(target=self._writer_loop,
+                                            name='journal-writer', daemon=True)
+            self._writer.start()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._compaction_loop,
+                                            name='journal-compactor', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop the background threads, flush what is queued and close the segment"""
+        self._stopped.set()
+        self._wake.set()
+        self._dirty.set()
+        if self._writer is not None:
+            self._writer.join(timeout=5)
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+        try:
+            pending = self.flush()
+            if pending:
+                print(f"💾 Flushed {pending} queued journal records on shutdown")
+        except Exception as e:
+            print(f"❌ Error flushing journal on shutdown: {e}")
+        with self._lock:
+            if self._file:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Mail Queue Module
+Background outbound email over a persistent SMTP connection
+"""
+
+import heapq
+import json
+import smtplib
+import ssl
+import threading
+import time
+from datetime import datetime
+
+# ==================== TRANSPORTS ====================
+
+class SmtpTransport:
+    """STARTTLS + login once, then reuse the connection for every message"""
+
+    def __init__(self, host, port, username, password, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._server = None
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls(context=ssl.create_default_context())
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+
+    def is_connected(self):
+        if self._server is None:
+            return False
+        try:
+            return self._server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def send(self, sender, to_email, message):
+        if not self.is_connected():
+            self.close()
+            self.connect()
+        self._server.sendmail(sender, to_email, message)
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                self._server.close()
+            self._server = None
+
+class SinkTransport:
+    """Local stand-in for an SMTP server: keeps (and optionally logs) messages"""
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def send(self, sender, to_email, message):
+        record = {'from': sender, 'to': to_email, 'message': message,
+                  'sent_at': datetime.now().isoformat()}
+        with self._lock:
+            self.messages.append(record)
+            if self.log_file:
+                with open(self.log_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        pass
+
+# ==================== QUEUE ====================
+
+def is_permanent_failure(error):
+    """5xx replies will not succeed on retry"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    code = getattr(error, 'smtp_code', None)
+    return code is not None and 500 <= code < 600
+
+class MailQueue:
+    """Sends queued emails from a background thread.
+
+    Callers only enqueue. The worker drains up to `batch_size` due messages
+    per pass over one connection, retries transient failures with
+    exponential backoff and appends messages it gives up on to the
+    dead-letter file (one JSON object per line).
+    """
+
+    def __init__(self, transport, sender, dead_letter_file='echoroom_mail_dead.jsonl',
+                 batch_size=20, max_attempts=5, backoff=2.0, max_backoff=300,
+                 idle_timeout=60):
+        self.transport = transport
+        self.sender = sender
+        self.dead_letter_file = dead_letter_file
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (due, seq, item)
+        self._seq = 0
+        self._stopped = False
+        self._thread = None
+
+    def send(self, to_email, message, kind='email'):
+        """Queue a message (a full RFC 822 string); returns immediately"""
+        self._push(time.monotonic(), {'to': to_email, 'message': message,
+                                      'kind': kind, 'attempts': 0})
+
+    def _push(self, due, item):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._queue, (due, self._seq, item))
+            self._cond.notify()
+
+    def _next_batch(self):
+        """Block until messages are due; [] after an idle timeout, None once
+        stopped and drained"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._queue and (self._queue[0][0] <= now or self._stopped):
+                    batch = []
+                    while self._queue and len(batch) < self.batch_size and \
+                            (self._queue[0][0] <= now or self._stopped):
+                        batch.append(heapq.heappop(self._queue)[2])
+                    return batch
+                if self._stopped:
+                    return None
+                timeout = self._queue[0][0] - now if self._queue else self.idle_timeout
+                if not self._cond.wait(timeout) and not self._queue:
+                    return []
+
+    def _deliver(self, item):
+        try:
+            self.transport.send(self.sender, item['to'], item['message'])
+            print(f"📧 {item['kind'].capitalize()} sent to {item['to']}")
+        except Exception as e:
+            item['attempts'] += 1
+            item['error'] = str(e)
+            if is_permanent_failure(e):
+                self._dead_letter(item)
+                return
+            # Transient: the connection may be broken, start over next time
+            self.transport.close()
+            if item['attempts'] >= self.max_attempts or self._stopped:
+                self._dead_letter(item)
+                return
+            delay = min(self.max_backoff, self.backoff * 2 ** (item['attempts'] - 1))
+            print(f"⚠️ Email to {item['to']} failed ({e}), retrying in {delay:g}s")
+            self._push(time.monotonic() + delay, item)
+
+    def _dead_letter(self, item):
+        print(f"❌ Giving up on email to {item['to']}: {item.get('error')}")
+        item['failed_at'] = datetime.now().isoformat()
+        try:
+            with open(self.dead_letter_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(item) + '\n')
+        except Exception as e:
+            print(f"❌ Error writing mail dead-letter file: {e}")
+
+    def _worker_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            if not batch:
+                # Idle: don't hold the SMTP connection open forever
+                self.transport.close()
+            for item in batch:
+                self._deliver(item)
+        self.transport.close()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker_loop,
+                                            name='mail-queue', daemon=True)
+            self._thread.start()
+
+    def close(self, timeout=10):
+        """Try to send what is queued; whatever fails goes to the dead-letter file"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Static Pages Module
+Pre-rendered, pre-compressed page and asset responses with HTTP caching
+"""
+
+import gzip
+import hashlib
+from datetime import datetime, timezone
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped without it
+    brotli = None
+
+# Fingerprinted assets never change under the same URL
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# The page itself is revalidated on every load (cheap 304 via ETag)
+REVALIDATE = 'no-cache'
+
+class Asset:
+    """One static body, compressed once, served with ETag/Last-Modified"""
+
+    def __init__(self, body, mimetype, last_modified):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()
+        # HTTP dates have one-second resolution
+        self.last_modified = datetime.fromtimestamp(int(last_modified), timezone.utc)
+
+        self.variants = {'identity': body,
+                         'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body, quality=11)
+
+    def etag(self, encoding):
+        # Each encoding is a different representation, so a different strong ETag
+        tag = self.digest[:32]
+        return tag if encoding == 'identity' else f"{tag}-{encoding}"
+
+    def _choose_encoding(self):
+        accepted = request.accept_encodings
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepted[encoding] > 0:
+                return encoding
+        return 'identity'
+
+    def _not_modified(self, etag):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        if request.if_modified_since:
+            return self.last_modified <= request.if_modified_since
+        return False
+
+    def response(self, cache_control):
+        encoding = self._choose_encoding()
+        etag = self.etag(encoding)
+
+        if self._not_modified(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.variants[encoding], mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.last_modified = self.last_modified
+        response.headers['Cache-Control'] = cache_control
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+# ==================== PAGE SPLITTING ====================
+
+def _extract(html, open_tag, close_tag):
+    """Cut the first open_tag...close_tag block; returns (before, inner, after)"""
+    start = html.index(open_tag)
+    end = html.index(close_tag, start)
+    return html[:start], html[start + len(open_tag):end], html[end + len(close_tag):]
+
+def build_page(html, last_modified):
+    """Split the page's inline <style> and <script> into fingerprinted assets.
+
+    Returns (page Asset, {asset file name: Asset}). The page references the
+    assets by content hash, so they can be cached forever.
+    """
+    assets = {}
+
+    def add(body, extension, mimetype):
+        asset = Asset(body, mimetype, last_modified)
+        name = f"app.{asset.digest[:12]}.{extension}"
+        assets[name] = asset
+        return name
+
+    before, css, after = _extract(html, '<style>', '</style>')
+    css_name = add(css, 'css', 'text/css')
+    html = f'{before}<link href="/assets/{css_name}" rel="stylesheet">{after}'
+
+    before, js, after = _extract(html, '<script>', '</script>')
+    js_name = add(js, 'js', 'application/javascript')
+    html = f'{before}<script src="/assets/{js_name}"></script>{after}'
+
+    return Asset(html, 'text/html', last_modified), assets
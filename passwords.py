@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Password Hashing Module
+Salted KDF hashing (scrypt / PBKDF2) run on a bounded worker pool
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+from runtime import BlockingPool
+
+# ==================== STORED FORMAT ====================
+# password_hash holds "<algorithm>$<cost params>$<hex digest>"; the salt
+# stays in the user's 'salt' field. A bare hex digest (no '$') is a legacy
+# single-round SHA-256 record, accepted once and rehashed on login.
+
+SCRYPT = 'scrypt'
+PBKDF2 = 'pbkdf2_sha256'
+LEGACY_SHA256 = 'sha256'
+
+DEFAULT_SCRYPT_N = 2 ** 14
+DEFAULT_SCRYPT_R = 8
+DEFAULT_SCRYPT_P = 1
+DEFAULT_PBKDF2_ITERATIONS = 600000
+
+def default_workers():
+    return max(1, min(4, os.cpu_count() or 1))
+
+class ScryptHasher:
+    algorithm = SCRYPT
+
+    def __init__(self, n=DEFAULT_SCRYPT_N, r=DEFAULT_SCRYPT_R, p=DEFAULT_SCRYPT_P):
+        self.n, self.r, self.p = n, r, p
+
+    @property
+    def params(self):
+        return f"{self.n},{self.r},{self.p}"
+
+    @staticmethod
+    def derive(password, salt, params):
+        n, r, p = (int(x) for x in params.split(','))
+        # scrypt needs ~128*n*r bytes; leave headroom over OpenSSL's 32MB default
+        return hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                              maxmem=256 * n * r + 1024 * 1024).hex()
+
+class Pbkdf2Hasher:
+    algorithm = PBKDF2
+
+    def __init__(self, iterations=DEFAULT_PBKDF2_ITERATIONS):
+        self.iterations = iterations
+
+    @property
+    def params(self):
+        return str(self.iterations)
+
+    @staticmethod
+    def derive(password, salt, params):
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(),
+                                   int(params)).hex()
+
+HASHERS = {SCRYPT: ScryptHasher, PBKDF2: Pbkdf2Hasher}
+
+def parse_hash(hashed_password):
+    """Stored hash -> (algorithm, params, digest)"""
+    if '$' not in hashed_password:
+        return LEGACY_SHA256, '', hashed_password
+    algorithm, params, digest = hashed_password.split('$', 2)
+    return algorithm, params, digest
+
+class PasswordHasher:
+    """Hashes new passwords with the configured KDF and verifies any stored format.
+
+    The KDF is deliberately slow, so every hash/verify runs on a small
+    thread pool: a burst of logins queues up there instead of tying up
+    the threads that handle chat events.
+    """
+
+    def __init__(self, algorithm=SCRYPT, workers=None, **cost):
+        if algorithm not in HASHERS:
+            raise ValueError(f"Unknown password hasher: {algorithm}")
+        self.hasher = HASHERS[algorithm](**cost)
+        self.workers = workers or default_workers()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        # Created on first use (after the async mode is set up); the lock
+        # keeps a burst of first logins from each starting a pool
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = BlockingPool(self.workers, 'password-hasher')
+        return self._pool.run(fn, *args)
+
+    # ==================== HASH / VERIFY ====================
+
+    def _hash(self, password, salt):
+        digest = self.hasher.derive(password, salt, self.hasher.params)
+        return f"{self.hasher.algorithm}${self.hasher.params}${digest}"
+
+    @staticmethod
+    def _verify(password, hashed_password, salt):
+        algorithm, params, digest = parse_hash(hashed_password)
+        if algorithm == LEGACY_SHA256:
+            candidate = hashlib.sha256((password + salt).encode()).hexdigest()
+        elif algorithm in HASHERS:
+            candidate = HASHERS[algorithm].derive(password, salt, params)
+        else:
+            return False
+        return hmac.compare_digest(candidate, digest)
+
+    def hash(self, password, salt=None):
+        """Hash a password; returns (password_hash, salt)"""
+        if salt is None:
+            salt = secrets.token_hex(16)
+        return self._run(self._hash, password, salt), salt
+
+    def verify(self, password, hashed_password, salt):
+        """Check a password against any stored format (including legacy SHA-256)"""
+        if not password or not hashed_password or salt is None:
+            return False
+        return self._run(self._verify, password, hashed_password, salt)
+
+    def needs_rehash(self, hashed_password):
+        """True if the record was hashed with another algorithm or cost"""
+        algorithm, params, _ = parse_hash(hashed_password)
+        return algorithm != self.hasher.algorithm or params != self.hasher.params
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Presence Broadcast Module
+Online/offline transitions and room-list updates coalesced before they are broadcast
+"""
+
+import threading
+import time
+
+class WindowedAggregator:
+    """Base of the aggregators: a thread that calls flush() `window`
+    seconds after the first event recorded since the last flush, and
+    logs stats() every `log_interval` seconds in which they changed
+    (0: only at close)."""
+
+    name = 'aggregator'
+
+    def __init__(self, window=1.0, log_interval=0):
+        self.window = window
+        self.log_interval = log_interval
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def flush(self):
+        raise NotImplementedError
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics, pending=len(self._pending))
+
+    def describe(self, stats):
+        """One log line's worth of `stats`"""
+        raise NotImplementedError
+
+    def log_stats(self):
+        print(f"📊 {self.describe(self.stats())}")
+
+    def _loop(self):
+        logged = self.stats()
+        next_log = time.monotonic() + self.log_interval if self.log_interval else None
+        while not self._stopped.is_set():
+            timeout = None if next_log is None else max(0, next_log - time.monotonic())
+            if self._wake.wait(timeout):
+                self._wake.clear()
+                # Let the window fill up before looking at it
+                if self._stopped.wait(self.window):
+                    break
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"❌ Error broadcasting {self.name}: {e}")
+            if next_log is not None and time.monotonic() >= next_log:
+                next_log = time.monotonic() + self.log_interval
+                stats = self.stats()
+                if stats != logged:
+                    logged = stats
+                    print(f"📊 {self.describe(stats)}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name=f'{self.name}-aggregator',
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+class PresenceAggregator(WindowedAggregator):
+    """Collects online/offline transitions and sends them in batches.
+
+    Transitions are held for `window` seconds. At the end of the window
+    each user's net change is looked up: a user who went offline and came
+    back (or the other way round) inside the window is not announced at
+    all, and the remaining changes are grouped so that each affected room
+    gets one combined update through `emit_changes(room_id, changes)`.
+    `rooms_of(username)` gives the rooms a user's presence matters to.
+    """
+
+    name = 'presence'
+
+    def __init__(self, rooms_of, emit_changes, window=1.0, log_interval=0):
+        super().__init__(window, log_interval)
+        self.rooms_of = rooms_of
+        self.emit_changes = emit_changes
+
+        self._pending = {}  # username -> [online before the window, online now, events]
+
+        self.metrics = {
+            'transitions': 0,   # online/offline events recorded
+            'suppressed': 0,    # events never announced (flaps, repeats)
+            'changes': 0,       # net per-user changes announced
+            'updates': 0,       # room updates emitted
+        }
+
+    def record(self, username, online):
+        """Note that `username` just came online (True) or went offline"""
+        with self._lock:
+            self.metrics['transitions'] += 1
+            state = self._pending.get(username)
+            if state is None:
+                self._pending[username] = [not online, online, 1]
+            else:
+                state[1] = online
+                state[2] += 1
+        self._wake.set()
+
+    def flush(self):
+        """Announce everything pending now"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        by_room = {}
+        changes = suppressed = 0
+        for username, (before, now, events) in pending.items():
+            if before == now:
+                suppressed += events
+                continue
+            changes += 1
+            suppressed += events - 1
+            change = {'op': 'online' if now else 'offline', 'username': username}
+            for room_id in self.rooms_of(username):
+                by_room.setdefault(room_id, []).append(change)
+
+        for room_id, room_changes in by_room.items():
+            self.emit_changes(room_id, room_changes)
+
+        with self._lock:
+            self.metrics['suppressed'] += suppressed
+            self.metrics['changes'] += changes
+            self.metrics['updates'] += len(by_room)
+
+    def describe(self, stats):
+        return (f"Presence: {stats['transitions']} transitions, "
+                f"{stats['suppressed']} suppressed, {stats['updates']} room updates")
+
+    def close(self):
+        super().close()
+        self.log_stats()
+
+class RoomUpdateAggregator(WindowedAggregator):
+    """Collects rooms whose member count changed and announces each once.
+
+    A burst of joins and leaves inside the `window` becomes a single
+    `emit_update(room_id)` at the end of it, which sends the room as it
+    is by then.
+    """
+
+    name = 'room-updates'
+
+    def __init__(self, emit_update, window=1.0, log_interval=0):
+        super().__init__(window, log_interval)
+        self.emit_update = emit_update
+
+        self._pending = {}  # room id -> None, in the order they changed
+
+        self.metrics = {
+            'changes': 0,   # member count changes recorded
+            'updates': 0,   # room updates emitted
+        }
+
+    def record(self, room_id):
+        """Note that `room_id`'s member count just changed"""
+        with self._lock:
+            self.metrics['changes'] += 1
+            self._pending[room_id] = None
+        self._wake.set()
+
+    def flush(self):
+        """Announce every pending room now"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for room_id in pending:
+            self.emit_update(room_id)
+
+        with self._lock:
+            self.metrics['updates'] += len(pending)
+
+    def describe(self, stats):
+        return (f"Room list: {stats['changes']} member count changes, "
+                f"{stats['updates']} room updates")
+
+    def close(self):
+        super().close()
+        self.log_stats()
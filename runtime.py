@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Runtime Module
+Async mode selection (threading / eventlet / gevent) and real-thread offloading
+"""
+
+import importlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# threading: one OS thread per connection (development)
+# eventlet / gevent: green threads, one process holds many idle websockets
+ASYNC_MODE = os.environ.get('ECHOROOM_ASYNC_MODE', 'threading')
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"Unknown ECHOROOM_ASYNC_MODE: {ASYNC_MODE}")
+
+_patched = False
+
+def monkey_patch():
+    """Make sockets, locks, sleeps and threads cooperative.
+
+    Must run before anything else imports socket/threading (app.py and
+    wsgi.py call it first thing). No-op in threading mode.
+    """
+    global _patched
+    if _patched or ASYNC_MODE == 'threading':
+        return
+    _patched = True
+
+    if ASYNC_MODE == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    else:
+        from gevent import monkey
+        monkey.patch_all()
+
+    # psycopg2 is a C extension: without psycogreen every query blocks the hub
+    try:
+        if ASYNC_MODE == 'eventlet':
+            from psycogreen.eventlet import patch_psycopg
+        else:
+            from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    patch_psycopg()
+
+def original(module_name):
+    """The stdlib module as it was before monkey_patch().
+
+    eventlet's green modules expect to run on the hub's thread; code that
+    runs on BlockingPool threads uses the original ones instead.
+    """
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import patcher
+        return patcher.original(module_name)
+    return importlib.import_module(module_name)
+
+class BlockingPool:
+    """Runs CPU-heavy or non-cooperative calls on at most `workers` OS threads.
+
+    In the evented modes the calling green thread yields while the work
+    runs, so other connections keep being served.
+    """
+
+    def __init__(self, workers, name):
+        self.workers = workers
+        self.name = name
+        self._executor = None
+        self._gevent_pool = None
+        self._slots = None
+
+        if ASYNC_MODE == 'eventlet':
+            # eventlet's tpool is process-wide; bound our share of it
+            self._slots = threading.Semaphore(workers)
+        elif ASYNC_MODE == 'gevent':
+            from gevent.threadpool import ThreadPool
+            self._gevent_pool = ThreadPool(workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=workers,
+                                                thread_name_prefix=name)
+
+    def run(self, fn, *args):
+        if self._slots is not None:
+            from eventlet import tpool
+            with self._slots:
+                return tpool.execute(fn, *args)
+        if self._gevent_pool is not None:
+            return self._gevent_pool.apply(fn, args)
+        return self._executor.submit(fn, *args).result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._gevent_pool is not None:
+            self._gevent_pool.kill()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Message Search Module
+Incremental full-text index over room and private message text
+"""
+
+import re
+import sqlite3
+import threading
+import unicodedata
+
+# ==================== TOKENIZER ====================
+# Arabic: drop harakat and tatweel, fold the alef / yaa / taa marbuta
+# variants people type interchangeably, strip the definite article (with
+# its common attached prepositions). English: case folding and a light
+# plural fold. Documents and queries go through the same steps.
+
+ARABIC_MARKS_RE = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_FOLD = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic-Indic digits
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # Extended (Persian) digits
+})
+ARABIC_PREFIXES = ('وال', 'بال', 'كال', 'فال', 'لل', 'ال')
+TOKEN_RE = re.compile(r'\w+')
+
+def _is_arabic(token):
+    return '\u0600' <= token[0] <= '\u06ff'
+
+def _stem(token):
+    if _is_arabic(token):
+        for prefix in ARABIC_PREFIXES:
+            if token.startswith(prefix) and len(token) - len(prefix) >= 2:
+                return token[len(prefix):]
+        return token
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+def tokenize(text):
+    """Normalized search tokens of a message or a query"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = ARABIC_MARKS_RE.sub('', text).translate(ARABIC_FOLD)
+    return [_stem(token) for token in TOKEN_RE.findall(text)]
+
+# ==================== SCHEMA ====================
+# `terms` is a contentless FTS5 table (the inverted index); its rowid is the
+# `docs` row. Tokens are joined by spaces before indexing, so FTS5's own
+# tokenizer only splits them again. The conversation is indexed too, as one
+# opaque token, so a query is restricted to the caller's conversations by
+# the MATCH itself rather than by filtering every hit afterwards.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    doc             INTEGER PRIMARY KEY,
+    conversation    TEXT NOT NULL,
+    message_id      TEXT NOT NULL,
+    sender          TEXT,
+    timestamp       TEXT,
+    text            TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS docs_message_idx ON docs (conversation, message_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5(
+    conversation, tokens, content='', tokenize='unicode61 remove_diacritics 0'
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key     TEXT PRIMARY KEY,
+    value   TEXT NOT NULL
+);
+'''
+
+MAX_QUERY_TOKENS = 8
+
+def conversation_id(kind, key):
+    """'room:<room id>' or 'private:<chat key>'"""
+    return f"{kind}:{key}"
+
+def conversation_token(conversation):
+    """A conversation id as a single FTS token (matched exactly, never as a
+    prefix or phrase of another conversation's)"""
+    return 'c' + conversation.encode('utf-8').hex()
+
+class MessageSearch:
+    """Full-text index of message text in its own SQLite file.
+
+    Updated as messages are sent, deleted or dropped from a history. Hits
+    are ranked by BM25 (ties: newest first) among the conversations the
+    caller may read, which every query names, so the index itself knows
+    nothing about permissions. Writes are batched the same way
+    SqliteStorage does it: one connection, and a background thread that
+    commits every `commit_interval` seconds.
+    """
+
+    def __init__(self, db_file, commit_interval=0.5):
+        self.db_file = db_file
+        self.commit_interval = commit_interval
+
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._upgrade()
+        self.conn.executescript(SCHEMA)
+
+        self._committer = threading.Thread(target=self._commit_loop,
+                                           name='search-committer', daemon=True)
+        self._committer.start()
+
+    # ---------- Transactions ----------
+
+    def _write(self, sql, params=()):
+        with self._lock:
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            return self.conn.execute(sql, params)
+
+    def commit(self):
+        with self._lock:
+            if self.conn.in_transaction:
+                self.conn.execute("COMMIT")
+
+    def _commit_loop(self):
+        while not self._stopped.wait(self.commit_interval):
+            try:
+                self.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Search index commit failed: {e}")
+
+    def _upgrade(self):
+        """Indexes from before `terms` had the conversation column are
+        re-indexed from `docs`"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(terms)")]
+        if not columns or 'conversation' in columns:
+            return
+        self.conn.execute("DROP TABLE terms")
+        self.conn.executescript(SCHEMA)
+        with self._lock:
+            for doc, conversation, text in self.conn.execute(
+                    "SELECT doc, conversation, text FROM docs").fetchall():
+                self._write("INSERT INTO terms (rowid, conversation, tokens) VALUES (?, ?, ?)",
+                            (doc, conversation_token(conversation), ' '.join(tokenize(text))))
+            self.commit()
+        print("🔎 Search index upgraded")
+
+    # ---------- Index ----------
+
+    def add(self, kind, key, message):
+        """Index one message; messages without text (voice) are skipped"""
+        text = message.get('message')
+        if not isinstance(text, str) or not text.strip() or not message.get('id'):
+            return
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        sender = message.get('username') or message.get('from')
+        conversation = conversation_id(kind, key)
+        with self._lock:
+            cursor = self._write("INSERT OR IGNORE INTO docs (conversation, message_id, sender, "
+                                 "timestamp, text) VALUES (?, ?, ?, ?, ?)",
+                                 (conversation, message['id'], sender,
+                                  message.get('timestamp'), text))
+            if cursor.rowcount:
+                self._write("INSERT INTO terms (rowid, conversation, tokens) VALUES (?, ?, ?)",
+                            (cursor.lastrowid, conversation_token(conversation), ' '.join(tokens)))
+
+    def _remove_docs(self, rows):
+        # A contentless table forgets a row given the tokens it was indexed with
+        for doc, conversation, text in rows:
+            self._write("INSERT INTO terms (terms, rowid, conversation, tokens) "
+                        "VALUES ('delete', ?, ?, ?)",
+                        (doc, conversation_token(conversation), ' '.join(tokenize(text))))
+            self._write("DELETE FROM docs WHERE doc = ?", (doc,))
+
+    def remove(self, kind, key, message_id):
+        with self._lock:
+            rows = self.conn.execute("SELECT doc, conversation, text FROM docs "
+                                     "WHERE conversation = ? AND message_id = ?",
+                                     (conversation_id(kind, key), message_id)).fetchall()
+            self._remove_docs(rows)
+
+    def drop(self, kind, key):
+        """Forget a whole conversation (a deleted room)"""
+        with self._lock:
+            rows = self.conn.execute("SELECT doc, conversation, text FROM docs "
+                                     "WHERE conversation = ?",
+                                     (conversation_id(kind, key),)).fetchall()
+            self._remove_docs(rows)
+
+    # ---------- Initial build ----------
+
+    def is_built(self):
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone() is not None
+
+    def build(self, messages):
+        """Index every (kind, key, message) of an existing history.
+
+        Safe to re-run after an interruption: messages already indexed are
+        skipped.
+        """
+        count = 0
+        for kind, key, message in messages:
+            self.add(kind, key, message)
+            count += 1
+            if count % 1000 == 0:
+                self.commit()
+        with self._lock:
+            self._write("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+            self.commit()
+        return count
+
+    # ---------- Queries ----------
+
+    @staticmethod
+    def match_expression(query, conversations=None):
+        """FTS5 MATCH string for a user query: every token must occur, the
+        last one as a prefix while it is still being typed; with
+        `conversations`, only in one of those"""
+        tokens = tokenize(query)[:MAX_QUERY_TOKENS]
+        if not tokens:
+            return None
+        terms = [f'"{token}"' for token in tokens]
+        if not query[-1:].isspace():
+            terms[-1] += '*'
+        match = f"tokens : ({' '.join(terms)})"
+        if conversations is not None:
+            scope = ' OR '.join(conversation_token(c) for c in conversations)
+            match = f"conversation : ({scope}) AND {match}"
+        return match
+
+    def search(self, query, conversations, limit, offset=0):
+        """Best hits for `query` within `conversations` (conversation_id values).
+
+        Returns (hits, has_more); each hit is {'kind', 'key', 'id', 'sender',
+        'timestamp', 'message', 'score'}.
+        """
+        if not conversations:
+            return [], False
+        match = self.match_expression(query, sorted(set(conversations)))
+        if match is None:
+            return [], False
+
+        # Weight 0 for the conversation column: it only scopes, never ranks
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT d.conversation, d.message_id, d.sender, d.timestamp, d.text, "
+                "bm25(terms, 0.0, 1.0) AS score FROM terms JOIN docs d ON d.doc = terms.rowid "
+                "WHERE terms MATCH ? ORDER BY score, d.doc DESC LIMIT ? OFFSET ?",
+                (match, limit + 1, offset)).fetchall()
+
+        hits = []
+        for conversation, message_id, sender, timestamp, text, score in rows[:limit]:
+            kind, _, key = conversation.partition(':')
+            hits.append({'kind': kind, 'key': key, 'id': message_id, 'sender': sender,
+                         'timestamp': timestamp, 'message': text, 'score': round(-score, 3)})
+        return hits, len(rows) > limit
+
+    # ---------- Lifecycle ----------
+
+    def close(self):
+        self._stopped.set()
+        self._committer.join(timeout=self.commit_interval * 2)
+        with self._lock:
+            self.commit()
+            self.conn.close()
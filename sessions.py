@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Session Index Module
+In-memory token -> session index with heap-driven expiry
+"""
+
+import heapq
+import threading
+import time
+from datetime import datetime
+
+# A token that is not in the index makes us re-read that user's sessions
+# from storage (another worker may have created it), but at most this often.
+MISS_RELOAD_SECONDS = 5
+
+def to_epoch(iso_timestamp):
+    """ISO timestamp (as stored in session records) -> integer epoch seconds"""
+    return int(datetime.fromisoformat(iso_timestamp).timestamp())
+
+class SessionIndex:
+    """Validates session tokens without touching storage.
+
+    Sessions are still persisted by the storage backend on login/logout;
+    this index is a cache in front of it. Entries are loaded per user on
+    first use and expire lazily on lookup or when the sweeper pops them
+    off the expiry heap.
+    """
+
+    def __init__(self, load_sessions, sweep_interval=60):
+        self.load_sessions = load_sessions  # email -> list of session records
+        self.sweep_interval = sweep_interval
+
+        self._lock = threading.Lock()
+        self.by_token = {}      # token -> (email, expires_epoch)
+        self.by_email = {}      # email -> set of tokens
+        self._heap = []         # (expires_epoch, token)
+        self._loaded_at = {}    # email -> monotonic time of last storage read
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # ==================== INDEX MAINTENANCE ====================
+
+    def _add(self, email, token, expires):
+        """Caller holds _lock"""
+        self.by_token[token] = (email, expires)
+        self.by_email.setdefault(email, set()).add(token)
+        heapq.heappush(self._heap, (expires, token))
+
+    def _remove(self, token):
+        """Caller holds _lock"""
+        entry = self.by_token.pop(token, None)
+        if entry:
+            tokens = self.by_email.get(entry[0])
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self.by_email[entry[0]]
+        return entry
+
+    def add(self, email, session):
+        """Index a session record that was just persisted"""
+        with self._lock:
+            self._add(email, session['token'], to_epoch(session['expires_at']))
+
+    def load(self, email):
+        """(Re)index a user's sessions from storage"""
+        sessions = self.load_sessions(email)
+        now = int(time.time())
+        with self._lock:
+            for token in list(self.by_email.get(email, ())):
+                self._remove(token)
+            for session in sessions:
+                expires = to_epoch(session['expires_at'])
+                if expires > now:
+                    self._add(email, session['token'], expires)
+            self._loaded_at[email] = time.monotonic()
+
+    def retain(self, email, tokens):
+        """Drop the user's indexed sessions that are not in `tokens`"""
+        keep = set(tokens)
+        with self._lock:
+            for token in list(self.by_email.get(email, ())):
+                if token not in keep:
+                    self._remove(token)
+
+    # ==================== VALIDATION ====================
+
+    def expires_at(self, email, token):
+        """Expiry (epoch seconds) of a valid session, or None"""
+        if not email or not token:
+            return None
+
+        entry = self.by_token.get(token)
+        if entry is None:
+            loaded_at = self._loaded_at.get(email)
+            if loaded_at is not None and time.monotonic() - loaded_at < MISS_RELOAD_SECONDS:
+                return None
+            self.load(email)
+            entry = self.by_token.get(token)
+            if entry is None:
+                return None
+
+        owner, expires = entry
+        if owner != email:
+            return None
+        if expires <= time.time():
+            with self._lock:
+                self._remove(token)
+            return None
+        return expires
+
+    def validate(self, email, token):
+        return self.expires_at(email, token) is not None
+
+    # ==================== BACKGROUND EXPIRY ====================
+
+    def sweep(self):
+        """Pop every expired token off the heap"""
+        now = time.time()
+        expired = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires, token = heapq.heappop(self._heap)
+                entry = self.by_token.get(token)
+                # Skip stale heap entries (token revoked or re-added since)
+                if entry and entry[1] == expires:
+                    self._remove(token)
+                    expired += 1
+            # Revoked tokens leave stale heap entries behind; rebuild once
+            # they dominate the heap
+            if len(self._heap) > 2 * len(self.by_token) + 1024:
+                self._heap = [(expires, token) for token, (_, expires) in self.by_token.items()]
+                heapq.heapify(self._heap)
+        return expired
+
+    def _sweep_loop(self):
+        while not self._stopped.wait(self.sweep_interval):
+            try:
+                expired = self.sweep()
+                if expired:
+                    print(f"⌛ Expired {expired} sessions")
+            except Exception as e:
+                print(f"❌ Error expiring sessions: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sweep_loop,
+                                            name='session-expiry', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
@@ -0,0 +1,776 @@
+#!/usr/bin/env python3
+"""
+Storage Module
+Repository layer for users, sessions, rooms, messages, friends and settings
+"""
+
+import base64
+import json
+from abc import ABC, abstractmethod
+
+from history import MessageLog
+
+# ==================== BINARY VALUES ====================
+# Voice messages carry raw audio bytes. JSON has no bytes type, so the
+# JSON-based formats (journal, SQLite/PostgreSQL message columns) write
+# them as {"$bytes": "<base64>"} and turn them back into bytes on load.
+
+BYTES_TAG = '$bytes'
+
+class BytesEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return {BYTES_TAG: base64.b64encode(obj).decode('ascii')}
+        if isinstance(obj, (MessageLog, MemberSet)):
+            # Snapshots keep the plain list layout of echoroom_data.json
+            return obj.to_list()
+        return super().default(obj)
+
+def decode_bytes(obj):
+    """json object_hook that restores tagged bytes"""
+    if len(obj) == 1 and BYTES_TAG in obj:
+        return base64.b64decode(obj[BYTES_TAG])
+    return obj
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'), cls=BytesEncoder)
+
+def loads(text):
+    return json.loads(text, object_hook=decode_bytes)
+
+# ==================== HISTORY PAGES ====================
+# History is paged with message ids as cursors: `before` asks for the
+# messages right before (older than) that message, `after` for the ones
+# right after it, neither for the newest page. Every backend returns
+# (messages oldest first, has_more) where has_more says whether the history
+# continues past the page in the direction of travel. An unknown cursor
+# (e.g. a deleted message) gives an empty page.
+
+# ==================== INTERFACE ====================
+
+class Storage(ABC):
+    """Interface every storage backend implements.
+
+    Records are plain dicts shaped exactly like the ones the Socket.IO
+    handlers send to the client. Returned records must be treated as
+    read-only: change them through the update methods so the backend can
+    persist the change. Every method but close() is abstract, so a backend
+    that misses one fails as soon as it is instantiated.
+    """
+
+    # ---------- Users (keyed by email) ----------
+
+    @abstractmethod
+    def get_user(self, email):
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_user_email(self, username):
+        """Email of the account with this username, or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_user(self, email, user):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, email, fields):
+        raise NotImplementedError
+
+    # ---------- Sessions ----------
+
+    @abstractmethod
+    def get_sessions(self, email):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_sessions(self, email, sessions):
+        """Replace the user's session list"""
+        raise NotImplementedError
+
+    # ---------- Rooms ----------
+
+    @abstractmethod
+    def get_room(self, room_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_rooms(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_room(self, room):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_room(self, room_id):
+        """Delete a room together with its message history"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_room_member(self, room_id, username):
+        """Returns True if the user was not a member yet"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_room_member(self, room_id, username):
+        """Returns True if the user was a member"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_room_invite(self, room_id, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_rooms(self, username):
+        """Ids of the rooms the user is a member of"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_room_member(self, room_id, username):
+        raise NotImplementedError
+
+    # ---------- Room messages ----------
+
+    @abstractmethod
+    def add_room_message(self, room_id, message):
+        """Returns the messages pushed out of the kept history (usually [])"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_room_messages(self, room_id, limit):
+        """Last `limit` messages, oldest first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_room_history(self, room_id, limit, before=None, after=None):
+        """One page of history, oldest first (see HISTORY PAGES above)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_room_message(self, room_id, message_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_room_message(self, room_id, message_id):
+        raise NotImplementedError
+
+    # ---------- Private messages (keyed by chat key) ----------
+
+    @abstractmethod
+    def add_private_message(self, chat_key, message):
+        """Returns the messages pushed out of the kept history (usually [])"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_private_messages(self, chat_key, limit):
+        """Last `limit` messages, oldest first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_private_history(self, chat_key, limit, before=None, after=None):
+        """One page of history, oldest first (see HISTORY PAGES above)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_private_message(self, chat_key, message_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_private_message(self, chat_key, message_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_messages(self):
+        """Every stored message as (kind, key, message), kind being 'room'
+        (key = room id) or 'private' (key = chat key); for building indexes"""
+        raise NotImplementedError
+
+    # ---------- User settings ----------
+
+    @abstractmethod
+    def get_settings(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_settings(self, username, settings):
+        raise NotImplementedError
+
+    # ---------- Friends ----------
+
+    @abstractmethod
+    def get_friends(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def are_friends(self, user1, user2):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_friendship(self, user1, user2):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_friendship(self, user1, user2):
+        raise NotImplementedError
+
+    # ---------- Friend requests (incoming, keyed by recipient) ----------
+
+    @abstractmethod
+    def get_friend_requests(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_friend_request(self, to_user, from_user):
+        """Returns True if the request was not pending yet"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_friend_request(self, to_user, from_user):
+        raise NotImplementedError
+
+    # ---------- Lifecycle ----------
+
+    def close(self):
+        pass
+
+# ==================== JSON FILE BACKEND ====================
+
+def empty_data():
+    return {
+        'users_db': {},
+        'rooms_db': {},
+        'messages_db': {},
+        'user_settings': {},
+        'friends_db': {},
+        'friend_requests_db': {},
+        'sessions_db': {},
+        'private_messages_db': {},
+        'username_index': {}
+    }
+
+class UsernameIndex:
+    """Bidirectional username <-> email map over users_db"""
+
+    def __init__(self, by_username=None):
+        self.by_username = by_username if by_username is not None else {}
+        self.by_email = {email: username for username, email in self.by_username.items()}
+
+    @classmethod
+    def build(cls, users_db):
+        index = cls()
+        for email, user_data in users_db.items():
+            if user_data.get('username'):
+                index.add(user_data['username'], email)
+        return index
+
+    def is_consistent_with(self, users_db):
+        return len(self.by_email) == len(users_db) == len(self.by_username)
+
+    def email_for(self, username):
+        return self.by_username.get(username)
+
+    def username_for(self, email):
+        return self.by_email.get(email)
+
+    def add(self, username, email):
+        self.by_username[username] = email
+        self.by_email[email] = username
+
+    def remove(self, email):
+        """Drop the email's entry; returns the username it had"""
+        username = self.by_email.pop(email, None)
+        if username is not None and self.by_username.get(username) == email:
+            del self.by_username[username]
+        return username
+
+class MemberSet:
+    """One room's members in join order, with O(1) add and remove.
+    Snapshots and the records handed out see a plain list."""
+
+    def __init__(self, members=()):
+        self.members = dict.fromkeys(members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __contains__(self, username):
+        return username in self.members
+
+    def to_list(self):
+        return list(self.members)
+
+    def add(self, username):
+        """True if the user was not a member yet"""
+        if username in self.members:
+            return False
+        self.members[username] = None
+        return True
+
+    def discard(self, username):
+        """True if the user was a member"""
+        if username not in self.members:
+            return False
+        del self.members[username]
+        return True
+
+class MembershipIndex:
+    """username -> set of room ids, the reverse of the rooms' member lists"""
+
+    def __init__(self):
+        self.by_username = {}
+
+    @classmethod
+    def build(cls, rooms_db):
+        index = cls()
+        for room_id, room in rooms_db.items():
+            for username in room.get('members', []):
+                index.add(username, room_id)
+        return index
+
+    def rooms_of(self, username):
+        return self.by_username.get(username, ())
+
+    def add(self, username, room_id):
+        self.by_username.setdefault(username, set()).add(room_id)
+
+    def remove(self, username, room_id):
+        rooms = self.by_username.get(username)
+        if rooms is not None:
+            rooms.discard(room_id)
+            if not rooms:
+                del self.by_username[username]
+
+class JsonStorage(Storage):
+    """Everything in memory, persisted through a Journal (snapshot + WAL).
+
+    The on-disk format is the original echoroom_data.json layout, so
+    existing data files keep working. Each conversation's history is a
+    MessageLog sized by room_history_limit (or the room type's entry in
+    room_type_history_limits) / private_history_limit. A room's members are
+    a MemberSet, journaled one join or leave at a time.
+
+    With an `archive` (archive.MessageArchive) nothing is ever dropped:
+    every message a log evicts goes to the archive (written out a block at
+    a time), and the history reads continue into the archive where the
+    in-memory tail ends.
+    """
+
+    def __init__(self, journal, room_history_limit=500, private_history_limit=1000,
+                 room_type_history_limits=None, archive=None):
+        self.journal = journal
+        self.room_history_limit = room_history_limit
+        self.private_history_limit = private_history_limit
+        self.room_type_history_limits = room_type_history_limits or {}
+        self.archive = archive
+        if journal.encoder is None:
+            journal.encoder = BytesEncoder  # writes MessageLogs as lists
+        if archive is not None and archive.encoder is None:
+            archive.encoder = BytesEncoder
+
+        try:
+            data = journal.load(empty_data())
+        except Exception as e:
+            print(f"❌ Error loading data: {e}")
+            data = empty_data()
+
+        self.users_db = data['users_db']
+        self.rooms_db = data['rooms_db']
+        self.messages_db = data['messages_db']
+        self.user_settings_db = data['user_settings']
+        self.friends_db = data['friends_db']
+        self.friend_requests_db = data['friend_requests_db']
+        self.sessions_db = data['sessions_db']
+        self.private_messages_db = data['private_messages_db']
+
+        # Snapshot lists -> ring buffers (trimmed if a limit was lowered).
+        # With an archive the excess is archived by _settle_archive instead,
+        # once the journal runs
+        for room_id, messages in self.messages_db.items():
+            limit = self._room_limit(room_id) if archive is None else None
+            self.messages_db[room_id] = MessageLog(limit, messages)
+        for chat_key, messages in self.private_messages_db.items():
+            limit = self.private_history_limit if archive is None else None
+            self.private_messages_db[chat_key] = MessageLog(limit, messages)
+
+        # Persisted with the snapshot; rebuilt if it does not match users_db
+        # (first start after upgrading, or a hand-edited data file)
+        self.usernames = UsernameIndex(data.get('username_index'))
+        if not self.usernames.is_consistent_with(self.users_db):
+            self.usernames = UsernameIndex.build(self.users_db)
+            print(f"🔎 Rebuilt username index ({len(self.usernames.by_username)} users)")
+        for room in self.rooms_db.values():
+            room['members'] = MemberSet(room.get('members', []))
+        self.memberships = MembershipIndex.build(self.rooms_db)
+
+        journal.start(self.current_data)
+        if archive is not None:
+            self._settle_archive()
+
+    def current_data(self):
+        return {
+            'users_db': self.users_db,
+            'rooms_db': self.rooms_db,
+            'messages_db': self._snapshot_logs('messages_db', self.messages_db),
+            'user_settings': self.user_settings_db,
+            'friends_db': self.friends_db,
+            'friend_requests_db': self.friend_requests_db,
+            'sessions_db': self.sessions_db,
+            'private_messages_db': self._snapshot_logs('private_messages_db',
+                                                       self.private_messages_db),
+            'username_index': self.usernames.by_username
+        }
+
+    # ---------- Users ----------
+
+    def get_user(self, email):
+        return self.users_db.get(email)
+
+    def find_user_email(self, username):
+        return self.usernames.email_for(username)
+
+    def create_user(self, email, user):
+        self.users_db[email] = user
+        self.usernames.add(user['username'], email)
+        self.journal.set('users_db', email, user)
+        self.journal.set('username_index', user['username'], email)
+
+    def update_user(self, email, fields):
+        old_username = self.users_db[email].get('username')
+        self.users_db[email].update(fields)
+        self.journal.set('users_db', email, self.users_db[email])
+
+        new_username = self.users_db[email].get('username')
+        if new_username != old_username:
+            self.usernames.remove(email)
+            self.usernames.add(new_username, email)
+            self.journal.delete('username_index', old_username)
+            self.journal.set('username_index', new_username, email)
+
+    # ---------- Sessions ----------
+
+    def get_sessions(self, email):
+        return self.sessions_db.get(email, [])
+
+    def save_sessions(self, email, sessions):
+        self.sessions_db[email] = sessions
+        self.journal.set('sessions_db', email, sessions)
+
+    # ---------- Rooms ----------
+
+    @staticmethod
+    def _room_record(room):
+        return dict(room, members=room['members'].to_list())
+
+    def get_room(self, room_id):
+        room = self.rooms_db.get(room_id)
+        return self._room_record(room) if room else None
+
+    def list_rooms(self):
+        return [self._room_record(room) for room in list(self.rooms_db.values())]
+
+    def create_room(self, room):
+        room = self.rooms_db[room['id']] = dict(room, members=MemberSet(room.get('members', [])))
+        for username in room['members']:
+            self.memberships.add(username, room['id'])
+        self.journal.set('rooms_db', room['id'], room)
+
+    def delete_room(self, room_id):
+        room = self.rooms_db.pop(room_id, None)
+        for username in (room or {}).get('members', []):
+            self.memberships.remove(username, room_id)
+        self.messages_db.pop(room_id, None)
+        self.journal.delete('rooms_db', room_id)
+        self.journal.delete('messages_db', room_id)
+        if self.archive is not None:
+            self.archive.drop('messages_db', room_id)
+
+    def add_room_member(self, room_id, username):
+        room = self.rooms_db.get(room_id)
+        if not room or not room['members'].add(username):
+            return False
+        self.memberships.add(username, room_id)
+        self.journal.set_add('rooms_db', room_id, 'members', username)
+        return True
+
+    def remove_room_member(self, room_id, username):
+        room = self.rooms_db.get(room_id)
+        if not room or not room['members'].discard(username):
+            return False
+        self.memberships.remove(username, room_id)
+        self.journal.set_discard('rooms_db', room_id, 'members', username)
+        return True
+
+    def add_room_invite(self, room_id, username):
+        room = self.rooms_db.get(room_id)
+        if not room:
+            return
+        if 'invited' not in room:
+            room['invited'] = []
+        if username not in room['invited']:
+            room['invited'].append(username)
+            self.journal.set('rooms_db', room_id, room)
+
+    def get_user_rooms(self, username):
+        return list(self.memberships.rooms_of(username))
+
+    def is_room_member(self, room_id, username):
+        return room_id in self.memberships.rooms_of(username)
+
+    # ---------- Room messages ----------
+
+    def _room_limit(self, room_id):
+        room_type = (self.rooms_db.get(room_id) or {}).get('type')
+        return self.room_type_history_limits.get(room_type, self.room_history_limit)
+
+    def add_room_message(self, room_id, message):
+        return self._append(self.messages_db, 'messages_db', room_id, message,
+                            self._room_limit(room_id))
+
+    def get_room_messages(self, room_id, limit):
+        return self._tail(self.messages_db, 'messages_db', room_id, limit)
+
+    def get_room_history(self, room_id, limit, before=None, after=None):
+        return self._page(self.messages_db, 'messages_db', room_id, limit, before, after)
+
+    def get_room_message(self, room_id, message_id):
+        return self._find(self.messages_db, 'messages_db', room_id, message_id)
+
+    def delete_room_message(self, room_id, message_id):
+        return self._delete(self.messages_db, 'messages_db', room_id, message_id)
+
+    # ---------- Private messages ----------
+
+    def add_private_message(self, chat_key, message):
+        return self._append(self.private_messages_db, 'private_messages_db', chat_key, message,
+                            self.private_history_limit)
+
+    def get_private_messages(self, chat_key, limit):
+        return self._tail(self.private_messages_db, 'private_messages_db', chat_key, limit)
+
+    def get_private_history(self, chat_key, limit, before=None, after=None):
+        return self._page(self.private_messages_db, 'private_messages_db', chat_key,
+                          limit, before, after)
+
+    def get_private_message(self, chat_key, message_id):
+        return self._find(self.private_messages_db, 'private_messages_db', chat_key, message_id)
+
+    def delete_private_message(self, chat_key, message_id):
+        return self._delete(self.private_messages_db, 'private_messages_db', chat_key, message_id)
+
+    def iter_messages(self):
+        for kind, name, collection in (('room', 'messages_db', self.messages_db),
+                                       ('private', 'private_messages_db', self.private_messages_db)):
+            for key in list(collection):
+                if self.archive is not None:
+                    # Streamed a block at a time; a whole archive never sits in memory
+                    for message in self.archive.messages(name, key):
+                        yield kind, key, message
+                log = collection.get(key)
+                if log is not None:
+                    for message in log.head(len(log)):
+                        yield kind, key, message
+
+    # ---------- Message logs ----------
+
+    def _archive_evicted(self, name, key, evicted):
+        """Hand messages a log evicted to the archive. They stay in the
+        journal until the archive has written them out as a block."""
+        for message in evicted:
+            block = self.archive.append(name, key, message)
+            if block:
+                self.journal.trim(name, key, block[-1].get('id'))
+
+    def _snapshot_logs(self, name, collection):
+        """Histories as snapshot lists, including messages still waiting in
+        the archive's write buffer (they are not on disk anywhere else)"""
+        if self.archive is None:
+            return collection
+        return {key: self.archive.pending(name, key) + log.to_list()
+                for key, log in list(collection.items())}
+
+    def _settle_archive(self):
+        """Start-up: drop messages a crash left both in the journal and in
+        the archive, then bound every log, archiving what it evicts"""
+        for name, collection in (('messages_db', self.messages_db),
+                                 ('private_messages_db', self.private_messages_db)):
+            for key, log in list(collection.items()):
+                last_id = self.archive.last_id(name, key)
+                if last_id is not None and last_id in log:
+                    while log.pop_oldest(1)[0].get('id') != last_id:
+                        pass
+                    self.journal.trim(name, key, last_id)
+                limit = (self._room_limit(key) if name == 'messages_db'
+                         else self.private_history_limit)
+                bounded = MessageLog(limit)
+                for message in log:
+                    self._archive_evicted(name, key, bounded.append(message))
+                collection[key] = bounded
+
+    def _append(self, collection, name, key, message, limit):
+        log = collection.get(key)
+        if log is None:
+            log = collection[key] = MessageLog(limit)
+        evicted = log.append(message)
+        if self.archive is None:
+            self.journal.append(name, key, message, log.maxlen)
+            return evicted
+
+        # Replay keeps the log plus the archive's write buffer (less than a
+        # block); the archived part is trimmed explicitly
+        self.journal.append(name, key, message, limit + self.archive.block_size)
+        self._archive_evicted(name, key, evicted)
+        return []
+
+    def _tail(self, collection, name, key, limit):
+        log = collection.get(key)
+        messages = log.tail(limit) if log is not None else []
+        if self.archive is not None and len(messages) < limit:
+            older, _ = self.archive.before(name, key, None, limit - len(messages))
+            messages = older + messages
+        return messages
+
+    def _page(self, collection, name, key, limit, before, after):
+        log = collection.get(key) or MessageLog(None)
+        if self.archive is None:
+            return log.page(limit, before, after)
+
+        if after is not None and after not in log:
+            # Forward from an archived message, on into memory
+            messages, has_more = self.archive.after(name, key, after, limit)
+            if has_more or not messages:
+                return messages, has_more
+            newer = log.head(limit - len(messages))
+            return messages + newer, len(log) > len(newer)
+        if before is not None and before not in log:
+            return self.archive.before(name, key, before, limit)
+
+        messages, has_more = log.page(limit, before, after)
+        if after is None and not has_more:
+            # The in-memory tail ran out: continue with the newest archived
+            older, has_more = self.archive.before(name, key, None, limit - len(messages))
+            messages = older + messages
+        return messages, has_more
+
+    def _find(self, collection, name, key, message_id):
+        log = collection.get(key)
+        message = log.get(message_id) if log is not None else None
+        if message is None and self.archive is not None:
+            message = self.archive.get(name, key, message_id)
+        return message
+
+    def _delete(self, collection, name, key, message_id):
+        log = collection.get(key)
+        if log is not None and log.remove(message_id) is not None:
+            self.journal.remove(name, key, message_id)
+            return True
+        if self.archive is not None and self.archive.delete(name, key, message_id):
+            # It may still be in the journal, waiting to be written to a block
+            self.journal.remove(name, key, message_id)
+            return True
+        return False
+
+    # ---------- User settings ----------
+
+    def get_settings(self, username):
+        return self.user_settings_db.get(username)
+
+    def save_settings(self, username, settings):
+        self.user_settings_db[username] = settings
+        self.journal.set('user_settings', username, settings)
+
+    # ---------- Friends ----------
+
+    def get_friends(self, username):
+        return self.friends_db.get(username, [])
+
+    def are_friends(self, user1, user2):
+        return (user2 in self.friends_db.get(user1, [])) and (user1 in self.friends_db.get(user2, []))
+
+    def add_friendship(self, user1, user2):
+        for user, friend in ((user1, user2), (user2, user1)):
+            if user not in self.friends_db:
+                self.friends_db[user] = []
+            if friend not in self.friends_db[user]:
+                self.friends_db[user].append(friend)
+            self.journal.set('friends_db', user, self.friends_db[user])
+
+    def remove_friendship(self, user1, user2):
+        for user, friend in ((user1, user2), (user2, user1)):
+            if user in self.friends_db:
+                self.friends_db[user] = [f for f in self.friends_db[user] if f != friend]
+                self.journal.set('friends_db', user, self.friends_db[user])
+
+    # ---------- Friend requests ----------
+
+    def get_friend_requests(self, username):
+        return self.friend_requests_db.get(username, [])
+
+    def add_friend_request(self, to_user, from_user):
+        if to_user not in self.friend_requests_db:
+            self.friend_requests_db[to_user] = []
+        if from_user in self.friend_requests_db[to_user]:
+            return False
+        self.friend_requests_db[to_user].append(from_user)
+        self.journal.set('friend_requests_db', to_user, self.friend_requests_db[to_user])
+        return True
+
+    def remove_friend_request(self, to_user, from_user):
+        if to_user in self.friend_requests_db:
+            self.friend_requests_db[to_user] = [r for r in self.friend_requests_db[to_user] if r != from_user]
+            self.journal.set('friend_requests_db', to_user, self.friend_requests_db[to_user])
+
+    # ---------- Lifecycle ----------
+
+    def save(self):
+        """Write a full snapshot now"""
+        self.journal.compact(self.current_data())
+
+    def close(self):
+        self.journal.close()
+
+# ==================== IMPORT ====================
+
+def import_data(data, target):
+    """Copy an echoroom_data.json document into another backend.
+
+    Returns a dict of per-collection counts. Records the target rejects
+    (e.g. a duplicate username) are reported and skipped.
+    """
+    counts = {}
+
+    def copy(name, items, fn):
+        done = 0
+        for item in items:
+            try:
+                fn(*item)
+                done += 1
+            except Exception as e:
+                print(f"⚠️ Skipped {name} {item[0]!r}: {e}")
+        counts[name] = done
+
+    copy('users', data.get('users_db', {}).items(), target.create_user)
+    copy('sessions', data.get('sessions_db', {}).items(), target.save_sessions)
+    copy('settings', data.get('user_settings', {}).items(), target.save_settings)
+    copy('rooms', ((room,) for room in data.get('rooms_db', {}).values()), target.create_room)
+    copy('room messages', ((room_id, msg)
+                           for room_id, msgs in data.get('messages_db', {}).items()
+                           for msg in msgs), target.add_room_message)
+    copy('private messages', ((key, msg)
+                              for key, msgs in data.get('private_messages_db', {}).items()
+                              for msg in msgs), target.add_private_message)
+
+    # Only mutual entries count as a friendship (see are_friends)
+    friends_db = data.get('friends_db', {})
+    copy('friendships', ((user, friend)
+                         for user, friends in friends_db.items()
+                         for friend in friends
+                         if user < friend and user in friends_db.get(friend, [])),
+         target.add_friendship)
+    copy('friend requests', ((to_user, from_user)
+                             for to_user, senders in data.get('friend_requests_db', {}).items()
+                             for from_user in senders), target.add_friend_request)
+    return counts
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+PostgreSQL Storage Backend
+Pooled connections, indexed tables and server-side prepared statements
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.pool
+    from psycopg2.extras import Json, register_default_jsonb
+except ImportError:  # only needed when ECHOROOM_STORAGE=postgres
+    psycopg2 = None
+
+from storage import Storage, dumps, loads
+
+# ==================== SCHEMA ====================
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    email       TEXT PRIMARY KEY,
+    username    TEXT NOT NULL UNIQUE,
+    data        JSONB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    token       TEXT PRIMARY KEY,
+    email       TEXT NOT NULL,
+    created_at  TIMESTAMP NOT NULL,
+    expires_at  TIMESTAMP NOT NULL,
+    ip          TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_email_idx ON sessions (email, created_at);
+
+CREATE TABLE IF NOT EXISTS rooms (
+    id          TEXT PRIMARY KEY,
+    data        JSONB NOT NULL,
+    created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS room_members (
+    room_id     TEXT NOT NULL REFERENCES rooms (id) ON DELETE CASCADE,
+    username    TEXT NOT NULL,
+    seq         BIGSERIAL,
+    PRIMARY KEY (room_id, username)
+);
+CREATE INDEX IF NOT EXISTS room_members_username_idx ON room_members (username);
+
+CREATE TABLE IF NOT EXISTS room_invites (
+    room_id     TEXT NOT NULL REFERENCES rooms (id) ON DELETE CASCADE,
+    username    TEXT NOT NULL,
+    seq         BIGSERIAL,
+    PRIMARY KEY (room_id, username)
+);
+
+CREATE TABLE IF NOT EXISTS room_messages (
+    seq         BIGSERIAL PRIMARY KEY,
+    room_id     TEXT NOT NULL,
+    id          TEXT NOT NULL,
+    timestamp   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    data        JSONB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS room_messages_room_ts_idx ON room_messages (room_id, timestamp, seq);
+CREATE UNIQUE INDEX IF NOT EXISTS room_messages_room_id_idx ON room_messages (room_id, id);
+
+CREATE TABLE IF NOT EXISTS private_messages (
+    seq         BIGSERIAL PRIMARY KEY,
+    chat_key    TEXT NOT NULL,
+    id          TEXT NOT NULL,
+    timestamp   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    data        JSONB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS private_messages_chat_ts_idx ON private_messages (chat_key, timestamp, seq);
+CREATE UNIQUE INDEX IF NOT EXISTS private_messages_chat_id_idx ON private_messages (chat_key, id);
+
+CREATE TABLE IF NOT EXISTS user_settings (
+    username    TEXT PRIMARY KEY,
+    data        JSONB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS friends (
+    username    TEXT NOT NULL,
+    friend      TEXT NOT NULL,
+    seq         BIGSERIAL,
+    PRIMARY KEY (username, friend)
+);
+
+CREATE TABLE IF NOT EXISTS friend_requests (
+    to_user     TEXT NOT NULL,
+    from_user   TEXT NOT NULL,
+    seq         BIGSERIAL,
+    PRIMARY KEY (to_user, from_user)
+);
+'''
+
+# ==================== PREPARED STATEMENTS ====================
+# Prepared lazily, once per pooled connection.
+
+STATEMENTS = {
+    'get_user': "SELECT data FROM users WHERE email = $1",
+    'find_user_email': "SELECT email FROM users WHERE username = $1",
+    'create_user': "INSERT INTO users (email, username, data) VALUES ($1, $2, $3)",
+    'update_user': "UPDATE users SET data = data || $2, username = COALESCE($2->>'username', username) "
+                   "WHERE email = $1",
+
+    'get_sessions': "SELECT token, created_at, expires_at, ip FROM sessions "
+                    "WHERE email = $1 ORDER BY created_at",
+    'delete_sessions': "DELETE FROM sessions WHERE email = $1",
+    'insert_session': "INSERT INTO sessions (token, email, created_at, expires_at, ip) "
+                      "VALUES ($1, $2, $3, $4, $5) ON CONFLICT (token) DO NOTHING",
+
+    'get_room': "SELECT data FROM rooms WHERE id = $1",
+    'get_room_members': "SELECT username FROM room_members WHERE room_id = $1 ORDER BY seq",
+    'get_room_invites': "SELECT username FROM room_invites WHERE room_id = $1 ORDER BY seq",
+    'list_rooms': "SELECT id, data FROM rooms ORDER BY created_at",
+    'list_room_members': "SELECT room_id, username FROM room_members ORDER BY seq",
+    'list_room_invites': "SELECT room_id, username FROM room_invites ORDER BY seq",
+    'create_room': "INSERT INTO rooms (id, data) VALUES ($1, $2)",
+    'delete_room': "DELETE FROM rooms WHERE id = $1",
+    'delete_room_messages': "DELETE FROM room_messages WHERE room_id = $1",
+    'add_room_member': "INSERT INTO room_members (room_id, username) VALUES ($1, $2) "
+                       "ON CONFLICT DO NOTHING",
+    'remove_room_member': "DELETE FROM room_members WHERE room_id = $1 AND username = $2",
+    'add_room_invite': "INSERT INTO room_invites (room_id, username) VALUES ($1, $2) "
+                       "ON CONFLICT DO NOTHING",
+    'get_user_rooms': "SELECT room_id FROM room_members WHERE username = $1",
+    'is_room_member': "SELECT 1 FROM room_members WHERE room_id = $1 AND username = $2",
+
+    'add_room_message': "INSERT INTO room_messages (room_id, id, data) VALUES ($1, $2, $3)",
+    'get_room_messages': "SELECT data FROM (SELECT data, timestamp, seq FROM room_messages "
+                         "WHERE room_id = $1 ORDER BY timestamp DESC, seq DESC LIMIT $2) t "
+                         "ORDER BY timestamp, seq",
+    'get_room_history_before': "SELECT data FROM (SELECT data, timestamp, seq FROM room_messages "
+                               "WHERE room_id = $1 AND (timestamp, seq) < "
+                               "(SELECT timestamp, seq FROM room_messages WHERE room_id = $1 AND id = $2) "
+                               "ORDER BY timestamp DESC, seq DESC LIMIT $3) t ORDER BY timestamp, seq",
+    'get_room_history_after': "SELECT data FROM room_messages WHERE room_id = $1 AND (timestamp, seq) > "
+                              "(SELECT timestamp, seq FROM room_messages WHERE room_id = $1 AND id = $2) "
+                              "ORDER BY timestamp, seq LIMIT $3",
+    'get_room_message': "SELECT data FROM room_messages WHERE room_id = $1 AND id = $2",
+    'delete_room_message': "DELETE FROM room_messages WHERE room_id = $1 AND id = $2",
+    'iter_room_messages': "SELECT seq, room_id, data FROM room_messages WHERE seq > $1 "
+                          "ORDER BY seq LIMIT $2",
+
+    'add_private_message': "INSERT INTO private_messages (chat_key, id, data) VALUES ($1, $2, $3)",
+    'get_private_messages': "SELECT data FROM (SELECT data, timestamp, seq FROM private_messages "
+                            "WHERE chat_key = $1 ORDER BY timestamp DESC, seq DESC LIMIT $2) t "
+                            "ORDER BY timestamp, seq",
+    'get_private_history_before': "SELECT data FROM (SELECT data, timestamp, seq FROM private_messages "
+                                  "WHERE chat_key = $1 AND (timestamp, seq) < "
+                                  "(SELECT timestamp, seq FROM private_messages WHERE chat_key = $1 AND id = $2) "
+                                  "ORDER BY timestamp DESC, seq DESC LIMIT $3) t ORDER BY timestamp, seq",
+    'get_private_history_after': "SELECT data FROM private_messages WHERE chat_key = $1 AND (timestamp, seq) > "
+                                 "(SELECT timestamp, seq FROM private_messages WHERE chat_key = $1 AND id = $2) "
+                                 "ORDER BY timestamp, seq LIMIT $3",
+    'get_private_message': "SELECT data FROM private_messages WHERE chat_key = $1 AND id = $2",
+    'delete_private_message': "DELETE FROM private_messages WHERE chat_key = $1 AND id = $2",
+    'iter_private_messages': "SELECT seq, chat_key, data FROM private_messages WHERE seq > $1 "
+                             "ORDER BY seq LIMIT $2",
+
+    'get_settings': "SELECT data FROM user_settings WHERE username = $1",
+    'save_settings': "INSERT INTO user_settings (username, data) VALUES ($1, $2) "
+                     "ON CONFLICT (username) DO UPDATE SET data = EXCLUDED.data",
+
+    'get_friends': "SELECT friend FROM friends WHERE username = $1 ORDER BY seq",
+    'are_friends': "SELECT count(*) FROM friends WHERE (username = $1 AND friend = $2) "
+                   "OR (username = $2 AND friend = $1)",
+    'add_friend': "INSERT INTO friends (username, friend) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+    'remove_friend': "DELETE FROM friends WHERE (username = $1 AND friend = $2) "
+                     "OR (username = $2 AND friend = $1)",
+
+    'get_friend_requests': "SELECT from_user FROM friend_requests WHERE to_user = $1 ORDER BY seq",
+    'add_friend_request': "INSERT INTO friend_requests (to_user, from_user) VALUES ($1, $2) "
+                          "ON CONFLICT DO NOTHING",
+    'remove_friend_request': "DELETE FROM friend_requests WHERE to_user = $1 AND from_user = $2",
+}
+
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+if psycopg2 is not None:
+    class PreparedConnection(psycopg2.extensions.connection):
+        """Connection that remembers which statements it has prepared"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+            # Restore the tagged bytes of voice messages when reading JSONB
+            register_default_jsonb(self, loads=loads)
+
+# ==================== BACKEND ====================
+
+class PostgresStorage(Storage):
+    """Storage backed by PostgreSQL; nothing is held in process memory"""
+
+    def __init__(self, dsn, min_connections=1, max_connections=10):
+        if psycopg2 is None:
+            raise RuntimeError("PostgreSQL storage requires psycopg2 (pip install psycopg2-binary)")
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            min_connections, max_connections, dsn,
+            connection_factory=PreparedConnection)
+
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SCHEMA)
+
+        print(f"🐘 Connected to PostgreSQL (pool {min_connections}-{max_connections})")
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection for one transaction"""
+        conn = self.pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            # Broken connections are dropped and replaced by the pool
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    @staticmethod
+    def _execute(conn, name, *params):
+        cur = conn.cursor()
+        if name not in conn.prepared:
+            cur.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+            conn.prepared.add(name)
+        if params:
+            placeholders = ', '.join(['%s'] * len(params))
+            cur.execute(f"EXECUTE {name} ({placeholders})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+        return cur
+
+    def _fetch_value(self, name, *params):
+        with self._connection() as conn:
+            row = self._execute(conn, name, *params).fetchone()
+        return row[0] if row else None
+
+    def _fetch_column(self, name, *params):
+        with self._connection() as conn:
+            return [row[0] for row in self._execute(conn, name, *params).fetchall()]
+
+    def _run(self, name, *params):
+        with self._connection() as conn:
+            return self._execute(conn, name, *params).rowcount
+
+    # ---------- Users ----------
+
+    def get_user(self, email):
+        return self._fetch_value('get_user', email)
+
+    def find_user_email(self, username):
+        return self._fetch_value('find_user_email', username)
+
+    def create_user(self, email, user):
+        self._run('create_user', email, user['username'], Json(user))
+
+    def update_user(self, email, fields):
+        self._run('update_user', email, Json(fields))
+
+    # ---------- Sessions ----------
+
+    def get_sessions(self, email):
+        with self._connection() as conn:
+            rows = self._execute(conn, 'get_sessions', email).fetchall()
+        return [{
+            'token': token,
+            'created_at': _isoformat(created_at),
+            'expires_at': _isoformat(expires_at),
+            'ip': ip
+        } for token, created_at, expires_at, ip in rows]
+
+    def save_sessions(self, email, sessions):
+        with self._connection() as conn:
+            self._execute(conn, 'delete_sessions', email)
+            for session in sessions:
+                self._execute(conn, 'insert_session', session['token'], email,
+                              _parse_time(session['created_at']),
+                              _parse_time(session['expires_at']),
+                              session.get('ip'))
+
+    # ---------- Rooms ----------
+
+    def get_room(self, room_id):
+        with self._connection() as conn:
+            row = self._execute(conn, 'get_room', room_id).fetchone()
+            if not row:
+                return None
+            room = row[0]
+            room['members'] = [r[0] for r in self._execute(conn, 'get_room_members', room_id)]
+            room['invited'] = [r[0] for r in self._execute(conn, 'get_room_invites', room_id)]
+        return room
+
+    def list_rooms(self):
+        with self._connection() as conn:
+            rooms = {}
+            for room_id, room in self._execute(conn, 'list_rooms').fetchall():
+                room['members'] = []
+                room['invited'] = []
+                rooms[room_id] = room
+            for room_id, username in self._execute(conn, 'list_room_members').fetchall():
+                if room_id in rooms:
+                    rooms[room_id]['members'].append(username)
+            for room_id, username in self._execute(conn, 'list_room_invites').fetchall():
+                if room_id in rooms:
+                    rooms[room_id]['invited'].append(username)
+        return list(rooms.values())
+
+    def create_room(self, room):
+        data = {k: v for k, v in room.items() if k not in ('members', 'invited')}
+        with self._connection() as conn:
+            self._execute(conn, 'create_room', room['id'], Json(data))
+            for username in room.get('members', []):
+                self._execute(conn, 'add_room_member', room['id'], username)
+            for username in room.get('invited', []):
+                self._execute(conn, 'add_room_invite', room['id'], username)
+
+    def delete_room(self, room_id):
+        with self._connection() as conn:
+            self._execute(conn, 'delete_room', room_id)
+            self._execute(conn, 'delete_room_messages', room_id)
+
+    def add_room_member(self, room_id, username):
+        try:
+            return self._run('add_room_member', room_id, username) > 0
+        except psycopg2.IntegrityError:
+            return False  # room does not exist
+
+    def remove_room_member(self, room_id, username):
+        return self._run('remove_room_member', room_id, username) > 0
+
+    def add_room_invite(self, room_id, username):
+        try:
+            self._run('add_room_invite', room_id, username)
+        except psycopg2.IntegrityError:
+            pass
+
+    def get_user_rooms(self, username):
+        return self._fetch_column('get_user_rooms', username)
+
+    def is_room_member(self, room_id, username):
+        return self._fetch_value('is_room_member', room_id, username) is not None
+
+    # ---------- Room messages ----------
+
+    def _get_history(self, kind, key, limit, before, after):
+        # One extra row tells whether the history goes on past the page
+        if before:
+            messages = self._fetch_column(f'get_{kind}_history_before', key, before, limit + 1)
+            return messages[-limit:], len(messages) > limit
+        if after:
+            messages = self._fetch_column(f'get_{kind}_history_after', key, after, limit + 1)
+            return messages[:limit], len(messages) > limit
+        messages = self._fetch_column(f'get_{kind}_messages', key, limit + 1)
+        return messages[-limit:], len(messages) > limit
+
+    def add_room_message(self, room_id, message):
+        # Full history is kept; nothing is ever pushed out
+        self._run('add_room_message', room_id, message['id'], Json(message, dumps=dumps))
+        return []
+
+    def get_room_messages(self, room_id, limit):
+        return self._fetch_column('get_room_messages', room_id, limit)
+
+    def get_room_history(self, room_id, limit, before=None, after=None):
+        return self._get_history('room', room_id, limit, before, after)
+
+    def get_room_message(self, room_id, message_id):
+        return self._fetch_value('get_room_message', room_id, message_id)
+
+    def delete_room_message(self, room_id, message_id):
+        return self._run('delete_room_message', room_id, message_id) > 0
+
+    # ---------- Private messages ----------
+
+    def add_private_message(self, chat_key, message):
+        self._run('add_private_message', chat_key, message['id'], Json(message, dumps=dumps))
+        return []
+
+    def get_private_messages(self, chat_key, limit):
+        return self._fetch_column('get_private_messages', chat_key, limit)
+
+    def get_private_history(self, chat_key, limit, before=None, after=None):
+        return self._get_history('private', chat_key, limit, before, after)
+
+    def get_private_message(self, chat_key, message_id):
+        return self._fetch_value('get_private_message', chat_key, message_id)
+
+    def delete_private_message(self, chat_key, message_id):
+        return self._run('delete_private_message', chat_key, message_id) > 0
+
+    def _iter_messages(self, kind, batch=1000):
+        last_seq = 0
+        while True:
+            with self._connection() as conn:
+                rows = self._execute(conn, f'iter_{kind}_messages', last_seq, batch).fetchall()
+            for seq, key, message in rows:
+                yield key, message
+            if len(rows) < batch:
+                return
+            last_seq = rows[-1][0]
+
+    def iter_messages(self):
+        for room_id, message in self._iter_messages('room'):
+            yield 'room', room_id, message
+        for chat_key, message in self._iter_messages('private'):
+            yield 'private', chat_key, message
+
+    # ---------- User settings ----------
+
+    def get_settings(self, username):
+        return self._fetch_value('get_settings', username)
+
+    def save_settings(self, username, settings):
+        self._run('save_settings', username, Json(settings))
+
+    # ---------- Friends ----------
+
+    def get_friends(self, username):
+        return self._fetch_column('get_friends', username)
+
+    def are_friends(self, user1, user2):
+        return self._fetch_value('are_friends', user1, user2) == 2
+
+    def add_friendship(self, user1, user2):
+        with self._connection() as conn:
+            self._execute(conn, 'add_friend', user1, user2)
+            self._execute(conn, 'add_friend', user2, user1)
+
+    def remove_friendship(self, user1, user2):
+        self._run('remove_friend', user1, user2)
+
+    # ---------- Friend requests ----------
+
+    def get_friend_requests(self, username):
+        return self._fetch_column('get_friend_requests', username)
+
+    def add_friend_request(self, to_user, from_user):
+        return self._run('add_friend_request', to_user, from_user) > 0
+
+    def remove_friend_request(self, to_user, from_user):
+        self._run('remove_friend_request', to_user, from_user)
+
+    # ---------- Lifecycle ----------
+
+    def close(self):
+        self.pool.closeall()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+SQLite Storage Backend
+Embedded single-node storage: WAL journaling, batched commits, indexed lookups
+"""
+
+import sqlite3
+import threading
+
+from storage import Storage, dumps, loads
+
+# ==================== SCHEMA ====================
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    email       TEXT PRIMARY KEY,
+    username    TEXT NOT NULL UNIQUE,
+    data        TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    token       TEXT PRIMARY KEY,
+    email       TEXT NOT NULL,
+    created_at  TEXT NOT NULL,
+    expires_at  TEXT NOT NULL,
+    ip          TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_email_idx ON sessions (email, created_at);
+
+CREATE TABLE IF NOT EXISTS rooms (
+    id          TEXT PRIMARY KEY,
+    data        TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS room_members (
+    room_id     TEXT NOT NULL REFERENCES rooms (id) ON DELETE CASCADE,
+    username    TEXT NOT NULL,
+    PRIMARY KEY (room_id, username)
+);
+CREATE INDEX IF NOT EXISTS room_members_username_idx ON room_members (username);
+
+CREATE TABLE IF NOT EXISTS room_invites (
+    room_id     TEXT NOT NULL REFERENCES rooms (id) ON DELETE CASCADE,
+    username    TEXT NOT NULL,
+    PRIMARY KEY (room_id, username)
+);
+
+CREATE TABLE IF NOT EXISTS room_messages (
+    seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+    room_id     TEXT NOT NULL,
+    id          TEXT NOT NULL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS room_messages_room_seq_idx ON room_messages (room_id, seq);
+CREATE UNIQUE INDEX IF NOT EXISTS room_messages_room_id_idx ON room_messages (room_id, id);
+
+CREATE TABLE IF NOT EXISTS private_messages (
+    seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_key    TEXT NOT NULL,
+    id          TEXT NOT NULL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS private_messages_chat_seq_idx ON private_messages (chat_key, seq);
+CREATE UNIQUE INDEX IF NOT EXISTS private_messages_chat_id_idx ON private_messages (chat_key, id);
+
+CREATE TABLE IF NOT EXISTS user_settings (
+    username    TEXT PRIMARY KEY,
+    data        TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS friends (
+    username    TEXT NOT NULL,
+    friend      TEXT NOT NULL,
+    PRIMARY KEY (username, friend)
+);
+
+CREATE TABLE IF NOT EXISTS friend_requests (
+    to_user     TEXT NOT NULL,
+    from_user   TEXT NOT NULL,
+    PRIMARY KEY (to_user, from_user)
+);
+'''
+
+def _dumps(value):
+    return dumps(value)
+
+def _loads(row):
+    return loads(row[0]) if row else None
+
+# ==================== BACKEND ====================
+
+class SqliteStorage(Storage):
+    """Storage in a single SQLite file.
+
+    One connection is shared by all handler threads (SQLite has a single
+    writer anyway). Writes join an open transaction that a background
+    thread commits every `commit_interval` seconds, so a burst of messages
+    costs one WAL fsync instead of one per message. Reads use the same
+    connection and therefore always see the batch in progress.
+    """
+
+    def __init__(self, db_file, commit_interval=0.05):
+        self.db_file = db_file
+        self.commit_interval = commit_interval
+
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+
+        self._committer = threading.Thread(target=self._commit_loop,
+                                           name='sqlite-committer', daemon=True)
+        self._committer.start()
+
+        print(f"🗄️ Using SQLite database: {db_file}")
+
+    # ---------- Transactions ----------
+
+    def _write(self, sql, params=()):
+        """Run a write inside the current batch; returns the row count"""
+        with self._lock:
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            return self.conn.execute(sql, params).rowcount
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _query_one(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def commit(self):
+        with self._lock:
+            if self.conn.in_transaction:
+                self.conn.execute("COMMIT")
+
+    def _commit_loop(self):
+        while not self._stopped.wait(self.commit_interval):
+            try:
+                self.commit()
+            except Exception as e:
+                print(f"❌ Error committing SQLite batch: {e}")
+
+    # ---------- Users ----------
+
+    def get_user(self, email):
+        return _loads(self._query_one("SELECT data FROM users WHERE email = ?", (email,)))
+
+    def find_user_email(self, username):
+        row = self._query_one("SELECT email FROM users WHERE username = ?", (username,))
+        return row[0] if row else None
+
+    def create_user(self, email, user):
+        self._write("INSERT INTO users (email, username, data) VALUES (?, ?, ?)",
+                    (email, user['username'], _dumps(user)))
+
+    def update_user(self, email, fields):
+        with self._lock:
+            user = self.get_user(email)
+            if user is None:
+                return
+            user.update(fields)
+            self._write("UPDATE users SET username = ?, data = ? WHERE email = ?",
+                        (user['username'], _dumps(user), email))
+
+    # ---------- Sessions ----------
+
+    def get_sessions(self, email):
+        rows = self._query("SELECT token, created_at, expires_at, ip FROM sessions "
+                           "WHERE email = ? ORDER BY created_at", (email,))
+        return [{
+            'token': token,
+            'created_at': created_at,
+            'expires_at': expires_at,
+            'ip': ip
+        } for token, created_at, expires_at, ip in rows]
+
+    def save_sessions(self, email, sessions):
+        with self._lock:
+            self._write("DELETE FROM sessions WHERE email = ?", (email,))
+            for session in sessions:
+                self._write("INSERT OR IGNORE INTO sessions (token, email, created_at, expires_at, ip) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (session['token'], email, session['created_at'],
+                             session['expires_at'], session.get('ip')))
+
+    # ---------- Rooms ----------
+
+    def get_room(self, room_id):
+        with self._lock:
+            room = _loads(self._query_one("SELECT data FROM rooms WHERE id = ?", (room_id,)))
+            if room is None:
+                return None
+            room['members'] = [r[0] for r in self._query(
+                "SELECT username FROM room_members WHERE room_id = ? ORDER BY rowid", (room_id,))]
+            room['invited'] = [r[0] for r in self._query(
+                "SELECT username FROM room_invites WHERE room_id = ? ORDER BY rowid", (room_id,))]
+        return room
+
+    def list_rooms(self):
+        with self._lock:
+            rooms = {}
+            for room_id, data in self._query("SELECT id, data FROM rooms ORDER BY rowid"):
+                room = loads(data)
+                room['members'] = []
+                room['invited'] = []
+                rooms[room_id] = room
+            for room_id, username in self._query(
+                    "SELECT room_id, username FROM room_members ORDER BY rowid"):
+                if room_id in rooms:
+                    rooms[room_id]['members'].append(username)
+            for room_id, username in self._query(
+                    "SELECT room_id, username FROM room_invites ORDER BY rowid"):
+                if room_id in rooms:
+                    rooms[room_id]['invited'].append(username)
+        return list(rooms.values())
+
+    def create_room(self, room):
+        data = {k: v for k, v in room.items() if k not in ('members', 'invited')}
+        with self._lock:
+            self._write("INSERT INTO rooms (id, data) VALUES (?, ?)", (room['id'], _dumps(data)))
+            for username in room.get('members', []):
+                self._write("INSERT OR IGNORE INTO room_members (room_id, username) VALUES (?, ?)",
+                            (room['id'], username))
+            for username in room.get('invited', []):
+                self._write("INSERT OR IGNORE INTO room_invites (room_id, username) VALUES (?, ?)",
+                            (room['id'], username))
+
+    def delete_room(self, room_id):
+        with self._lock:
+            self._write("DELETE FROM rooms WHERE id = ?", (room_id,))
+            self._write("DELETE FROM room_messages WHERE room_id = ?", (room_id,))
+
+    def add_room_member(self, room_id, username):
+        try:
+            return self._write("INSERT OR IGNORE INTO room_members (room_id, username) VALUES (?, ?)",
+                               (room_id, username)) > 0
+        except sqlite3.IntegrityError:
+            return False  # room does not exist
+
+    def remove_room_member(self, room_id, username):
+        return self._write("DELETE FROM room_members WHERE room_id = ? AND username = ?",
+                           (room_id, username)) > 0
+
+    def add_room_invite(self, room_id, username):
+        try:
+            self._write("INSERT OR IGNORE INTO room_invites (room_id, username) VALUES (?, ?)",
+                        (room_id, username))
+        except sqlite3.IntegrityError:
+            pass
+
+    def get_user_rooms(self, username):
+        return [row[0] for row in self._query("SELECT room_id FROM room_members WHERE username = ?",
+                                              (username,))]
+
+    def is_room_member(self, room_id, username):
+        return self._query_one("SELECT 1 FROM room_members WHERE room_id = ? AND username = ?",
+                               (room_id, username)) is not None
+
+    # ---------- Messages ----------
+
+    def _add_message(self, table, column, key, message):
+        self._write(f"INSERT OR IGNORE INTO {table} ({column}, id, data) VALUES (?, ?, ?)",
+                    (key, message['id'], _dumps(message)))
+
+    def _get_messages(self, table, column, key, limit):
+        rows = self._query(f"SELECT data FROM (SELECT data, seq FROM {table} WHERE {column} = ? "
+                           f"ORDER BY seq DESC LIMIT ?) ORDER BY seq", (key, limit))
+        return [loads(row[0]) for row in rows]
+
+    def _get_history(self, table, column, key, limit, before, after):
+        # One extra row tells whether the history goes on past the page
+        if before:
+            rows = self._query(f"SELECT data FROM (SELECT data, seq FROM {table} WHERE {column} = ? "
+                               f"AND seq < (SELECT seq FROM {table} WHERE {column} = ? AND id = ?) "
+                               f"ORDER BY seq DESC LIMIT ?) ORDER BY seq",
+                               (key, key, before, limit + 1))
+            messages = [loads(row[0]) for row in rows]
+            return messages[-limit:], len(messages) > limit
+        if after:
+            rows = self._query(f"SELECT data FROM {table} WHERE {column} = ? "
+                               f"AND seq > (SELECT seq FROM {table} WHERE {column} = ? AND id = ?) "
+                               f"ORDER BY seq LIMIT ?", (key, key, after, limit + 1))
+            messages = [loads(row[0]) for row in rows]
+            return messages[:limit], len(messages) > limit
+        messages = self._get_messages(table, column, key, limit + 1)
+        return messages[-limit:], len(messages) > limit
+
+    def _get_message(self, table, column, key, message_id):
+        return _loads(self._query_one(f"SELECT data FROM {table} WHERE {column} = ? AND id = ?",
+                                      (key, message_id)))
+
+    def _iter_messages(self, table, column, batch=1000):
+        last_seq = 0
+        while True:
+            rows = self._query(f"SELECT seq, {column}, data FROM {table} WHERE seq > ? "
+                               f"ORDER BY seq LIMIT ?", (last_seq, batch))
+            for seq, key, data in rows:
+                yield key, loads(data)
+            if len(rows) < batch:
+                return
+            last_seq = rows[-1][0]
+
+    def _delete_message(self, table, column, key, message_id):
+        return self._write(f"DELETE FROM {table} WHERE {column} = ? AND id = ?",
+                           (key, message_id)) > 0
+
+    def add_room_message(self, room_id, message):
+        # Full history is kept; nothing is ever pushed out
+        self._add_message('room_messages', 'room_id', room_id, message)
+        return []
+
+    def get_room_messages(self, room_id, limit):
+        return self._get_messages('room_messages', 'room_id', room_id, limit)
+
+    def get_room_history(self, room_id, limit, before=None, after=None):
+        return self._get_history('room_messages', 'room_id', room_id, limit, before, after)
+
+    def get_room_message(self, room_id, message_id):
+        return self._get_message('room_messages', 'room_id', room_id, message_id)
+
+    def delete_room_message(self, room_id, message_id):
+        return self._delete_message('room_messages', 'room_id', room_id, message_id)
+
+    def add_private_message(self, chat_key, message):
+        self._add_message('private_messages', 'chat_key', chat_key, message)
+        return []
+
+    def get_private_messages(self, chat_key, limit):
+        return self._get_messages('private_messages', 'chat_key', chat_key, limit)
+
+    def get_private_history(self, chat_key, limit, before=None, after=None):
+        return self._get_history('private_messages', 'chat_key', chat_key, limit, before, after)
+
+    def get_private_message(self, chat_key, message_id):
+        return self._get_message('private_messages', 'chat_key', chat_key, message_id)
+
+    def delete_private_message(self, chat_key, message_id):
+        return self._delete_message('private_messages', 'chat_key', chat_key, message_id)
+
+    def iter_messages(self):
+        for room_id, message in self._iter_messages('room_messages', 'room_id'):
+            yield 'room', room_id, message
+        for chat_key, message in self._iter_messages('private_messages', 'chat_key'):
+            yield 'private', chat_key, message
+
+    # ---------- User settings ----------
+
+    def get_settings(self, username):
+        return _loads(self._query_one("SELECT data FROM user_settings WHERE username = ?", (username,)))
+
+    def save_settings(self, username, settings):
+        self._write("INSERT OR REPLACE INTO user_settings (username, data) VALUES (?, ?)",
+                    (username, _dumps(settings)))
+
+    # ---------- Friends ----------
+
+    def get_friends(self, username):
+        return [r[0] for r in self._query(
+            "SELECT friend FROM friends WHERE username = ? ORDER BY rowid", (username,))]
+
+    def are_friends(self, user1, user2):
+        row = self._query_one("SELECT count(*) FROM friends WHERE (username = ? AND friend = ?) "
+                              "OR (username = ? AND friend = ?)", (user1, user2, user2, user1))
+        return row[0] == 2
+
+    def add_friendship(self, user1, user2):
+        with self._lock:
+            self._write("INSERT OR IGNORE INTO friends (username, friend) VALUES (?, ?)", (user1, user2))
+            self._write("INSERT OR IGNORE INTO friends (username, friend) VALUES (?, ?)", (user2, user1))
+
+    def remove_friendship(self, user1, user2):
+        self._write("DELETE FROM friends WHERE (username = ? AND friend = ?) "
+                    "OR (username = ? AND friend = ?)", (user1, user2, user2, user1))
+
+    # ---------- Friend requests ----------
+
+    def get_friend_requests(self, username):
+        return [r[0] for r in self._query(
+            "SELECT from_user FROM friend_requests WHERE to_user = ? ORDER BY rowid", (username,))]
+
+    def add_friend_request(self, to_user, from_user):
+        return self._write("INSERT OR IGNORE INTO friend_requests (to_user, from_user) VALUES (?, ?)",
+                           (to_user, from_user)) > 0
+
+    def remove_friend_request(self, to_user, from_user):
+        self._write("DELETE FROM friend_requests WHERE to_user = ? AND from_user = ?",
+                    (to_user, from_user))
+
+    # ---------- Lifecycle ----------
+
+    def close(self):
+        self._stopped.set()
+        self._committer.join(timeout=5)
+        with self._lock:
+            self.commit()
+            self.conn.close()
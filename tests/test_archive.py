@@ -0,0 +1,108 @@
+import json
+import os
+
+from archive import MessageArchive
+
+def messages(start, count):
+    return [{'id': f'm{i:03d}', 'timestamp': '2026-01-01T00:00:00', 'text': str(i)}
+            for i in range(start, start + count)]
+
+def fill(archive, count, key='r1'):
+    for message in messages(0, count):
+        archive.append('messages_db', key, message)
+
+def counting_decodes(archive):
+    decoded = []
+    decode_block = archive._decode_block
+    archive._decode_block = lambda path, entry: (decoded.append(entry['seq'] // 4),
+                                                 decode_block(path, entry))[1]
+    return decoded
+
+def test_cursors_are_located_without_a_per_message_index(tmp_path):
+    fill(MessageArchive(str(tmp_path), block_size=4), 40)
+
+    archive = MessageArchive(str(tmp_path), block_size=4, cache_blocks=1)
+    decoded = counting_decodes(archive)
+    page, _ = archive.before('messages_db', 'r1', None, 6)
+    assert [m['id'] for m in page] == [f'm{i:03d}' for i in range(34, 40)]
+    # The next page's cursor was just served: no search
+    page, _ = archive.before('messages_db', 'r1', page[0]['id'], 6)
+    assert [m['id'] for m in page] == [f'm{i:03d}' for i in range(28, 34)]
+    assert decoded == [9, 8, 7, 6]
+
+    # A block's first and last ids are in the index
+    decoded.clear()
+    assert archive.get('messages_db', 'r1', 'm016')['text'] == '16'
+    assert decoded == [4]
+
+    # Anything else is searched for, newest block first
+    decoded.clear()
+    assert archive.get('messages_db', 'r1', 'm009')['text'] == '9'
+    assert decoded == [9, 8, 7, 6, 5, 4, 3, 2]
+    assert archive.get('messages_db', 'r1', 'nope') is None
+    assert not archive.delete('messages_db', 'r1', 'nope')
+
+def test_legacy_id_lists_in_the_index_are_ignored(tmp_path):
+    fill(MessageArchive(str(tmp_path), block_size=4), 12)
+
+    # Index lines as written when blocks listed all their ids
+    conversation_dir = MessageArchive(str(tmp_path))._path('messages_db', 'r1')
+    index_file = os.path.join(conversation_dir, 'index.jsonl')
+    with open(index_file, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    for number, record in enumerate(records):
+        record['block'].pop('first_id')
+        record['block']['ids'] = [f'm{i:03d}' for i in range(number * 4, number * 4 + 4)]
+    with open(index_file, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(record) + '\n' for record in records)
+
+    archive = MessageArchive(str(tmp_path), block_size=4)
+    assert archive.get('messages_db', 'r1', 'm005')['text'] == '5'
+    page, has_more = archive.before('messages_db', 'r1', 'm005', 3)
+    assert [m['id'] for m in page] == ['m002', 'm003', 'm004'] and has_more
+    conversation = archive._conversation('messages_db', 'r1')
+    assert not any('ids' in entry for entry in conversation.blocks)
+
+def test_idle_conversations_are_unloaded(tmp_path):
+    archive = MessageArchive(str(tmp_path), block_size=4, max_conversations=2)
+    fill(archive, 8, key='r1')
+    fill(archive, 8, key='r2')
+    fill(archive, 2, key='r3')      # r1 goes: least recently used, nothing buffered
+    fill(archive, 1, key='r4')      # r2 goes; r3 has buffered messages and stays
+    assert [m['id'] for m in archive.pending('messages_db', 'r3')] == ['m000', 'm001']
+    assert len(archive._conversations) == 2
+
+    # An unloaded conversation is read back from its index
+    assert archive.last_id('messages_db', 'r1') == 'm007'
+    assert [m['id'] for m in archive.messages('messages_db', 'r1')] == [f'm{i:03d}' for i in range(8)]
+
+def test_pages_run_across_blocks_and_the_write_buffer(tmp_path):
+    archive = MessageArchive(str(tmp_path), block_size=4)
+    written = [archive.append('messages_db', 'r1', m) for m in messages(0, 10)]
+    assert [len(block) for block in written if block] == [4, 4]
+    assert [m['id'] for m in archive.pending('messages_db', 'r1')] == ['m008', 'm009']
+
+    page, has_more = archive.before('messages_db', 'r1', None, 3)
+    assert [m['id'] for m in page] == ['m007', 'm008', 'm009'] and has_more
+    page, has_more = archive.before('messages_db', 'r1', 'm007', 10)
+    assert [m['id'] for m in page] == [f'm{i:03d}' for i in range(7)] and not has_more
+    page, has_more = archive.after('messages_db', 'r1', 'm002', 3)
+    assert [m['id'] for m in page] == ['m003', 'm004', 'm005'] and has_more
+
+def test_deletes_survive_a_restart_and_drop_forgets_everything(tmp_path):
+    archive = MessageArchive(str(tmp_path), block_size=4)
+    fill(archive, 10)
+    assert archive.delete('messages_db', 'r1', 'm002')   # in a block
+    assert archive.delete('messages_db', 'r1', 'm009')   # still buffered
+    assert not archive.delete('messages_db', 'r1', 'm002')
+    assert [m['id'] for m in archive.pending('messages_db', 'r1')] == ['m008']
+
+    archive = MessageArchive(str(tmp_path), block_size=4)
+    assert archive.get('messages_db', 'r1', 'm002') is None
+    page, _ = archive.before('messages_db', 'r1', 'm004', 10)
+    assert [m['id'] for m in page] == ['m000', 'm001', 'm003']
+    assert archive.last_id('messages_db', 'r1') == 'm007'
+
+    archive.drop('messages_db', 'r1')
+    assert archive.before('messages_db', 'r1', None, 10) == ([], False)
+    assert MessageArchive(str(tmp_path)).last_id('messages_db', 'r1') is None
@@ -0,0 +1,16 @@
+from blobs import served_type, sniff_image
+
+def test_images_are_recognized_by_their_bytes():
+    assert sniff_image(b'\x89PNG\r\n\x1a\n' + b'\0' * 8) == 'image/png'
+    assert sniff_image(b'\xff\xd8\xff\xe0' + b'\0' * 8) == 'image/jpeg'
+    assert sniff_image(b'GIF89a' + b'\0' * 8) == 'image/gif'
+    assert sniff_image(b'RIFF\0\0\0\0WEBPVP8 ') == 'image/webp'
+    assert sniff_image(b'RIFF\0\0\0\0WAVEfmt ') is None
+    assert sniff_image(b'<svg xmlns="http://www.w3.org/2000/svg"></svg>') is None
+    assert sniff_image(b'<script>alert(1)</script>') is None
+
+def test_only_media_types_are_served_as_stored():
+    assert served_type('image/png') == 'image/png'
+    assert served_type('audio/webm;codecs=opus') == 'audio/webm;codecs=opus'
+    for mime_type in ('text/html', 'image/svg+xml', 'application/javascript', None):
+        assert served_type(mime_type) == 'application/octet-stream'
@@ -0,0 +1,45 @@
+import time
+
+import socketio
+
+from cluster import LocalManager, LocalPresence
+
+def test_local_manager_delivers_through_the_queue():
+    manager = LocalManager()
+    published = []
+    publish = manager._publish
+    manager._publish = lambda data: (published.append(data), publish(data))
+
+    server = socketio.Server(async_mode='threading', client_manager=manager)
+    sent = []
+    server._send_packet = lambda eio_sid, pkt: sent.append((eio_sid, pkt.data))
+    manager.initialize()
+
+    sid = manager.connect('eio-1', '/')
+    manager.connect('eio-2', '/')
+    server.enter_room(sid, 'general')
+
+    server.emit('news', {'n': 1}, room='general')
+    deadline = time.time() + 5
+    while not sent and time.time() < deadline:
+        time.sleep(0.01)
+
+    # The emit went out through the queue and came back to the room only
+    assert [p['event'] for p in published] == ['news']
+    assert sent == [('eio-1', ['news', {'n': 1}])]
+
+    manager.close()
+    manager.thread.join(timeout=5)
+    assert not manager.thread.is_alive()
+
+def test_local_presence_events_and_versions():
+    presence = LocalPresence()
+    seen = []
+    presence.subscribe('sessions_revoked', seen.append)
+    presence.publish('sessions_revoked', {'email': 'a@example.com'})
+    assert seen == [{'email': 'a@example.com'}]
+
+    assert presence.version('members:general') == 0
+    assert presence.next_version('members:general') == 1
+    assert presence.next_version('members:general') == 2
+    assert presence.version('members:general') == 2
@@ -0,0 +1,46 @@
+import pytest
+
+from directory import RoomDirectory
+
+def room(room_id, name, members=(), type='public', **fields):
+    return dict(fields, id=room_id, name=name, type=type, members=list(members),
+                created_at='2026-01-01T00:00:00')
+
+def ids(rooms):
+    return [r['id'] for r in rooms]
+
+def test_pages_cover_every_room_once_even_as_rooms_change():
+    directory = RoomDirectory()
+    for n in range(7):
+        directory.put(room(f'r{n}', f'Room {n}', members=['u'] * n))
+
+    page, cursor = directory.browse(sort='members', limit=3)
+    assert ids(page) == ['r6', 'r5', 'r4'] and cursor
+    directory.remove('r3')
+    directory.put(room('r9', 'Room 9', members=['u'] * 9))   # sorts before the cursor
+    page, cursor = directory.browse(sort='members', cursor=cursor, limit=3)
+    assert ids(page) == ['r2', 'r1', 'r0'] and cursor is None
+
+    with pytest.raises(ValueError):
+        directory.browse(sort='name', cursor=directory.browse(sort='members', limit=1)[1])
+    with pytest.raises(ValueError):
+        directory.browse(sort='members', cursor='not-a-cursor')
+
+def test_search_by_prefix_and_substring_respects_private_rooms():
+    directory = RoomDirectory()
+    directory.put(room('a', 'Go players'))
+    directory.put(room('b', 'Golf club'))
+    directory.put(room('c', 'Cargo lounge'))
+    directory.put(room('d', 'Golden secret', type='private', creator='alice', members=['bob']))
+
+    page, _ = directory.browse(query='go', sort='name')
+    assert ids(page) == ['a', 'b']                      # word prefix only
+    page, _ = directory.browse(query='go', sort='name', username='bob')
+    assert ids(page) == ['a', 'd', 'b']
+    page, _ = directory.browse(query='GOL', sort='name', username='carol')
+    assert ids(page) == ['b']                           # substring, private room hidden
+    page, _ = directory.browse(query='argo', sort='name')
+    assert ids(page) == ['c']
+
+    directory.put(room('b', 'Tennis club'))             # renamed rooms are reindexed
+    assert directory.browse(query='golf')[0] == []
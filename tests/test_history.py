@@ -0,0 +1,33 @@
+from history import MessageLog
+
+def message(n, message_id=None):
+    return {'id': message_id or f'm{n}', 'text': str(n)}
+
+def ids(messages):
+    return [m['id'] for m in messages]
+
+def test_a_full_log_evicts_the_oldest_and_forgets_its_id():
+    log = MessageLog(3, [message(n) for n in range(3)])
+    assert log.append(message(3)) == [message(0)]
+    assert ids(log) == ['m1', 'm2', 'm3']
+    assert 'm0' not in log and log.get('m0') is None
+    assert log.get('m2') == message(2)
+
+    # A reused id belongs to the newest message; evicting the old one keeps it
+    log.append(message(4, 'm2'))
+    assert log.append(message(5)) == [message(2)]
+    assert log.get('m2') == message(4, 'm2')
+    assert ids(log.pop_oldest(2)) == ['m3', 'm2']
+    assert ids(log) == ['m5'] and 'm2' not in log
+
+def test_pages_step_over_deleted_messages():
+    log = MessageLog(None, [message(n) for n in range(8)])
+    assert log.remove('m0') == message(0) and log.remove('m0') is None
+    assert log.remove('m5') == message(5)
+    assert log.first_seq == 1
+
+    assert log.page(3) == ([message(4), message(6), message(7)], True)
+    assert log.page(3, before='m4') == ([message(1), message(2), message(3)], False)
+    assert log.page(2, after='m3') == ([message(4), message(6)], True)
+    assert log.page(2, before='nope') == ([], False)
+    assert ids(log.head(2)) == ['m1', 'm2'] and ids(log.tail(2)) == ['m6', 'm7']
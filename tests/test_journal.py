@@ -0,0 +1,54 @@
+from journal import DURABILITY_SYNC, Journal
+
+def empty():
+    return {'rooms_db': {}, 'messages_db': {}}
+
+def open_journal(tmp_path):
+    journal = Journal(str(tmp_path / 'data.json'), durability=DURABILITY_SYNC)
+    return journal, journal.load(empty())
+
+def message(n):
+    return {'id': f'm{n}', 'text': str(n)}
+
+def test_replay_applies_every_record(tmp_path):
+    journal, data = open_journal(tmp_path)
+    journal.set('rooms_db', 'r1', {'id': 'r1', 'members': ['alice']})
+    journal.set_add('rooms_db', 'r1', 'members', 'bob')
+    journal.set_add('rooms_db', 'r1', 'members', 'bob')
+    journal.set_discard('rooms_db', 'r1', 'members', 'alice')
+    for n in range(6):
+        journal.append('messages_db', 'r1', message(n), limit=4)
+    journal.remove('messages_db', 'r1', 'm4')
+    journal.trim('messages_db', 'r1', 'm3')
+    journal.set('rooms_db', 'r2', {'id': 'r2'})
+    journal.delete('rooms_db', 'r2')
+    journal.close()
+
+    _, data = open_journal(tmp_path)
+    assert data['rooms_db'] == {'r1': {'id': 'r1', 'members': ['bob']}}
+    assert data['messages_db'] == {'r1': [message(5)]}
+
+def test_replay_after_compaction_is_idempotent(tmp_path):
+    journal, data = open_journal(tmp_path)
+    messages = data['messages_db'].setdefault('r1', [])
+    for n in range(3):
+        messages.append(message(n))
+        journal.append('messages_db', 'r1', message(n))
+    journal.compact(data)
+    # Records that land after the snapshot may already be in it
+    journal.append('messages_db', 'r1', message(2))
+    journal.append('messages_db', 'r1', message(3))
+    journal.close()
+
+    _, data = open_journal(tmp_path)
+    assert [m['id'] for m in data['messages_db']['r1']] == ['m0', 'm1', 'm2', 'm3']
+
+def test_torn_last_record_is_skipped(tmp_path):
+    journal, _ = open_journal(tmp_path)
+    journal.set('rooms_db', 'r1', {'id': 'r1'})
+    journal.close()
+    with open(journal._segment_path(journal._segment), 'a', encoding='utf-8') as f:
+        f.write('["s","rooms_db","r2",{"id":')
+
+    _, data = open_journal(tmp_path)
+    assert list(data['rooms_db']) == ['r1']
@@ -0,0 +1,65 @@
+import json
+import smtplib
+import time
+
+from mailer import MailQueue, SinkTransport
+
+class FlakyTransport(SinkTransport):
+    """Fails the first `failures` sends with `error`"""
+
+    def __init__(self, failures, error):
+        super().__init__()
+        self.failures = failures
+        self.error = error
+        self.closed = 0
+
+    def send(self, sender, to_email, message):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        super().send(sender, to_email, message)
+
+    def close(self):
+        self.closed += 1
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_transient_failures_are_retried(tmp_path):
+    transport = FlakyTransport(2, smtplib.SMTPServerDisconnected('gone'))
+    queue = MailQueue(transport, 'team@example.com', backoff=0.01,
+                      dead_letter_file=str(tmp_path / 'dead.jsonl'))
+    queue.start()
+    queue.send('a@example.com', 'Subject: hi\n\nhello')
+
+    assert wait_for(lambda: transport.messages)
+    queue.close()
+    assert transport.messages[0]['to'] == 'a@example.com'
+    assert transport.closed >= 2  # the connection is dropped after each failure
+    assert not (tmp_path / 'dead.jsonl').exists()
+
+def test_permanent_failures_and_exhausted_retries_are_dead_lettered(tmp_path):
+    dead_letter_file = tmp_path / 'dead.jsonl'
+    refused = smtplib.SMTPRecipientsRefused({'b@example.com': (550, b'no such user')})
+    queue = MailQueue(FlakyTransport(1, refused), 'team@example.com',
+                      dead_letter_file=str(dead_letter_file))
+    queue.start()
+    queue.send('b@example.com', 'Subject: hi\n\nhello', kind='verification')
+    assert wait_for(dead_letter_file.exists)
+    queue.close()
+
+    transport = FlakyTransport(10, smtplib.SMTPServerDisconnected('gone'))
+    queue = MailQueue(transport, 'team@example.com', backoff=0.01, max_attempts=3,
+                      dead_letter_file=str(dead_letter_file))
+    queue.start()
+    queue.send('c@example.com', 'Subject: hi\n\nhello')
+    assert wait_for(lambda: len(dead_letter_file.read_text().splitlines()) == 2)
+    queue.close()
+
+    first, second = [json.loads(line) for line in dead_letter_file.read_text().splitlines()]
+    assert (first['to'], first['kind'], first['attempts']) == ('b@example.com', 'verification', 1)
+    assert (second['to'], second['attempts']) == ('c@example.com', 3)
+    assert transport.failures == 7 and not transport.messages
@@ -0,0 +1,33 @@
+from flask import Flask
+
+from pages import REVALIDATE, Asset
+
+app = Flask(__name__)
+asset = Asset('body { color: red }' * 100, 'text/css', 1767225600)
+
+def get(**headers):
+    with app.test_request_context(headers=headers):
+        return asset.response(REVALIDATE)
+
+def test_encoding_follows_accept_encoding():
+    assert get(**{'Accept-Encoding': 'gzip, deflate'}).headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Encoding' not in get(**{'Accept-Encoding': 'gzip;q=0'}).headers
+    assert 'Content-Encoding' not in get().headers
+
+    response = get(**{'Accept-Encoding': 'gzip, br'})
+    expected = 'br' if 'br' in asset.variants else 'gzip'
+    assert response.headers['Content-Encoding'] == expected
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+def test_revalidation_answers_304_per_encoding():
+    first = get(**{'Accept-Encoding': 'gzip'})
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and etag == f'"{asset.etag("gzip")}"'
+
+    assert get(**{'Accept-Encoding': 'gzip', 'If-None-Match': etag}).status_code == 304
+    # Another encoding is another representation
+    assert get(**{'If-None-Match': etag}).status_code == 200
+    # If-None-Match wins over If-Modified-Since
+    modified = first.headers['Last-Modified']
+    assert get(**{'If-Modified-Since': modified}).status_code == 304
+    assert get(**{'If-None-Match': '"other"', 'If-Modified-Since': modified}).status_code == 200
@@ -0,0 +1,34 @@
+import time
+
+from presence import PresenceAggregator, RoomUpdateAggregator
+
+def test_flaps_inside_the_window_are_not_announced():
+    emitted = []
+    rooms = {'alice': ['r1', 'r2'], 'bob': ['r1'], 'carol': ['r2']}
+    aggregator = PresenceAggregator(rooms.get, lambda room_id, changes: emitted.append((room_id, changes)))
+
+    aggregator.record('alice', True)
+    aggregator.record('bob', True)
+    aggregator.record('bob', False)     # flap: never announced
+    aggregator.record('carol', False)
+    aggregator.record('carol', True)
+    aggregator.record('carol', False)   # net change after three events
+    aggregator.flush()
+
+    assert dict(emitted) == {
+        'r1': [{'op': 'online', 'username': 'alice'}],
+        'r2': [{'op': 'online', 'username': 'alice'}, {'op': 'offline', 'username': 'carol'}],
+    }
+    assert aggregator.stats() == {'transitions': 6, 'suppressed': 4, 'changes': 2,
+                                  'updates': 2, 'pending': 0}
+
+def test_stats_are_logged_while_they_move(capsys):
+    aggregator = RoomUpdateAggregator(lambda room_id: None, window=0.01, log_interval=0.05)
+    aggregator.start()
+    aggregator.record('r1')
+    aggregator.record('r1')
+    time.sleep(0.2)
+    aggregator.close()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ['📊 Room list: 2 member count changes, 1 room updates'] * 2
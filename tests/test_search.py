@@ -0,0 +1,18 @@
+from search import MessageSearch
+
+def test_search_is_scoped_to_the_given_conversations(tmp_path):
+    index = MessageSearch(str(tmp_path / 'search.db'))
+    index.add('private', 'alice_bob', {'id': 'p1', 'message': 'hello bob', 'from': 'alice'})
+    index.add('private', 'alice_bob_x', {'id': 'p2', 'message': 'hello bob_x', 'from': 'alice'})
+    index.add('room', 'general', {'id': 'g1', 'message': 'hello hello everyone', 'username': 'carol'})
+
+    hits, has_more = index.search('hel', ['private:alice_bob'], 10)
+    assert [hit['id'] for hit in hits] == ['p1'] and not has_more
+
+    hits, _ = index.search('hello', ['private:alice_bob', 'room:general'], 10)
+    assert sorted(hit['id'] for hit in hits) == ['g1', 'p1']
+    assert index.search('hello', [], 10) == ([], False)
+
+    index.remove('room', 'general', 'g1')
+    assert index.search('everyone', ['room:general'], 10) == ([], False)
+    index.close()
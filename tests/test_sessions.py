@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+import sessions
+from sessions import SessionIndex
+
+def session(token, seconds):
+    return {'token': token, 'expires_at': (datetime.now() + timedelta(seconds=seconds)).isoformat()}
+
+def test_retain_and_the_expiry_heap():
+    stored = {'a@example.com': [session('t1', 3600), session('t2', -5)]}
+    index = SessionIndex(lambda email: stored.get(email, []))
+
+    assert index.validate('a@example.com', 't1')      # loaded on first use
+    assert not index.validate('a@example.com', 't2')  # expired ones are never indexed
+    assert not index.validate('b@example.com', 't1')  # someone else's token
+
+    index.add('a@example.com', session('t3', 3600))
+    index.retain('a@example.com', ['t3'])
+    assert index.by_email['a@example.com'] == {'t3'}
+
+    # The heap still holds t1; the sweep skips it, and pops t4 once it is due
+    index.add('a@example.com', session('t4', 0))
+    assert index.sweep() == 1
+    assert list(index.by_token) == ['t3']
+
+def test_unknown_tokens_reload_storage_at_most_every_few_seconds(monkeypatch):
+    stored = {'a@example.com': []}
+    loads = []
+    index = SessionIndex(lambda email: loads.append(email) or stored[email])
+
+    assert not index.validate('a@example.com', 't1')
+    stored['a@example.com'] = [session('t1', 3600)]   # written by another worker
+    assert not index.validate('a@example.com', 't1')
+    assert len(loads) == 1
+
+    monkeypatch.setattr(sessions, 'MISS_RELOAD_SECONDS', 0)
+    assert index.validate('a@example.com', 't1')
+    assert len(loads) == 2
@@ -0,0 +1,84 @@
+import sys
+
+import pytest
+
+import migrate
+from journal import DURABILITY_SYNC, Journal
+from storage import JsonStorage, decode_bytes
+from storage_sqlite import SqliteStorage
+
+def json_storage(tmp_path):
+    journal = Journal(str(tmp_path / 'data.json'), object_hook=decode_bytes,
+                      durability=DURABILITY_SYNC)
+    return JsonStorage(journal)
+
+def message(n, **fields):
+    return dict(fields, id=f'm{n}', message=str(n), timestamp='2026-01-01T00:00:00')
+
+@pytest.fixture(params=['json', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'json':
+        store = json_storage(tmp_path)
+    else:
+        store = SqliteStorage(str(tmp_path / 'data.db'))
+    yield store
+    store.close()
+
+def test_json_data_imports_into_sqlite(tmp_path, monkeypatch):
+    source = json_storage(tmp_path)
+    source.create_user('a@example.com', {'username': 'alice', 'password': 'x'})
+    source.create_user('b@example.com', {'username': 'bob', 'password': 'y'})
+    source.create_room({'id': 'r1', 'name': 'General', 'type': 'public', 'members': ['alice']})
+    source.add_room_member('r1', 'bob')
+    for n in range(3):
+        source.add_room_message('r1', message(n, avatar=b'\x89PNG'))
+    source.add_private_message('alice_bob', message(9))
+    source.add_friendship('alice', 'bob')
+    source.add_friend_request('alice', 'carol')
+    source.close()
+
+    db_file = str(tmp_path / 'data.db')
+    monkeypatch.setattr(sys, 'argv', ['migrate.py', '--data', str(tmp_path / 'data.json'),
+                                      '--sqlite', db_file])
+    assert migrate.main() == 0
+
+    target = SqliteStorage(db_file)
+    try:
+        assert target.find_user_email('bob') == 'b@example.com'
+        assert target.get_user('a@example.com')['username'] == 'alice'
+        assert sorted(target.get_room('r1')['members']) == ['alice', 'bob']
+        assert target.get_room_messages('r1', 10) == [message(n, avatar=b'\x89PNG') for n in range(3)]
+        assert target.get_private_messages('alice_bob', 10) == [message(9)]
+        assert target.are_friends('alice', 'bob')
+        assert target.get_friend_requests('alice') == ['carol']
+    finally:
+        target.close()
+
+def test_history_pages(store):
+    store.create_room({'id': 'r1', 'name': 'General', 'type': 'public', 'members': []})
+    for n in range(7):
+        store.add_room_message('r1', message(n))
+
+    def page(**cursor):
+        messages, has_more = store.get_room_history('r1', 3, **cursor)
+        return [m['id'] for m in messages], has_more
+
+    assert page() == (['m4', 'm5', 'm6'], True)
+    assert page(before='m4') == (['m1', 'm2', 'm3'], True)
+    assert page(before='m1') == (['m0'], False)
+    assert page(after='m2') == (['m3', 'm4', 'm5'], True)
+    assert page(after='m3') == (['m4', 'm5', 'm6'], False)
+    assert page(before='nope') == ([], False)
+
+def test_membership_changes_report_whether_they_did_anything(store):
+    store.create_room({'id': 'r1', 'name': 'General', 'type': 'public', 'members': ['alice']})
+
+    assert not store.add_room_member('r1', 'alice')
+    assert store.add_room_member('r1', 'bob')
+    assert not store.add_room_member('missing', 'bob')
+    assert store.remove_room_member('r1', 'alice')
+    assert not store.remove_room_member('r1', 'alice')
+    assert not store.remove_room_member('missing', 'alice')
+
+    assert store.get_room('r1')['members'] == ['bob']
+    assert store.get_user_rooms('bob') == ['r1'] and store.get_user_rooms('alice') == []
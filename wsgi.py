@@ -4,14 +4,20 @@ WSGI entry point for Squad Talk
 Use this file for production deployment
 """
 
-from app import app, socketio
+import os
+
+# Production default: evented server (override with ECHOROOM_ASYNC_MODE)
+os.environ.setdefault('ECHOROOM_ASYNC_MODE', 'eventlet')
+
+import runtime
+runtime.monkey_patch()
+
+from app import app, socketio, install_shutdown_handler, run_server
+
+# Flush queued journal writes and mail on `docker stop`, also when a WSGI
+# server (gunicorn) imports this module instead of running it
+install_shutdown_handler()
 
 if __name__ == "__main__":
     # Production configuration
-    socketio.run(
-        app,
-        host='0.0.0.0',
-        port=5000,
-        debug=False,
-        allow_unsafe_werkzeug=True
-    )
+    run_server(host='0.0.0.0', port=5000)